@@ -80,4 +80,6 @@ for i in range(int(maxsteps)):
             rw.logger.add_log('reward_unclipped', r_sum, force=True)
             r_sum = 0
         s = env.reset()
-    else: s = sn
\ No newline at end of file
+        tfms[-1].reset()
+    else: s = sn
+agent.close()
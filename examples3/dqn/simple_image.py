@@ -85,6 +85,7 @@ def main():
         agent.report(r=np.array(r)[None], d=np.array(d)[None].astype('float'))
         if d or tsteps == 1000:
             _ = env.reset()
+            tfms[-1].reset()
             new_screen, last_screen = get_screen(), new_screen
             tsteps = 0
         tsteps += 1
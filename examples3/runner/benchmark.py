@@ -0,0 +1,62 @@
+"""
+Steps per second of ``rw.runner.ThreadRunner`` and ``rw.runner.PAAC`` on an env doing only
+numpy work (which releases the GIL), e.g. ``python benchmark.py --n_envs 16 --size 256``.
+"""
+import time, argparse
+import numpy as np
+import reward as rw
+
+
+class NumpyEnv:
+    "Each step multiplies the state by a (size, size) matrix, ``work`` times."
+    def __init__(self, size=128, work=4):
+        self.size, self.work = size, work
+        self.w = np.random.randn(size, size) / np.sqrt(size)
+        self.n = 0
+
+    def reset(self):
+        self.n, self.s = 0, np.random.randn(self.size)
+        return self.s[:8].astype('float32')
+
+    def step(self, a):
+        for _ in range(self.work): self.s = np.tanh(self.w @ self.s + a)
+        self.n += 1
+        return self.s[:8].astype('float32'), float(self.s[0]), self.n % 1000 == 0, {}
+
+
+def bench(runner, n_envs, steps):
+    runner.reset()
+    acs = np.zeros((n_envs, 1), dtype='float32')
+    for _ in range(10): runner.step(acs)
+    runner.stats()
+    start = time.perf_counter()
+    for _ in range(steps): runner.step(acs)
+    elapsed = time.perf_counter() - start
+    stats = runner.stats()
+    runner.close()
+    return steps * n_envs / elapsed, stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_envs', type=int, default=8)
+    parser.add_argument('--n_workers', type=int, default=4)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--work', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=500)
+    args = parser.parse_args()
+
+    env_fn = lambda: NumpyEnv(size=args.size, work=args.work)
+    S, A = rw.space.Continuous(low=-1, high=1, shape=(8,)), rw.space.Continuous(low=-1, high=1, shape=(1,))
+    runners = {
+        'ThreadRunner': lambda: rw.runner.ThreadRunner(env_fn, n_envs=args.n_envs, s_sp=S, a_sp=A, n_threads=args.n_workers),
+        'PAAC (queue)': lambda: rw.runner.PAAC(env_fn, n_envs=args.n_envs, s_sp=S, a_sp=A, n_workers=args.n_workers),
+        'PAAC (futex)': lambda: rw.runner.PAAC(env_fn, n_envs=args.n_envs, s_sp=S, a_sp=A, n_workers=args.n_workers, sync='futex'),
+    }
+    for name, runner_fn in runners.items():
+        start = time.perf_counter()
+        runner = runner_fn()
+        startup = time.perf_counter() - start
+        sps, stats = bench(runner, n_envs=args.n_envs, steps=args.steps)
+        print(f'{name:<14} {sps:10.1f} steps/s  step {stats["step_ms"]:.3f} ms  '
+              f'sync overhead {stats["sync_overhead_ms"]:.3f} ms  startup {1e3 * startup:.1f} ms')
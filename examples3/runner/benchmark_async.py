@@ -0,0 +1,46 @@
+"""
+Steps per second of ``rw.runner.AsyncRunner`` against stepping the same socket-backed envs one
+at a time (like a blocking ``BaseEnv.step`` does), with ``rw.env.LoopbackSim`` standing in
+for the external simulator, e.g. ``python benchmark_async.py --n_envs 32 --delay 0.002``.
+"""
+import time, asyncio, argparse
+import numpy as np
+import reward as rw
+
+
+async def serial_steps(envs, steps):
+    for env in envs: await env.reset()
+    for _ in range(steps):
+        for env in envs:
+            _, _, d, _ = await env.step(np.zeros(1))
+            if d: await env.reset()
+
+async def close_all(envs): await asyncio.gather(*[env.close() for env in envs])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_envs', type=int, default=16)
+    parser.add_argument('--delay', type=float, default=0.001)
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--steps', type=int, default=100)
+    args = parser.parse_args()
+
+    S, A = rw.space.Continuous(low=0, high=100, shape=(4,)), rw.space.Continuous(low=-1, high=1, shape=(1,))
+    with rw.env.LoopbackSim(delay=args.delay, jitter=args.jitter) as sim:
+        runner = rw.runner.AsyncRunner(lambda: rw.env.LoopbackEnv(sim.address), n_envs=args.n_envs, s_sp=S, a_sp=A, timeout=1.)
+        runner.reset()
+        start = time.perf_counter()
+        for _ in range(args.steps): runner.step(np.zeros((args.n_envs, 1)))
+        elapsed = time.perf_counter() - start
+        print(f'AsyncRunner {args.steps * args.n_envs / elapsed:10.1f} steps/s  step {1e3 * elapsed / args.steps:.3f} ms')
+        runner.close()
+
+        loop = asyncio.new_event_loop()
+        envs = [rw.env.LoopbackEnv(sim.address) for _ in range(args.n_envs)]
+        start = time.perf_counter()
+        loop.run_until_complete(serial_steps(envs, args.steps))
+        elapsed = time.perf_counter() - start
+        print(f'Serial      {args.steps * args.n_envs / elapsed:10.1f} steps/s  step {1e3 * elapsed / args.steps:.3f} ms')
+        loop.run_until_complete(close_all(envs))
+        loop.close()
@@ -107,6 +107,4 @@ for i in range(int(20e6)):
         s = env.reset().observation
         if ep_len % MAX_STEPS == 0: agent.write_ep_logs(d=np.array(True)[None])
         ep_len = 1
-
-
-
+agent.close()
@@ -106,4 +106,4 @@ for i in range(int(20e6)):
         if ep_len % 1000 == 0: agent.write_ep_logs(d=np.array(True)[None])
         ep_len = 0
     if NORMALIZE and (i+1) % 1000 == 0: state_norm.update()
-
+agent.close()
@@ -118,4 +118,4 @@ for i in range(int(20e6)):
     a = agent.get_act(S(s))
     s, r, d, _ = runner.step(a_map(a[0].arr))
     agent.report(r=np.array(r), d=np.array(d))
-
+agent.close()
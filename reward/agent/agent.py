@@ -1,10 +1,22 @@
+import torch
+import numpy as np
 import reward as rw, reward.utils as U
 from abc import ABC, abstractmethod
+from reward.tfm.img.img import LazyStack
 
 class Agent(ABC):
-    def __init__(self, model, *, s_sp, a_sp):
+    """
+    Base agent, receives states with ``get_act`` and rewards with ``report``.
+
+    With an asynchronous runner (e.g. ``rw.runner.PAAC`` with ``groups``) each call receives
+    only a subset of the envs, passed as ``idxs``. The subsets are assembled into full steps
+    (see ``StepAligner``) before reaching ``register_sa`` and ``report``, so episode accounting
+    and memories still see one row per env each step. This needs ``n_envs``.
+    """
+    def __init__(self, model, *, s_sp, a_sp, n_envs=None):
         self.md, self.s_sp, self.a_sp = model, U.listify(s_sp), U.listify(a_sp)
         self._rsum, self._rs, self._eplen = None, [], None
+        self._aligner = StepAligner(n_envs=n_envs, register_sa=self.register_sa, report=self.report) if n_envs else None
 
     @abstractmethod
     def register_sa(self, s, a):
@@ -14,7 +26,8 @@ class Agent(ABC):
         self._check_a(a)
 
     @abstractmethod
-    def report(self, r, d):
+    def report(self, r, d, idxs=None):
+        if idxs is not None: return self._report_idxs(r=r, d=d, idxs=idxs)
         assert r.shape == d.shape
         if self._rsum is None: self._rsum = r
         else:                  self._rsum += r
@@ -22,15 +35,39 @@ class Agent(ABC):
         self._eplen += 1
         self.write_ep_logs(d=d)
 
-    def get_act(self, s):
+    def get_act(self, s, idxs=None):
         s = U.listify(s)
         self._check_s(s)
         st = [o.to_tensor() for o in s]
         a = [sp(U.to_np(o)) for o, sp in zip(U.listify(self.md.get_act(st)), self.a_sp)]
         self._check_a(a)
-        self.register_sa(s=s, a=a)
+        if idxs is None: self.register_sa(s=s, a=a)
+        else:            self._get_aligner().add_sa(s=s, a=a, idxs=idxs)
         return a
 
+    def _report_idxs(self, r, d, idxs): self._get_aligner().add_rd(r=r, d=d, idxs=idxs)
+
+    def close(self): pass
+
+    @staticmethod
+    def _batch_tensor(arr, sp=None):
+        """
+        Moves a batch array to the device in its stored dtype (non blocking if ``arr`` is pinned),
+        the dtype ``sp.from_arr(arr).to_tensor()`` would give (float32 without ``sp``) is applied there.
+        """
+        if sp is not None and not isinstance(sp, (rw.space.Continuous, rw.space.Categorical, rw.space.Image)):
+            return sp.from_arr(arr).to_tensor()
+        x, device = torch.from_numpy(np.ascontiguousarray(arr)), U.device.get()
+        if isinstance(sp, rw.space.Categorical): return x.to(device, torch.long, non_blocking=True)
+        if not isinstance(sp, rw.space.Image): return x.to(device, torch.float32, non_blocking=True)
+        # Channels first, like ImageList.to_tensor
+        x = x.to(device, non_blocking=True).permute(*range(x.dim() - 3), -1, -3, -2)
+        return x.float() / 255. if x.dtype == torch.uint8 else x
+
+    def _get_aligner(self):
+        if self._aligner is None: raise RuntimeError('The agent needs n_envs to receive a subset of envs')
+        return self._aligner
+
     def write_ep_logs(self, d):
         for i in range(len(d)):
             if d[i]:
@@ -48,4 +85,88 @@ class Agent(ABC):
         if not len(expected) == len(recv): raise ValueError(f'Declared {name} has {len(expected)} inputs but received has {len(recv)}')
         for v1, v2 in zip(expected, recv):            
             if not hasattr(v2, 'sig'): raise TypeError(f'{name} must have a signature. (Image, Continuous or Categorical)')
-            if not isinstance(v1, v2.sig): raise TypeError(f'{name} and Declared space dont match. Expected {v1} got {v2.sig}')
\ No newline at end of file
+            if not isinstance(v1, v2.sig): raise TypeError(f'{name} and Declared space dont match. Expected {v1} got {v2.sig}')
+
+
+class StepAligner:
+    """
+    Assembles transitions of subsets of envs into full steps, in the order expected by
+    ``register_sa`` and ``report`` (states and actions of step t, then rewards and dones of step t).
+
+    Each env may run ahead of the others (envs of the same call can be in different steps), the
+    parts of a step are kept until all envs sent them. Rewards of envs that have no pending
+    action are ignored, like the ones returned after a reset.
+
+    Parameters
+    ----------
+        n_envs: int
+            Total number of envs.
+        register_sa: callable
+            Receives the full states and actions of each step.
+        report: callable
+            Receives the full rewards and dones of each step.
+    """
+    def __init__(self, n_envs, register_sa, report):
+        self.n_envs, self.register_sa, self.report = n_envs, register_sa, report
+        # Number of steps sent by each env and parts of the steps not complete yet
+        self._nsa, self._nrd = np.zeros(n_envs, dtype=int), np.zeros(n_envs, dtype=int)
+        self._sa, self._rd = {}, {}
+        self._next_sa, self._next_rd = 0, 0
+
+    def add_sa(self, s, a, idxs):
+        idxs = np.asarray(idxs)
+        if (self._nsa[idxs] > self._nrd[idxs]).any(): raise RuntimeError(f'Envs {idxs} received an action before reporting the last one')
+        for t, m in self._by_step(self._nsa, idxs): self._sa.setdefault(t, []).append((idxs[m], self._take(s, m), self._take(a, m)))
+        self._nsa[idxs] += 1
+        self._flush()
+
+    def add_rd(self, r, d, idxs):
+        idxs, r, d = np.asarray(idxs), U.to_np(r), U.to_np(d)
+        pending = self._nrd[idxs] < self._nsa[idxs]
+        if not pending.any(): return
+        idxs, r, d = idxs[pending], r[pending], d[pending]
+        for t, m in self._by_step(self._nrd, idxs): self._rd.setdefault(t, []).append((idxs[m], r[m], d[m]))
+        self._nrd[idxs] += 1
+        self._flush()
+
+    @staticmethod
+    def _by_step(counts, idxs):
+        "Splits ``idxs`` by the step each env is in, as ``(step, mask)`` pairs."
+        t = counts[idxs]
+        return [(u, t == u) for u in np.unique(t)]
+
+    @staticmethod
+    def _take(objs, m):
+        if m.all(): return objs
+        return [type(o)(LazyStack([f[m] for f in o.img.arr]) if _lazy(o) else np.asarray(o)[m]) for o in objs]
+
+    def _complete(self, parts, t): return t in parts and sum(len(o[0]) for o in parts[t]) == self.n_envs
+
+    def _flush(self):
+        while True:
+            if self._next_sa == self._next_rd and self._complete(self._sa, self._next_sa):
+                idxs, ss, acs = zip(*self._sa.pop(self._next_sa))
+                self.register_sa(s=self._cat(idxs, ss), a=self._cat(idxs, acs))
+                self._next_sa += 1
+            elif self._next_rd < self._next_sa and self._complete(self._rd, self._next_rd):
+                idxs, rs, ds = zip(*self._rd.pop(self._next_rd))
+                self.report(r=self._cat_arr(idxs, rs), d=self._cat_arr(idxs, ds))
+                self._next_rd += 1
+            else: break
+
+    def _cat(self, idxs, parts):
+        "Joins lists of space objects, the objects are rebuilt with the joined arrays."
+        return [type(os[0])(self._cat_lazy(idxs, os) if _lazy(os[0]) else self._cat_arr(idxs, [np.asarray(o) for o in os]))
+                for os in zip(*parts)]
+
+    def _cat_lazy(self, idxs, os):
+        "Joins stacks of ``rw.tfm.img.Stack`` frame by frame, memories keep storing single frames."
+        return LazyStack([self._cat_arr(idxs, fs) for fs in zip(*[o.img.arr for o in os])])
+
+    def _cat_arr(self, idxs, arrs):
+        out = np.empty((self.n_envs, *arrs[0].shape[1:]), dtype=arrs[0].dtype)
+        for i, arr in zip(idxs, arrs): out[i] = arr
+        return out
+
+
+def _lazy(o): return isinstance(getattr(o, 'img', None), LazyStack)
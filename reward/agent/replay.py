@@ -1,31 +1,46 @@
 import torch
 import reward.utils as U
+from contextlib import nullcontext
 from .agent import Agent
-from reward.mem import ReplayBuffer
+from reward.mem import ReplayBuffer, BatchPrefetcher
 
 
 class Replay(Agent):
-    def __init__(self, model, *, s_sp, a_sp, bs, maxlen, learn_freq=1., learn_start=0):
-        super().__init__(model=model, s_sp=s_sp, a_sp=a_sp)
-        self.bs, self.learn_freq, self.learn_start = bs, learn_freq, learn_start
-        self.b = ReplayBuffer(maxlen=maxlen)
+    def __init__(self, model, *, s_sp, a_sp, bs, maxlen, learn_freq=1., learn_start=0, n_step=1, memdir=None, prefetch=0, n_envs=None):
+        super().__init__(model=model, s_sp=s_sp, a_sp=a_sp, n_envs=n_envs)
+        self.bs, self.learn_freq, self.learn_start, self.n_step = bs, learn_freq, learn_start, n_step
+        self.b = ReplayBuffer(maxlen=maxlen, s_sp=self.s_sp, a_sp=self.a_sp, memdir=memdir)
+        # Batches are sampled and converted on a background thread
+        self._prefetcher = BatchPrefetcher(sample_fn=self._sample, convert_fn=self._to_tensors, k=prefetch) if prefetch else None
+        self._lock = self._prefetcher.lock if prefetch else nullcontext()
         
     def register_sa(self, s, a):
         super().register_sa(s=s, a=a)
-        self.b.add_sa(s=U.listify(s), a=U.listify(a))
+        with self._lock: self.b.add_sa(s=U.listify(s), a=U.listify(a))
 
-    def report(self, r, d):
+    def report(self, r, d, idxs=None):
+        if idxs is not None: return self._report_idxs(r=r, d=d, idxs=idxs)
         super().report(r=r, d=d)
-        self.b.add_rd(r=r, d=d)
+        with self._lock: self.b.add_rd(r=r, d=d)
         gstep = U.global_step.get()
-        if len(self.b) > self.bs and gstep % self.learn_freq == 0 and gstep > self.learn_start:
+        if len(self.b) > self.bs + self.n_step * (self.b.num_envs or 1) and gstep % self.learn_freq == 0 and gstep > self.learn_start:
             self.md.train(**self._get_batch())
 
+    def close(self):
+        "Stops the prefetching thread and the buffer threads, the agent can't learn after this."
+        if self._prefetcher is not None: self._prefetcher.close()
+        self.b.close()
+
     def _get_batch(self):
-        b = self.b.sample(bs=self.bs)            
-        b['ss'] = [sp.from_list(o).to_tensor() for o, sp in zip(b['ss'], self.s_sp)]
-        b['sns'] = [sp.from_list(o).to_tensor() for o, sp in zip(b['sns'], self.s_sp)]
-        b['acs'] = [sp.from_list(o).to_tensor() for o, sp in zip(b['acs'], self.a_sp)]
-        b['rs'] = U.tensor(b['rs'], dtype=torch.float32)
-        b['ds'] = U.tensor(b['ds'], dtype=torch.float32)
+        if self._prefetcher is not None: return self._prefetcher.get()
+        return self._to_tensors(self._sample())
+
+    def _sample(self): return self.b.sample(bs=self.bs, n_step=self.n_step, gamma=self.md.gamma)
+
+    def _to_tensors(self, b):
+        b['ss'] = [self._batch_tensor(o, sp) for o, sp in zip(b['ss'], self.s_sp)]
+        b['sns'] = [self._batch_tensor(o, sp) for o, sp in zip(b['sns'], self.s_sp)]
+        b['acs'] = [self._batch_tensor(o, sp) for o, sp in zip(b['acs'], self.a_sp)]
+        for k in ['rs', 'ds', 'gammas']:
+            if k in b: b[k] = self._batch_tensor(b[k])
         return b
@@ -1,37 +1,37 @@
-import torch
+import numpy as np
 import reward.utils as U
 from .replay import Replay
 from reward.mem import DequeBuffer
 
 
 class ReplayContinual(Replay):
-    def __init__(self, model, *, s_sp, a_sp, bs, maxlen, on_split=.5, learn_freq=1., learn_start=0):
-        super().__init__(model=model, s_sp=s_sp, a_sp=a_sp, bs=bs, maxlen=maxlen, learn_freq=1., learn_start=0)
+    def __init__(self, model, *, s_sp, a_sp, bs, maxlen, on_split=.5, learn_freq=1., learn_start=0, memdir=None, prefetch=0, n_envs=None):
+        super().__init__(model=model, s_sp=s_sp, a_sp=a_sp, bs=bs, maxlen=maxlen, learn_freq=1., learn_start=0, memdir=memdir, prefetch=prefetch, n_envs=n_envs)
         self.on_split = on_split
-        self.onb = DequeBuffer(maxlen=int(bs*on_split))
+        self.onb = DequeBuffer(maxlen=int(bs*on_split), s_sp=self.s_sp, a_sp=self.a_sp)
+        # Mixed batches are assembled in preallocated arrays, created with the first batch
+        self._mixed = {}
 
     def register_sa(self, s, a):
-        self.onb.add_sa(s=U.listify(s), a=U.listify(a))
+        with self._lock: self.onb.add_sa(s=U.listify(s), a=U.listify(a))
         super().register_sa(s=s, a=a)
 
-    def report(self, r, d):
-        self.onb.add_rd(r=r, d=d)
+    def report(self, r, d, idxs=None):
+        if idxs is not None: return self._report_idxs(r=r, d=d, idxs=idxs)
+        with self._lock: self.onb.add_rd(r=r, d=d)
         super().report(r=r, d=d)
 
-    def _get_batch(self):
-        b = self.b.sample(bs=int(self.bs * (1-self.on_split)))
-        bon = self.onb.get()
+    def _sample(self):
+        b, bon = self.b.sample(bs=int(self.bs * (1-self.on_split))), self.onb.get()
+        for k in ['ss', 'sns', 'acs']: b[k] = [self._mix((k, i), o, on) for i, (o, on) in enumerate(zip(b[k], bon[k]))]
+        for k in ['rs', 'ds']: b[k] = self._mix(k, b[k], bon[k])
+        return b
 
-        # TODO: This is ugly
-        for i in range(len(b['acs'])): b['acs'][i].extend(bon['acs'][i])
-        for i in range(len(b['ss'])): b['ss'][i].extend(bon['ss'][i])
-        for i in range(len(b['sns'])): b['sns'][i].extend(bon['sns'][i])
-        b['rs'].extend(bon['rs'])
-        b['ds'].extend(bon['ds'])
-
-        b['ss'] = [sp.from_list(o).to_tensor() for o, sp in zip(b['ss'], self.s_sp)]
-        b['sns'] = [sp.from_list(o).to_tensor() for o, sp in zip(b['sns'], self.s_sp)]
-        b['acs'] = [sp.from_list(o).to_tensor() for o, sp in zip(b['acs'], self.a_sp)]
-        b['rs'] = U.tensor(b['rs'], dtype=torch.float32)
-        b['ds'] = U.tensor(b['ds'], dtype=torch.float32)
-        return b
\ No newline at end of file
+    def _mix(self, name, off, on):
+        "Copies the off-policy and on-policy samples into the preallocated array ``name``."
+        n = len(off) + len(on)
+        arr = self._mixed.get(name)
+        if arr is None or len(arr) < n or arr.shape[1:] != off.shape[1:]:
+            arr = self._mixed[name] = np.empty((len(off) + self.onb.maxlen, *off.shape[1:]), dtype=off.dtype)
+        arr[:len(off)], arr[len(off):n] = off, on
+        return arr[:n]
@@ -1,59 +1,98 @@
-import torch
+import numpy as np
 import reward.utils as U
 from .agent import Agent
 
 
 class Rollout(Agent):
-    def __init__(self, model, *, s_sp, a_sp, bs):
-        super().__init__(model=model, s_sp=s_sp, a_sp=a_sp)
+    def __init__(self, model, *, s_sp, a_sp, bs, n_envs=None):
+        super().__init__(model=model, s_sp=s_sp, a_sp=a_sp, n_envs=n_envs)
         self.bs = bs
-        self.b = RollBatch()
+        self.b = RollBatch(horizon=bs, s_sp=self.s_sp, a_sp=self.a_sp)
         
     def register_sa(self, s, a):
         super().register_sa(s=s, a=a)
         self.b.add_sa(s=U.listify(s), a=U.listify(a))
     
-    def report(self, r, d):
+    def report(self, r, d, idxs=None):
+        if idxs is not None: return self._report_idxs(r=r, d=d, idxs=idxs)
         super().report(r=r, d=d)
         self.b.add_rd(r=r, d=d)
-        if len(self.b) > self.bs: self.md.train(**self._get_batch())
+        if len(self.b) > self.bs:
+            self.md.train(**self._get_batch())
+            self.b.reset()
 
     def _get_batch(self):
-        b = self.b.get()            
-        b['ss'] = [sp.from_list(o).to_tensor() for o, sp in zip(b['ss'], self.s_sp)]
-        b['ss'], b['sns'] = [o[:-1] for o in b['ss']], [o[1:] for o in b['ss']]            
-        b['acs'] = [sp.from_list(o).to_tensor() for o, sp in zip(b['acs'], self.a_sp)]
-        b['rs'] = U.tensor(b['rs'], dtype=torch.float32)
-        b['ds'] = U.tensor(b['ds'], dtype=torch.float32)
+        # Views of the storage (so are the tensors on cpu), only valid until the storage is reset
+        b = self.b.get(reset=False)
+        # This includes all the states and next_states, so they are moved to the device one time
+        b['ss'] = [self._batch_tensor(o, sp) for o, sp in zip(b['ss'], self.s_sp)]
+        b['ss'], b['sns'] = [o[:-1] for o in b['ss']], [o[1:] for o in b['ss']]
+        b['acs'] = [self._batch_tensor(o, sp) for o, sp in zip(b['acs'], self.a_sp)]
+        b['rs'], b['ds'] = self._batch_tensor(b['rs']), self._batch_tensor(b['ds'])
         return b
 
 
 class RollBatch:
-    def __init__(self): self.reset()        
+    """
+    Rollout storage, each space is written in place to a preallocated array with shape
+    ``(horizon + 1, num_envs, ...)``, allocated on first use. The extra row holds the state
+    after the last transition, so states and next states are views of the same array.
+
+    Parameters
+    ----------
+        horizon: int
+            Number of transitions in each rollout.
+        s_sp: Space or list of Space
+            Declared state spaces, used for the storage dtype.
+        a_sp: Space or list of Space
+            Declared action spaces, used for the storage dtype.
+    """
+    def __init__(self, horizon, s_sp=None, a_sp=None):
+        self.horizon, self.s_sp, self.a_sp = horizon, U.listify(s_sp), U.listify(a_sp)
+        self.ss, self.acs, self.rs, self.ds = None, None, None, None
+        self._ns, self._nr = 0, 0
         
-    def __len__(self):
-        return min(len(self.b.ss), len(self.b.rs))
+    def __len__(self): return min(self._ns, self._nr)
         
     def add_sa(self, s, a):
         self._check()
-        self.b.ss.append(s)
-        self.b.acs.append(a)
+        if self.ss is None: self._initialize(s=s, a=a)
+        if self._ns > self.horizon: raise RuntimeError(f'Rollout storage is full ({self.horizon} transitions), call get or reset')
+        for arr, o in zip(self.ss + self.acs, s + a): arr[self._ns] = np.asarray(o)
+        self._ns += 1
         
     def add_rd(self, r, d):
-        self.b.rs.append(r)
-        self.b.ds.append(d)
+        if self.rs is None: self.rs, self.ds = self._alloc(r, np.float32), self._alloc(d, np.bool_)
+        self.rs[self._nr], self.ds[self._nr] = r, d
+        self._nr += 1
         self._check()
         
     def get(self, reset=True):
-        d = {k: v[:len(self.b.ss) - 1] for k, v in self.b.items()}
-        # This includes all the states and next_states, so we only call to_tensor one time
-        d['ss'].append(self.b.ss[-1])
-        # Change shape from (#samples, #spaces) to (#spaces, #samples)
-        d.update({k: list(zip(*d[k])) for k in ['ss', 'acs']})
-        if reset: self.reset()
+        "States include the next state of the last transition. Views of the storage if ``reset`` is False."
+        n = len(self) - 1
+        d = dict(ss=[o[:n + 1] for o in self.ss], acs=[o[:n] for o in self.acs], rs=self.rs[:n], ds=self.ds[:n])
+        if reset:
+            d = dict(ss=[o.copy() for o in d['ss']], acs=[o.copy() for o in d['acs']], rs=d['rs'].copy(), ds=d['ds'].copy())
+            self.reset()
         return d
         
-    def reset(self): self.b = U.memories.SimpleMemory(keys=['ss', 'acs', 'rs', 'ds'])
+    def reset(self):
+        "The last transition (only used as next state) becomes the first of the next rollout."
+        self._check()
+        n = len(self) - 1
+        if n <= 0: return
+        for arr in self.ss + self.acs + [self.rs, self.ds]: arr[0] = arr[n]
+        self._ns, self._nr = self._ns - n, self._nr - n
+
+    def _initialize(self, s, a):
+        s_dtypes = [sp.dtype for sp in self.s_sp] or [None] * len(s)
+        a_dtypes = [sp.dtype for sp in self.a_sp] or [None] * len(a)
+        self.ss = [self._alloc(o, dtype) for o, dtype in zip(s, s_dtypes)]
+        self.acs = [self._alloc(o, dtype) for o, dtype in zip(a, a_dtypes)]
+
+    def _alloc(self, o, dtype=None):
+        arr = np.asarray(o)
+        return np.empty((self.horizon + 1, *arr.shape), dtype=dtype or arr.dtype)
     
     def _check(self):
-        if len(self.b.ss) != len(self.b.rs): raise RuntimeError('add_sa and add_rd should be called sequentially')
\ No newline at end of file
+        if self._ns != self._nr: raise RuntimeError('add_sa and add_rd should be called sequentially')
@@ -8,6 +8,7 @@ from .base_env import BaseEnv
 from .gym_env import GymEnv
 from .atari_env import AtariEnv
 from .roboschool_env import RoboschoolEnv
+from .loopback import LoopbackSim, LoopbackEnv
 import reward.env.wrappers
 
-__all__ = ["BaseEnv", "GymEnv", "RoboschoolEnv", "AtariEnv"]
+__all__ = ["BaseEnv", "GymEnv", "RoboschoolEnv", "AtariEnv", "LoopbackSim", "LoopbackEnv"]
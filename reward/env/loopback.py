@@ -0,0 +1,127 @@
+import struct, asyncio, threading
+import numpy as np
+
+_RESET, _STEP, _CLOSE = b'R', b'S', b'C'
+_HEADER = struct.Struct('<cI')
+_FOOTER = struct.Struct('<fB')
+
+
+class LoopbackSim:
+    """
+    Stand-in for an external simulator, serves envs over local TCP sockets, used to test and
+    benchmark runners of socket-backed simulators (see ``rw.runner.AsyncRunner``).
+
+    Each connection is an independent env. The state is ``s_dim`` copies of the number of steps
+    since the last reset, the reward is the sum of the action and episodes last ``ep_len`` steps.
+    Each answer is delayed by ``delay`` plus an exponential ``jitter``, emulating the time
+    spent by the simulator.
+
+    The server runs on an event loop in a background thread, ``start`` returns its address.
+
+    Parameters
+    ----------
+        s_dim: int
+            Size of the state.
+        ep_len: int
+            Length of each episode.
+        delay: float
+            Seconds taken by each reset and step.
+        jitter: float
+            Mean of an exponential delay (in seconds) added to each answer.
+        seed: int
+            Seed of the jitter.
+    """
+    def __init__(self, s_dim=4, ep_len=100, delay=0., jitter=0., seed=None):
+        self.s_dim, self.ep_len, self.delay, self.jitter = s_dim, ep_len, delay, jitter
+        self.rng = np.random.default_rng(seed)
+        self._loop, self._thread, self._server, self._tasks = None, None, None, set()
+        self.address = None
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(asyncio.start_server(self._serve, '127.0.0.1', 0), self._loop).result()
+        self.address = self._server.sockets[0].getsockname()[:2]
+        return self.address
+
+    def close(self):
+        if self._loop is None: return
+        async def stop():
+            self._server.close()
+            # Connections still open are served by tasks that would never finish
+            for t in self._tasks: t.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args): self.close()
+
+    async def _serve(self, reader, writer):
+        n, task = 0, asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            while True:
+                cmd, size = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                a = np.frombuffer(await reader.readexactly(size), dtype=np.float32)
+                if cmd == _CLOSE: break
+                n = 0 if cmd == _RESET else n + 1
+                r, d = (0., False) if cmd == _RESET else (float(a.sum()), n % self.ep_len == 0)
+                delay = self.delay + (self.rng.exponential(self.jitter) if self.jitter else 0.)
+                if delay: await asyncio.sleep(delay)
+                writer.write(np.full(self.s_dim, n, dtype=np.float32).tobytes() + _FOOTER.pack(r, d))
+                await writer.drain()
+        # Cancelled by close, the connection is dropped like any other
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError): pass
+        finally:
+            writer.close()
+            self._tasks.discard(task)
+
+
+class LoopbackEnv:
+    """
+    Async adapter of an env served by ``LoopbackSim``, connects on the first reset.
+
+    Parameters
+    ----------
+        address: tuple
+            ``(host, port)`` of the simulator.
+        s_dim: int
+            Size of the state.
+    """
+    def __init__(self, address, s_dim=4):
+        self.address, self.s_dim = address, s_dim
+        self._reader, self._writer = None, None
+
+    async def reset(self):
+        if self._writer is None: self._reader, self._writer = await asyncio.open_connection(*self.address)
+        s, _, _ = await self._request(_RESET)
+        return s
+
+    async def step(self, a):
+        s, r, d = await self._request(_STEP, a)
+        return s, r, d, {}
+
+    async def close(self):
+        if self._writer is None: return
+        try:
+            self._writer.write(_HEADER.pack(_CLOSE, 0))
+            self._writer.close()
+            await self._writer.wait_closed()
+        except ConnectionError: pass
+        self._reader, self._writer = None, None
+
+    async def _request(self, cmd, a=()):
+        payload = np.asarray(a, dtype=np.float32).tobytes()
+        self._writer.write(_HEADER.pack(cmd, len(payload)) + payload)
+        data = await self._reader.readexactly(4 * self.s_dim + _FOOTER.size)
+        r, d = _FOOTER.unpack(data[4 * self.s_dim:])
+        return np.frombuffer(data[:4 * self.s_dim], dtype=np.float32).copy(), r, bool(d)
@@ -11,6 +11,7 @@ def set_debug(debug=True): _logger.debug = debug
 def get_logdir(): return _logger.logdir
 
 def subscribe_log(callback): return _logger.subscribe_log(callback=callback)
+def unsubscribe_log(callback): return _logger.unsubscribe_log(callback=callback)
 
 def log(): return _logger.log()
 
@@ -15,6 +15,9 @@ class Logger:
 
     def subscribe_log(self, callback): self.callbacks.append(callback)
 
+    def unsubscribe_log(self, callback):
+        if callback in self.callbacks: self.callbacks.remove(callback)
+
     def set_logfreq(self, logfreq): self.logfreq = logfreq
 
     def set_logdir(self, logdir):
@@ -1,2 +1,6 @@
 from .replay_buffer import ReplayBuffer
-from .deque_buffer import DequeBuffer
\ No newline at end of file
+from .deque_buffer import DequeBuffer
+from .stacked_frames import StackedFrames
+from .compressed_frames import CompressedFrames
+from .prefetcher import BatchPrefetcher
+from .shared_replay_buffer import SharedReplayBuffer, ReplayShard
@@ -0,0 +1,133 @@
+import zlib, time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Soft dependency
+try:
+    import lz4.frame
+except ImportError:
+    _has_lz4 = False
+else:
+    _has_lz4 = True
+
+
+class CompressedFrames:
+    """
+    Array-like storage that keeps each entry compressed in memory.
+
+    Entries are written one at a time (``frames[i] = arr``) and read with any integer
+    index array (``frames[idxs]`` or ``frames[idxs, envs]``), the unique entries are decompressed in parallel on a
+    small thread pool (zlib and lz4 release the GIL).
+
+    Parameters
+    ----------
+        maxlen: int
+            Number of entries.
+        shape: tuple
+            Shape of each entry.
+        dtype: np.dtype
+            Type of each entry.
+        codec: str
+            ``'zlib'`` or ``'lz4'`` (needs the ``lz4`` package).
+        level: int
+            Compression level passed to the codec.
+        delta: int or None
+            If given, entries are coded as the difference to the previously written entry,
+            with a full keyframe every ``delta`` entries. Only works with integer types.
+        n_threads: int
+            Number of decompression threads, 0 decompress on the calling thread.
+    """
+    def __init__(self, maxlen, shape, dtype, codec='zlib', level=1, delta=None, n_threads=4):
+        if codec not in {'zlib', 'lz4'}: raise ValueError(f'codec should be zlib or lz4, got {codec}')
+        if codec == 'lz4' and not _has_lz4: raise ImportError('Could not import lz4')
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        if delta is not None and not np.issubdtype(self.dtype, np.integer):
+            raise ValueError(f'Delta coding only works with integer types, got {self.dtype}')
+        self.codec, self.level, self.delta = codec, level, delta
+        self.blobs, self.keys = [None] * int(maxlen), np.ones(int(maxlen), dtype=bool)
+        self._pool = ThreadPoolExecutor(max_workers=n_threads) if n_threads > 0 else None
+        self._last, self._last_idx, self._nwrites = None, None, 0
+        self.raw_bytes, self.comp_bytes, self.decode_time, self.n_decoded = 0, 0, 0., 0
+
+    def __len__(self): return len(self.blobs)
+
+    @property
+    def ratio(self): return self.raw_bytes / max(self.comp_bytes, 1)
+
+    def __setitem__(self, idx, arr):
+        idx = int(idx)
+        arr = np.ascontiguousarray(arr, dtype=self.dtype).reshape(self.shape)
+        if self.delta is None: return self._store(idx, arr, key=True)
+        # Keep the oldest entry a keyframe, so overwriting the ring never breaks a chain
+        nxt = (idx + 1) % len(self)
+        if self.blobs[nxt] is not None and not self.keys[nxt]:
+            self._store(nxt, self._decode(idx) + self._decode(nxt), key=True)
+        key = self._nwrites % self.delta == 0 or self._last_idx != (idx - 1) % len(self)
+        self._store(idx, arr if key else arr - self._last, key=key)
+        self._last, self._last_idx, self._nwrites = arr.copy(), idx, self._nwrites + 1
+
+    def __getitem__(self, key):
+        start = time.perf_counter()
+        idxs, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        idxs = np.asarray(idxs)
+        uniq, inv = np.unique(idxs, return_inverse=True)
+        out = np.empty((len(uniq),) + self.shape, dtype=self.dtype)
+        if self.delta is None: self._map(self._decode_into, [(out, i, idx) for i, idx in enumerate(uniq)])
+        else:                  self._map(self._decode_chain_into, self._chains(uniq=uniq, out=out))
+        self.decode_time += time.perf_counter() - start
+        self.n_decoded += len(uniq)
+        x = out[inv.reshape(idxs.shape)]
+        # Select inside each entry, e.g. the env of each sample
+        return x[tuple(np.indices(idxs.shape, sparse=True)) + tuple(rest)] if rest else x
+
+    def close(self):
+        if self._pool is not None: self._pool.shutdown()
+
+    def stats(self):
+        "Compression ratio and mean decode time (ms) per entry since the last call."
+        decode_ms = 1e3 * self.decode_time / max(self.n_decoded, 1)
+        self.decode_time, self.n_decoded = 0., 0
+        return self.ratio, decode_ms
+
+    def _store(self, idx, arr, key):
+        blob = self._compress(arr.tobytes())
+        if self.blobs[idx] is None: self.raw_bytes += arr.nbytes
+        else:                       self.comp_bytes -= len(self.blobs[idx])
+        self.comp_bytes += len(blob)
+        self.blobs[idx], self.keys[idx] = blob, key
+
+    def _compress(self, data):
+        if self.codec == 'zlib': return zlib.compress(data, self.level)
+        return lz4.frame.compress(data, compression_level=self.level)
+
+    def _decompress(self, blob):
+        data = zlib.decompress(blob) if self.codec == 'zlib' else lz4.frame.decompress(blob)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.shape)
+
+    def _decode(self, idx):
+        # Entries never written read as zeros, like a freshly allocated array
+        if self.blobs[idx] is None: return np.zeros(self.shape, dtype=self.dtype)
+        return self._decompress(self.blobs[idx])
+
+    def _decode_into(self, out, i, idx): out[i] = self._decode(idx)
+
+    def _chains(self, uniq, out):
+        "Groups the requested entries by the keyframe that starts their chain."
+        steps = np.full(len(uniq), -1)
+        for t in range(self.delta):
+            found = (steps < 0) & self.keys[(uniq - t) % len(self)]
+            steps[found] = t
+            if (steps >= 0).all(): break
+        keys = (uniq - steps) % len(self)
+        return [(out, np.flatnonzero(keys == k), steps[keys == k], k) for k in np.unique(keys)]
+
+    def _decode_chain_into(self, out, outidxs, steps, key):
+        x = self._decode(key).copy()
+        for t in range(steps.max() + 1):
+            if t > 0: x += self._decode((key + t) % len(self))
+            out[outidxs[steps == t]] = x
+
+    def _map(self, fn, args):
+        if self._pool is None or len(args) <= 1:
+            for a in args: fn(*a)
+        else: list(self._pool.map(lambda a: fn(*a), args))
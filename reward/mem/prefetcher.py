@@ -0,0 +1,106 @@
+import time, queue, threading
+import numpy as np
+import torch
+import reward as rw, reward.utils as U
+
+# Staging slot key of the event recorded after ``convert_fn``
+_COPIED = '_copied'
+
+
+class BatchPrefetcher:
+    """
+    Builds batches on a background thread, keeping up to ``k`` of them ready.
+
+    Each batch is sampled while holding ``lock`` (writers of the buffer should hold it too),
+    copied into staging tensors that are reused across batches (pinned when cuda is available)
+    and then converted, so the acting thread only has to pop a ready batch. ``convert_fn`` can
+    copy the pinned staging memory with ``non_blocking=True``, a slot is only reused after the
+    copies issued on the current stream are done.
+
+    A batch returned by ``get`` is valid until the next call to ``get``, after that its
+    staging memory can be overwritten.
+
+    Parameters
+    ----------
+        sample_fn: callable
+            Returns a dict of numpy arrays (or lists of arrays).
+        convert_fn: callable
+            Receives the staged batch (same structure, arrays are views of the staging memory)
+            and returns the final batch, e.g. a dict of tensors on the training device.
+        k: int
+            Maximum number of ready batches.
+        pin_memory: bool
+            Pin the staging memory, defaults to ``torch.cuda.is_available()``.
+    """
+    def __init__(self, sample_fn, convert_fn, k=2, pin_memory=None):
+        if k < 1: raise ValueError(f'k should be at least 1, got {k}')
+        self.sample_fn, self.convert_fn, self.k = sample_fn, convert_fn, k
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.lock = threading.Lock()
+        # One more slot than ready batches, the last one is held by the consumer
+        self._free, self._ready = queue.Queue(), queue.Queue()
+        for _ in range(k + 1): self._free.put({})
+        self._held, self._thread, self._stop = None, None, threading.Event()
+        self.wait_time, self.n_gets = 0., 0
+
+    @property
+    def depth(self): return self._ready.qsize()
+
+    def get(self):
+        if self._thread is None: self.start()
+        if self._held is not None: self._free.put(self._held)
+        depth, start = self.depth, time.perf_counter()
+        slot, b = self._ready.get()
+        wait = time.perf_counter() - start
+        if isinstance(b, BaseException):
+            self._held = None
+            raise b
+        self._held, self.wait_time, self.n_gets = slot, self.wait_time + wait, self.n_gets + 1
+        rw.logger.add_log('prefetch/queue_depth', depth, hidden=True)
+        rw.logger.add_log('prefetch/wait_ms', 1e3 * wait, precision=3, hidden=True)
+        return b
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        # Unblock the worker if it's waiting for a free slot
+        self._free.put({})
+        if self._thread is not None: self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            slot = self._free.get()
+            if self._stop.is_set(): break
+            # Non blocking copies from the staging memory may still be running
+            event = slot.pop(_COPIED, None)
+            if event is not None: event.synchronize()
+            try:
+                with self.lock: b = self.sample_fn()
+                b = self.convert_fn(self._stage(slot, b))
+                if self.pin_memory:
+                    slot[_COPIED] = torch.cuda.Event()
+                    slot[_COPIED].record()
+            except BaseException as e:
+                self._ready.put((slot, e))
+                break
+            self._ready.put((slot, b))
+
+    def _stage(self, slot, b):
+        out = U.memories.SimpleMemory()
+        for k, v in b.items():
+            if isinstance(v, (list, tuple)): out[k] = [self._stage_arr(slot, (k, i), o) for i, o in enumerate(v)]
+            else:                            out[k] = self._stage_arr(slot, k, v)
+        return out
+
+    def _stage_arr(self, slot, name, arr):
+        src = torch.from_numpy(np.ascontiguousarray(arr))
+        t = slot.get(name)
+        if t is None or t.shape != src.shape or t.dtype != src.dtype:
+            t = slot[name] = torch.empty(src.shape, dtype=src.dtype, pin_memory=self.pin_memory)
+        t.copy_(src)
+        return t.numpy()
@@ -1,79 +1,378 @@
 import numpy as np
-import torch, pickle
-import reward.utils as U
+import torch, pickle, shutil, uuid
+import reward as rw, reward.utils as U
 from pathlib import Path
+from reward.tfm.img.img import LazyStack
+from reward.space.image import Image
+from .stacked_frames import StackedFrames
+from .compressed_frames import CompressedFrames
 
 
 class ReplayBuffer:
-    def __init__(self, maxlen, num_envs=1):
-        assert num_envs == 1, 'Only works with one env for now'
+    """
+    Columnar replay buffer, each declared space is stored in a single preallocated array
+    with shape ``(maxlen // num_envs, num_envs, ...)``.
+
+    Storage is allocated on the first call to ``add_sa``, using the shape of the received
+    objects and the dtype of the declared spaces (if given). Each call writes the whole
+    batch of envs, and ``sample`` draws ``(t, env)`` pairs so next states never cross envs.
+    Sampling returns one array per space with shape ``(bs, 1, ...)``, ready to be converted
+    with ``sp.from_arr(arr).to_tensor()``.
+
+    States stacked with ``rw.tfm.img.Stack`` are stored as single frames (see ``StackedFrames``),
+    image states can optionally be kept compressed in memory (see ``CompressedFrames``).
+
+    Parameters
+    ----------
+        maxlen: int
+            Maximum number of transitions stored (over all envs).
+        num_envs: int
+            Number of envs in each write, inferred from the first state if None.
+        s_sp: Space or list of Space
+            Declared state spaces, used for the storage dtype.
+        a_sp: Space or list of Space
+            Declared action spaces, used for the storage dtype.
+        memdir: str or Path
+            If given, the arrays are backed by ``np.memmap`` files in this directory. A buffer
+            already stored in ``memdir`` is reopened instead of being created.
+        compress: str
+            Codec used to compress image states (``'zlib'`` or ``'lz4'``), None disables compression.
+        compress_kw: dict
+            Extra arguments passed to ``CompressedFrames`` (e.g. ``level``, ``delta``, ``n_threads``).
+        seed: int or np.random.Generator
+            Seed used by ``sample``.
+    """
+    def __init__(self, maxlen, num_envs=None, *, s_sp=None, a_sp=None, memdir=None, compress=None, compress_kw=None, seed=None):
         # Position intialized at -1 so the first updated position is 0
-        self.maxlen, self.buffer, self.position = int(maxlen), [], -1
+        self.maxlen, self.num_envs, self.position, self._len = int(maxlen), num_envs, -1, 0
+        # Time steps added since creation, used to number the saved shards
+        self._total, self._uid = 0, uuid.uuid4().hex
+        self.s_sp, self.a_sp = U.listify(s_sp), U.listify(a_sp)
+        self.ss, self.acs, self.rs, self.ds = None, None, None, None
         self._cycle = False
+        self.sampler = U.buffers.IndexSampler(seed)
+        if compress is not None and memdir is not None: raise ValueError('Compression is not supported with memdir')
+        self.compress, self.compress_kw = compress, compress_kw or {}
+        self._storage = None if memdir is None else U.buffers.MemmapStorage(memdir)
+        if self._storage is not None and not self._storage.empty: self._reopen()
+
+    def __len__(self): return self._len * (self.num_envs or 1)
+
+    def __getitem__(self, key):
+        return dict(ss=[o[key] for o in self.ss], acs=[o[key] for o in self.acs], rs=self.rs[key], ds=self.ds[key])
+
+    @property
+    def real_maxlen(self): return self.maxlen // self.num_envs
+
+    @property
+    def full(self): return self._len == self.real_maxlen
+
+    @property
+    def oldest(self): return (self.position + 1) % self.real_maxlen if self.full else 0
+
+    @property
+    def _stale(self):
+        "Oldest time steps of a full buffer whose stacked states lost frames to the ring, never sampled."
+        return max([n - 1 for n in self._stacks if n is not None] or [0]) if self.full else 0
+
+    def _alloc(self, name, shape, dtype):
+        if self._storage is None: return np.empty((self.real_maxlen, *shape), dtype=dtype)
+        return self._storage.alloc(name, (self.real_maxlen, *shape), dtype)
+
+    def _initialize_sa(self, s, a):
+        num_envs = len(np.asarray(s[0].img.arr[-1] if isinstance(getattr(s[0], 'img', None), LazyStack) else s[0]))
+        if self.num_envs is None: self.num_envs = num_envs
+        if num_envs != self.num_envs: raise ValueError(f'Expected states with {self.num_envs} envs, got {num_envs}')
+        s_dtypes = [sp.dtype for sp in self.s_sp] or [None] * len(s)
+        a_dtypes = [sp.dtype for sp in self.a_sp] or [None] * len(a)
+        stacks = [self._stack_size(o) for o in s]
+        s_arrs = [np.asarray(o if n is None else o.img.arr[-1]) for o, n in zip(s, stacks)]
+        a_arrs = [np.asarray(o) for o in a]
+        self._allocate(s_cls=[o.__class__ for o in s], a_cls=[o.__class__ for o in a], stacks=stacks,
+                       images=[getattr(o, 'sig', None) is Image for o in s],
+                       s_layout=[(o.shape, dtype or o.dtype) for o, dtype in zip(s_arrs, s_dtypes)],
+                       a_layout=[(o.shape, dtype or o.dtype) for o, dtype in zip(a_arrs, a_dtypes)])
 
-    def __len__(self): return len(self.buffer)
+    @staticmethod
+    def _stack_size(o):
+        "Number of frames of states stacked with ``rw.tfm.img.Stack``, stored as single frames."
+        return len(o.img.arr) if isinstance(getattr(o, 'img', None), LazyStack) else None
 
-    def __getitem__(self, key): return self.buffer[key]
+    def _initialize_from_manifest(self, m):
+        if self.num_envs not in {None, m['num_envs']}: raise ValueError(f'Saved buffer has {m["num_envs"]} envs, got {self.num_envs}')
+        self.num_envs = m['num_envs']
+        self._allocate(s_cls=m['s_cls'], a_cls=m['a_cls'], stacks=m['stacks'], images=m['images'],
+                       s_layout=[m['arrs'][f'state_{i}'] for i in range(len(m['s_cls']))],
+                       a_layout=[m['arrs'][f'action_{i}'] for i in range(len(m['a_cls']))])
+        self.rs, self.ds = self._alloc('reward', *m['arrs']['reward']), self._alloc('done', *m['arrs']['done'])
 
-    def _get_batch(self, idxs):
-        samples = [self[i] for i in idxs]
-        b = U.memories.SimpleMemory.from_dicts(samples)
-        # Add next state to batch
-        b.sns = [self[i + 1]["ss"] for i in idxs]
-        # Change shape from (#samples, #spaces) to (#spaces, #samples)
-        b.update({k: list(map(list, zip(*b[k]))) for k in ['ss', 'sns', 'acs']})
+    def _allocate(self, s_cls, a_cls, stacks, images, s_layout, a_layout):
+        self._s_cls, self._a_cls, self._stacks, self._images = s_cls, a_cls, stacks, images
+        self.ss = [self._alloc_state(f'state_{i}', shape, dtype, n, image)
+                   for i, ((shape, dtype), n, image) in enumerate(zip(s_layout, stacks, images))]
+        self.acs = [self._alloc(f'action_{i}', shape, dtype) for i, (shape, dtype) in enumerate(a_layout)]
+        if self._storage is not None:
+            self._storage.set_info(maxlen=self.maxlen, num_envs=self.num_envs, s_cls=s_cls, a_cls=a_cls, stacks=stacks, images=images)
+        if self._compressed: rw.logger.subscribe_log(self._write_logs)
+
+    def _initialize_rd(self, r, d):
+        self.rs = self._alloc('reward', np.shape(r), np.float32)
+        self.ds = self._alloc('done', np.shape(d), np.bool_)
+
+    def _alloc_state(self, name, shape, dtype, n=None, image=False):
+        if self.compress is not None and image: frames = CompressedFrames(self.real_maxlen, shape, dtype, codec=self.compress, **self.compress_kw)
+        else:                                   frames = self._alloc(name, shape, dtype)
+        return frames if n is None else StackedFrames(frames, n=n, b=self)
+
+    @property
+    def _compressed(self):
+        frames = [o.frames if isinstance(o, StackedFrames) else o for o in self.ss]
+        return [(i, o) for i, o in enumerate(frames) if isinstance(o, CompressedFrames)]
+
+    def _write_logs(self):
+        for i, frames in self._compressed:
+            ratio, decode_ms = frames.stats()
+            rw.logger.add_log(f'replay/state_{i}/compression_ratio', ratio)
+            rw.logger.add_log(f'replay/state_{i}/decode_ms', decode_ms, precision=4)
+
+    def _write(self, arr, o):
+        arr[self.position] = o if isinstance(arr, StackedFrames) else np.asarray(o)
+
+    def _reopen(self):
+        info = self._storage.info
+        if info['maxlen'] != self.maxlen: raise ValueError(f'Buffer stored in {self._storage.path} has maxlen {info["maxlen"]}, got {self.maxlen}')
+        if self.num_envs not in {None, info['num_envs']}: raise ValueError(f'Buffer stored in {self._storage.path} has {info["num_envs"]} envs, got {self.num_envs}')
+        self.num_envs = info['num_envs']
+        self._s_cls, self._a_cls, self._stacks = info['s_cls'], info['a_cls'], info['stacks']
+        self._images = info.get('images', [False] * len(self._s_cls))
+        self.ss = [self._storage.get(f'state_{i}') for i in range(len(self._s_cls))]
+        self.ss = [o if n is None else StackedFrames(o, n=n, b=self) for o, n in zip(self.ss, self._stacks)]
+        self.acs = [self._storage.get(f'action_{i}') for i in range(len(self._a_cls))]
+        if 'reward' in self._storage: self.rs, self.ds = self._storage.get('reward'), self._storage.get('done')
+        # Only complete transitions are recorded by the cursor
+        self.position, self._len = self._storage.get_cursor()
+        if self._len == 0: self.position = -1
+        self._total = self._len
+
+    def flush(self):
+        if self._storage is not None: self._storage.flush()
+
+    def close(self):
+        "Stops the decompression threads of compressed states and their logs."
+        if self.ss is None or not self._compressed: return
+        rw.logger.unsubscribe_log(self._write_logs)
+        for _, frames in self._compressed: frames.close()
+
+    def _get_batch(self, idxs, envs=None, n_step=1, gamma=1.):
+        "Gathers the transitions at time ``idxs`` of ``envs``, with shape (#samples, 1, ...)."
+        envs = np.zeros_like(idxs) if envs is None else envs
+        take = lambda arr, t: arr[t, envs][:, None]
+        b = U.memories.SimpleMemory()
+        b.ss = [take(o, idxs) for o in self.ss]
+        b.acs = [take(o, idxs) for o in self.acs]
+        if n_step == 1:
+            nidxs = (idxs + 1) % self.real_maxlen
+            b.rs, b.ds = take(self.rs, idxs), take(self.ds, idxs)
+        else: nidxs, b.rs, b.ds, b.gammas = self._n_step(idxs=idxs, envs=envs, n_step=n_step, gamma=gamma)
+        b.sns = [take(o, nidxs) for o in self.ss]
         return b
-    
+
+    def _n_step(self, idxs, envs, n_step, gamma):
+        "Discounted n-step rewards, bootstrap indexes and effective discounts, truncated at episode ends."
+        pos, envs = (idxs[:, None] + np.arange(n_step)) % self.real_maxlen, envs[:, None]
+        rs, ds = self.rs[pos, envs], self.ds[pos, envs].astype(bool)
+        # Steps after the end of an episode are masked out
+        mask = np.ones_like(ds)
+        mask[:, 1:] = ~np.logical_or.accumulate(ds, axis=1)[:, :-1]
+        steps = mask.sum(axis=1)
+        rs = (rs * mask * gamma ** np.arange(n_step)).sum(axis=1)
+        ds = (ds & mask).any(axis=1)
+        gammas = gamma ** steps
+        return (idxs + steps) % self.real_maxlen, rs[:, None].astype(np.float32), ds[:, None], gammas[:, None].astype(np.float32)
+
+    def _ordered_idxs(self, idxs=None):
+        "Maps time steps relative to the oldest one to storage indexes."
+        idxs = np.arange(self._len) if idxs is None else np.asarray(idxs)
+        return (idxs + self.oldest) % self.real_maxlen
+
     def add_sa(self, s, a):
         if self._cycle: raise RuntimeError('add_sa and add_rd should be called sequentially')
         self._cycle = True
-        # If buffer is not full, add a new element
-        if len(self) < self.maxlen: self.buffer.append(None)
-        self.position = (self.position + 1) % self.maxlen
-        self.buffer[self.position] = dict(ss=s, acs=a)
-    
+        if self.ss is None: self._initialize_sa(s=s, a=a)
+        self.position, self._total = (self.position + 1) % self.real_maxlen, self._total + 1
+        self._len = min(self._len + 1, self.real_maxlen)
+        for arr, o in zip(self.ss, s): self._write(arr, o)
+        for arr, o in zip(self.acs, a): self._write(arr, o)
+
     def add_rd(self, r, d):
         if not self._cycle: raise RuntimeError('add_sa and add_rd should be called sequentially')
         self._cycle = False
-        self.buffer[self.position].update(dict(rs=r, ds=d))
+        if self.rs is None: self._initialize_rd(r=r, d=d)
+        self.rs[self.position], self.ds[self.position] = r, d
+        if self._storage is not None: self._storage.set_cursor(self.position, self._len)
 
     def add_transition(self, *, s, a, r, d):
         self.add_sa(s=s, a=a)
         self.add_rd(r=r, d=d)
 
-    def sample(self, bs):
-        idxs = np.random.choice(len(self) - 1, bs, replace=False)
-        return self._get_batch(idxs=idxs)
+    def sample(self, bs, n_step=1, gamma=1.):
+        """
+        Samples ``bs`` transitions from random ``(t, env)`` pairs.
+
+        With ``n_step > 1``, ``rs`` are the discounted sum of the next ``n_step`` rewards
+        (truncated at the end of the episode), ``sns`` the state to bootstrap from and
+        ``gammas`` the discount to apply to its value (``gamma ** steps``).
+
+        Once the buffer is full, the oldest ``n - 1`` steps of states stacked with ``n`` frames
+        are not sampled, their first frames were overwritten.
+        """
+        # The newest transitions don't have the next n states yet
+        flat = self.sampler.sample(n=(self._len - n_step - self._stale) * self.num_envs, bs=bs)
+        idxs, envs = np.divmod(flat, self.num_envs)
+        return self._get_batch(idxs=self._ordered_idxs(idxs + self._stale), envs=envs, n_step=n_step, gamma=gamma)
+
+    def sample_seq(self, bs, seq_len, burn_in=0):
+        """
+        Samples ``bs`` sequences of ``burn_in + seq_len`` contiguous time steps of a single env,
+        with shape ``(bs, burn_in + seq_len, ...)``, gathered with a single index per array.
+
+        Sequences can cross the end of episodes, ``masks`` is True only for the steps in the
+        same episode as the first step after the burn-in.
+        """
+        n = burn_in + seq_len
+        # The last step of a sequence needs its next state
+        flat = self.sampler.sample(n=(self._len - n - self._stale) * self.num_envs, bs=bs)
+        idxs, envs = np.divmod(flat, self.num_envs)
+        pos, envs = self._ordered_idxs(idxs[:, None] + self._stale + np.arange(n)), np.repeat(envs, n)
+        def take(arr, t):
+            x = arr[t.ravel(), envs]
+            return x.reshape((bs, n) + x.shape[1:])
+        b = U.memories.SimpleMemory()
+        b.ss = [take(o, pos) for o in self.ss]
+        b.sns = [take(o, (pos + 1) % self.real_maxlen) for o in self.ss]
+        b.acs = [take(o, pos) for o in self.acs]
+        b.rs, b.ds = take(self.rs, pos), take(self.ds, pos)
+        b.masks = self._seq_masks(ds=b.ds.astype(bool), burn_in=burn_in)
+        return b
+
+    @staticmethod
+    def _seq_masks(ds, burn_in):
+        "Steps that belong to the episode of step ``burn_in``."
+        # Ended before step k, for k after the burn-in
+        after = np.zeros_like(ds)
+        after[:, burn_in + 1:] = np.logical_or.accumulate(ds[:, burn_in:-1], axis=1)
+        # Ended at or after step k, for k in the burn-in
+        before = np.zeros_like(ds)
+        before[:, :burn_in] = np.logical_or.accumulate(ds[:, :burn_in][:, ::-1], axis=1)[:, ::-1]
+        return ~(after | before)
+
+    def save(self, savedir, shard_size=10000):
+        """
+        Writes the buffer as shards of ``shard_size`` time steps (one ``.npy`` per array)
+        plus a ``manifest.pkl``, only one shard is gathered in memory at a time.
 
-    def save(self, savedir):
+        Saving again to the same directory only writes the shards that changed since the
+        last call and removes the ones that left the buffer, so it can be called
+        periodically while the buffer fills.
+        """
         path = Path(savedir)/'buffer'
-        path.mkdir(exist_ok=True, parents=True)
-        mem = U.memories.SimpleMemory.from_dicts(self.buffer)
-        mem.update({k: list(zip(*mem[k])) for k in ['ss', 'acs']})
-        info = {}
-        info.update(self._save_space(mem.ss, name='state', savedir=path))
-        info.update(self._save_space(mem.acs, name='action', savedir=path))
-        np.save(path/'reward.npy', np.array(mem.rs))
-        np.save(path/'done.npy', np.array(mem.ds))
-        with open(str(path/'info.pkl'), 'wb') as f: pickle.dump(info, f)
-
-    def load(self, loaddir):
-        loaddir = Path(loaddir)/'buffer'
+        (path/'shards').mkdir(exist_ok=True, parents=True)
+        if self.rs is None: return
+        old = self._read_manifest(path)
+        # The newest transition is not complete between add_sa and add_rd
+        stop = self._total - self._cycle
+        start = stop - (self._len - self._cycle)
+        arrs = self._named_arrs()
+        m = dict(uid=self._uid, shard_size=shard_size, start=start, stop=stop, num_envs=self.num_envs,
+                 s_cls=self._s_cls, a_cls=self._a_cls, stacks=self._stacks, images=self._images,
+                 arrs={k: self._row_layout(v) for k, v in arrs.items()}, shards=[])
+        same = old is not None and (old['uid'], old['shard_size'], old['arrs']) == (self._uid, shard_size, m['arrs'])
+        saved = {o['name']: o for o in old['shards']} if same else {}
+        for k in range(start // shard_size, -(-stop // shard_size)):
+            lo, hi = max(k * shard_size, start), min((k + 1) * shard_size, stop)
+            # Complete shards never change, the last one is written under a new name each time
+            name = f'{k:06d}' if hi == (k + 1) * shard_size else f'{k:06d}_{hi}'
+            if name in saved and saved[name]['start'] <= lo: m['shards'].append(saved[name]); continue
+            (path/'shards'/name).mkdir(exist_ok=True)
+            idxs = self._global_idxs(np.arange(lo, hi))
+            for n, arr in arrs.items(): np.save(path/'shards'/name/f'{n}.npy', self._read_rows(arr, idxs))
+            m['shards'].append(dict(name=name, start=lo, stop=hi))
+        tmp = path/'manifest.pkl.tmp'
+        with open(str(tmp), 'wb') as f: pickle.dump(m, f)
+        tmp.replace(path/'manifest.pkl')
+        keep = {o['name'] for o in m['shards']}
+        for o in (path/'shards').iterdir():
+            if o.name not in keep: shutil.rmtree(str(o))
+
+    def load(self, loaddir, start=None, stop=None):
+        """
+        Bulk copies a buffer written by ``save`` into the storage, after the current transitions.
+
+        ``start`` and ``stop`` select the saved time steps like a ``slice`` (relative to the
+        oldest saved one), e.g. ``start=-1000`` only loads the newest 1000 steps.
+        """
+        path = Path(loaddir)/'buffer'
+        m = self._read_manifest(path)
+        if m is None: return self._load_legacy(path)
+        if self._cycle: raise RuntimeError('Cannot load between add_sa and add_rd')
+        steps = range(m['start'], m['stop'])[start:stop]
+        if len(steps) == 0: return
+        if self.rs is None: self._initialize_from_manifest(m)
+        layout = {k: self._row_layout(v) for k, v in self._named_arrs().items()}
+        if layout != m['arrs']: raise ValueError(f'Buffer saved in {path} has layout {m["arrs"]}, got {layout}')
+        # Only the newest steps fit in the buffer
+        lo, hi = max(steps.start, steps.stop - self.real_maxlen), steps.stop
+        for sh in m['shards']:
+            a, b = max(lo, sh['start']), min(hi, sh['stop'])
+            if a >= b: continue
+            idxs = (self.position + 1 + np.arange(b - a)) % self.real_maxlen
+            for n, arr in self._named_arrs().items():
+                x = np.load(path/'shards'/sh['name']/f'{n}.npy', mmap_mode='r')
+                self._write_rows(arr, idxs, x[a - sh['start']:b - sh['start']])
+            self.position, self._total = int(idxs[-1]), self._total + b - a
+            self._len = min(self._len + b - a, self.real_maxlen)
+        if self._storage is not None: self._storage.set_cursor(self.position, self._len)
+
+    def _named_arrs(self):
+        arrs = {f'state_{i}': o for i, o in enumerate(self.ss)}
+        arrs.update({f'action_{i}': o for i, o in enumerate(self.acs)})
+        arrs.update(reward=self.rs, done=self.ds)
+        return arrs
+
+    def _global_idxs(self, steps):
+        "Maps the number of a time step (counted since the buffer was created) to its storage index."
+        return (self.position - (self._total - 1 - steps)) % self.real_maxlen
+
+    @staticmethod
+    def _row_layout(arr):
+        arr = arr.frames if isinstance(arr, StackedFrames) else arr
+        shape = arr.shape if isinstance(arr, CompressedFrames) else arr.shape[1:]
+        return tuple(shape), np.dtype(arr.dtype).str
+
+    @staticmethod
+    def _read_rows(arr, idxs): return arr.frames[idxs] if isinstance(arr, StackedFrames) else arr[idxs]
+
+    @staticmethod
+    def _write_rows(arr, idxs, x):
+        arr = arr.frames if isinstance(arr, StackedFrames) else arr
+        if isinstance(arr, CompressedFrames):
+            for i, o in zip(idxs, x): arr[i] = o
+        else: arr[idxs] = x
+
+    @staticmethod
+    def _read_manifest(path):
+        try:
+            with open(str(path/'manifest.pkl'), 'rb') as f: return pickle.load(f)
+        except FileNotFoundError: return None
+
+    def _load_legacy(self, loaddir):
+        "Loads the format written before sharded saves."
         with open(str(loaddir/'info.pkl'), 'rb') as f: info = pickle.load(f)
         ss = self._load_space(loaddir=loaddir, info=info['state'])
         acs = self._load_space(loaddir=loaddir, info=info['action'])
         rs, ds = np.load(loaddir/'reward.npy'), np.load(loaddir/'done.npy')
         assert len(ss) == len(acs) == len(rs) == len(ds)
-        for s, a, r, d in zip(ss, acs, rs, ds): self.add_transition(s=s, a=a, r=r, d=d)
-
-    def _save_space(self, x, name, savedir):
-        info = {name: []}
-        for i, o in enumerate(x):
-            postfix = f'{name}_{i}'
-            olist = o[0].from_list(o)
-            olist.save(savedir=savedir, postfix=postfix)
-            info[name].append(dict(name=postfix, cls=olist.__class__))
-        return info
+        for s, a, r, d in zip(ss, acs, rs, ds): self.add_transition(s=list(s), a=list(a), r=r, d=d)
 
     def _load_space(self, loaddir, info):
-        return list(zip(*[o['cls'].load(loaddir=loaddir, postfix=o['name']).unpack() for o in info]))
\ No newline at end of file
+        return list(zip(*[o['cls'].load(loaddir=loaddir, postfix=o['name']).unpack() for o in info]))
@@ -0,0 +1,133 @@
+import numpy as np
+import torch
+import reward.utils as U
+from .replay_buffer import ReplayBuffer
+from .stacked_frames import StackedFrames
+
+
+class ReplayShard(ReplayBuffer):
+    """
+    Ring of a ``SharedReplayBuffer`` written by a single actor process.
+
+    The arrays are views of shared tensors (moved to shared memory with ``share_memory_``,
+    like ``rw.runner.PAAC``), the shard can be sent to another process and keeps writing
+    to the same memory. After each ``add_rd`` the number of complete transitions written
+    is published to a shared counter, the only state read by the learner.
+    """
+    def __init__(self, maxlen, num_envs=None, *, s_sp=None, a_sp=None, seed=None):
+        super().__init__(maxlen=maxlen, num_envs=num_envs, s_sp=s_sp, a_sp=a_sp, seed=seed)
+        self._tensors, self._cursor = {}, torch.zeros(1, dtype=torch.int64).share_memory_()
+
+    def __getstate__(self):
+        # Arrays are rebuilt from the shared tensors, so they are never copied when pickled
+        state = self.__dict__.copy()
+        state.update(ss=None, acs=None, rs=None, ds=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._tensors: self._create_views()
+
+    def _alloc(self, name, shape, dtype):
+        arr = np.zeros((self.real_maxlen, *shape), dtype=dtype)
+        # torch has no uint16/uint32 types, store the raw bytes instead
+        t = torch.from_numpy(arr.view(np.uint8) if arr.dtype.kind == 'u' and arr.dtype.itemsize > 1 else arr)
+        self._tensors[name] = (t.share_memory_(), arr.dtype)
+        return self._view(name)
+
+    def _view(self, name):
+        t, dtype = self._tensors[name]
+        return t.numpy().view(dtype)
+
+    def _create_views(self):
+        self.ss = [self._view(f'state_{i}') for i in range(len(self._s_cls))]
+        self.ss = [o if n is None else StackedFrames(o, n=n, b=self) for o, n in zip(self.ss, self._stacks)]
+        self.acs = [self._view(f'action_{i}') for i in range(len(self._a_cls))]
+        if 'reward' in self._tensors: self.rs, self.ds = self._view('reward'), self._view('done')
+
+    def add_rd(self, r, d):
+        super().add_rd(r=r, d=d)
+        # Published after the transition is written, a single aligned int64 store
+        self._cursor[0] = self._total
+
+    def sync(self):
+        "Reads the position of the writer, called by the learner before sampling."
+        self._total = int(self._cursor[0])
+        self.position, self._len = (self._total - 1) % self.real_maxlen, min(self._total, self.real_maxlen)
+
+
+class SharedReplayBuffer:
+    """
+    Replay buffer in shared memory, written by several actor processes and sampled by a
+    learner process (Ape-X style).
+
+    The storage is split in ``n_shards`` rings (see ``ReplayShard``), one per actor, so
+    each actor owns its write cursor and no locks are needed. The learner samples
+    uniformly over the complete transitions of all shards.
+
+    Storage is allocated by ``initialize`` with an example transition (of a single actor),
+    before the shards are sent to the actors.
+
+    Examples
+    --------
+        b = SharedReplayBuffer(maxlen=1e6, n_shards=4, s_sp=s_sp, a_sp=a_sp)
+        b.initialize(s=s, a=a, r=r, d=d)
+        ps = [mp.Process(target=act, args=(b.shards[i],)) for i in range(4)]
+        # Actors call shard.add_sa / shard.add_rd, the learner calls b.sample(bs)
+
+    Parameters
+    ----------
+        maxlen: int
+            Maximum number of transitions stored (over all shards and envs).
+        n_shards: int
+            Number of actors writing to the buffer.
+        s_sp: Space or list of Space
+            Declared state spaces, used for the storage dtype.
+        a_sp: Space or list of Space
+            Declared action spaces, used for the storage dtype.
+        guard: int
+            Oldest time steps of a full shard that are never sampled, the actor may
+            overwrite them while a batch is gathered.
+        seed: int or np.random.Generator
+            Seed used by ``sample``.
+    """
+    def __init__(self, maxlen, n_shards, *, s_sp=None, a_sp=None, guard=4, seed=None):
+        self.maxlen, self.n_shards, self.guard = int(maxlen), n_shards, guard
+        self.shards = [ReplayShard(maxlen=self.maxlen // n_shards, s_sp=s_sp, a_sp=a_sp) for _ in range(n_shards)]
+        self.sampler = U.buffers.IndexSampler(seed)
+
+    def __len__(self):
+        for o in self.shards: o.sync()
+        return sum(len(o) for o in self.shards)
+
+    @property
+    def num_envs(self): return self.shards[0].num_envs
+
+    def initialize(self, s, a, r, d):
+        "Allocates the shared storage with the layout of an example transition."
+        for o in self.shards:
+            o._initialize_sa(s=U.listify(s), a=U.listify(a))
+            o._initialize_rd(r=r, d=d)
+
+    def sample(self, bs, n_step=1, gamma=1.):
+        "Same as ``ReplayBuffer.sample``, over the complete transitions of all shards."
+        for o in self.shards: o.sync()
+        # Number of time steps that can be sampled from each shard
+        skip = np.array([self.guard + o._stale if o.full else 0 for o in self.shards])
+        steps = np.array([max(o._len - n_step - k, 0) for o, k in zip(self.shards, skip)])
+        ends = np.cumsum(steps * self.num_envs)
+        flat = self.sampler.sample(n=ends[-1], bs=bs)
+        shard = np.searchsorted(ends, flat, side='right')
+        idxs, envs = np.divmod(flat - (ends - steps * self.num_envs)[shard], self.num_envs)
+        batches = [self._sample_shard(i, idxs=idxs[shard == i] + skip[i], envs=envs[shard == i], n_step=n_step, gamma=gamma)
+                   for i in np.unique(shard)]
+        return U.memories.SimpleMemory({k: self._cat([b[k] for b in batches]) for k in batches[0]})
+
+    def _sample_shard(self, i, idxs, envs, n_step, gamma):
+        o = self.shards[i]
+        return o._get_batch(idxs=o._ordered_idxs(idxs), envs=envs, n_step=n_step, gamma=gamma)
+
+    @staticmethod
+    def _cat(xs):
+        if isinstance(xs[0], list): return [np.concatenate(o) for o in zip(*xs)]
+        return np.concatenate(xs)
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+class StackedFrames:
+    """
+    Storage for states created by ``rw.tfm.img.Stack``, each frame is stored only once.
+
+    Indexing rebuilds the stacks with a single gather over precomputed offsets, returning
+    the same layout as ``np.array(LazyStack)``. Frames that belong to a previous episode (or
+    that were not written yet) are replaced by the first frame of the episode, the stack
+    ``Stack`` returns after a ``reset``. The oldest ``n - 1`` steps of a full ring lost their
+    first frames to newer ones, the buffer doesn't sample them (see ``ReplayBuffer.sample``).
+
+    Parameters
+    ----------
+        frames: np.array
+            Preallocated array with shape ``(maxlen, *frame_shape)``.
+        n: int
+            Number of stacked frames.
+        b: ReplayBuffer
+            Buffer that owns this storage, used for the episode boundaries.
+            Its ``ds`` has shape ``(maxlen, num_envs)``, matching ``frames``.
+    """
+    def __init__(self, frames, n, b):
+        self.frames, self.n, self.b = frames, n, b
+        self._offsets = np.arange(-(n - 1), 1)
+        # How many steps back each frame of the stack is
+        self._ages = -self._offsets
+
+    def __len__(self): return len(self.frames)
+
+    def __setitem__(self, idx, o): self.frames[idx] = np.asarray(o.img.arr[-1])
+
+    def __getitem__(self, key):
+        "Indexed by time steps ``idxs`` or by ``(idxs, envs)`` pairs."
+        idxs, envs = key if isinstance(key, tuple) else (key, None)
+        idxs = np.asarray(idxs)
+        scalar, idxs = idxs.ndim == 0, np.atleast_1d(idxs)
+        if envs is None:
+            # Each env has its own episodes, all of them are gathered as (idx, env) pairs
+            n_envs = self.frames.shape[1]
+            x = self[np.repeat(idxs, n_envs), np.tile(np.arange(n_envs), len(idxs))]
+            x = x.reshape((len(idxs), n_envs) + x.shape[1:])
+            return x[0] if scalar else x
+        envs = np.broadcast_to(envs, idxs.shape)[:, None]
+        pos = (idxs[:, None] + self._offsets) % len(self.frames)
+        # Frames before the start of the episode repeat its first frame
+        first = (~self._valid(idxs=idxs, pos=pos, envs=envs)).sum(axis=1, keepdims=True)
+        pos = np.take_along_axis(pos, np.maximum(np.arange(self.n)[None], first), axis=1)
+        # (bs, n, H, W, 1)
+        x = self.frames[pos, envs]
+        x = np.moveaxis(x[..., 0], 1, -1)
+        return x[0] if scalar else x
+
+    def _valid(self, idxs, pos, envs):
+        rel = (idxs - self.b.oldest) % len(self.frames)
+        valid = self._ages[None] <= rel[:, None]
+        # A frame is from a previous episode if any of the following frames (but the last) is done
+        ds = self.b.ds[pos[:, :-1], envs].astype(bool)
+        ended = np.logical_or.accumulate(ds[:, ::-1], axis=1)[:, ::-1]
+        return valid & np.concatenate([~ended, np.ones_like(ended[:, :1])], axis=1)
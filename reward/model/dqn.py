@@ -11,17 +11,19 @@ class DQN(Model):
         U.copy_weights(from_nn=self.qnn, to_nn=self.qnn_targ, weight=1.)
         U.global_step.subscribe_add(self._update_target_callback)
 
-    def train(self, *, ss, sns, acs, rs, ds):
+    def train(self, *, ss, sns, acs, rs, ds, gammas=None):
         # (#samples, #envs, #feats) -> (#samples + #envs, #feats)
         ss, sns, acs = [[o.reshape((-1, *o.shape[2:])) for o in l] for l in [ss, sns, acs]]
         rs, ds = [o.reshape((-1, *o.shape[2:]))[..., None] for o in [rs, ds]]
+        # Per sample discount of n-step returns
+        gamma = self.gamma if gammas is None else gammas.reshape((-1, *gammas.shape[2:]))[..., None]
         if not len(acs) == 1: raise RuntimeError('Multi action space not suported')
         ### DQN update ###
         qb, qnb_targ = self.qnn(*ss), self.qnn_targ(*sns)
         if self.double: qnb_targ = qnb_targ.gather(dim=1, index=qb.argmax(dim=1, keepdim=True))
         else:           qnb_targ = qnb_targ.max(dim=1, keepdim=True)[0]
         select_qb = qb.gather(dim=1, index=acs[0][:, None])
-        qtarg = U.estim.td_target(rs=rs, ds=ds, vn=qnb_targ, gamma=self.gamma).detach()
+        qtarg = U.estim.td_target(rs=rs, ds=ds, vn=qnb_targ, gamma=gamma).detach()
         loss = F.smooth_l1_loss(input=select_qb, target=qtarg)
         self.q_opt.optimize(loss=loss, nn=self.qnn)
         rw.logger.add_log('loss', loss, precision=4)
@@ -7,7 +7,7 @@ class Model(ABC):
         self.p, self.gamma = policy, gamma
 
     @abstractmethod
-    def train(self, *, ss, sns, acs, rs, ds): pass
+    def train(self, *, ss, sns, acs, rs, ds, gammas=None): pass
     # TODO: carefull with shapes, probably want (num_samples, num_envs, feats)
             
     def get_act(self, ss): return self.p.get_act(*U.listify(ss))
@@ -1,5 +1,5 @@
+import reward as rw, reward.utils as U
 from .model import Model
-import reward.utils as U
 
 
 class PG(Model):
@@ -18,10 +18,12 @@ class SAC(Model):
         self.save_nn_callback(nn=self.q1nn, opt=self.q1_opt, name='q1nn')
         self.save_nn_callback(nn=self.q2nn, opt=self.q2_opt, name='q2nn')
 
-    def train(self, *, ss, sns, acs, rs, ds):
+    def train(self, *, ss, sns, acs, rs, ds, gammas=None):
         # (#samples, #envs, #feats) -> (#samples + #envs, #feats)
         ss, sns, acs = [[o.reshape((-1, *o.shape[2:])) for o in l] for l in [ss, sns, acs]]
         rs, ds = [o.reshape((-1, *o.shape[2:]))[..., None] for o in [rs, ds]]
+        # Per sample discount of n-step returns
+        gamma = self.gamma if gammas is None else gammas.reshape((-1, *gammas.shape[2:]))[..., None]
         ### Sac update ###
         q1b, q2b = self.q1nn(*ss, *acs), self.q2nn(*ss, *acs)
         dist, distn = self.p.get_dist(*ss), self.p.get_dist(*sns)
@@ -33,7 +35,7 @@ class SAC(Model):
         # Q loss
         q1targn, q2targn = self.q1nn_targ(*sns, *anewn), self.q2nn_targ(*sns, *anewn)
         qtargn = torch.min(q1targn, q2targn) - self.temp.detach() * logprobn
-        q_tdtarg = U.estim.td_target(rs=rs, ds=ds, vn=qtargn, gamma=self.gamma)
+        q_tdtarg = U.estim.td_target(rs=rs, ds=ds, vn=qtargn, gamma=gamma)
         q1_loss = (q1b - q_tdtarg.detach()).pow(2).mean()
         q2_loss = (q2b - q_tdtarg.detach()).pow(2).mean()
         # Policy loss
@@ -1,7 +1,10 @@
 from .paac import PAAC
+from .thread_runner import ThreadRunner
+from .async_runner import AsyncRunner
 from .base_runner import BaseRunner
 from .single_runner import SingleRunner
 from .paac_runner import PAACRunner
 from .eval_runner import EvalRunner
+from .autotune import LayoutTuner
 
-__all__ = ["BaseRunner", "SingleRunner", "PAACRunner"]
+__all__ = ["BaseRunner", "SingleRunner", "PAACRunner", "ThreadRunner", "AsyncRunner", "LayoutTuner"]
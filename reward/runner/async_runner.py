@@ -0,0 +1,139 @@
+import time, asyncio
+import numpy as np
+import torch
+import reward as rw, reward.utils as U
+
+
+class AsyncRunner:
+    """
+    Drives envs with an async interface (e.g. adapters of simulators running in other processes
+    and reached through sockets) concurrently on an event loop, so the time of a step is the
+    time of the slowest env instead of the sum of all of them.
+
+    An env adapter implements ``async reset() -> s`` and ``async step(a) -> (s, r, d, info)``
+    and optionally ``async close()`` (see ``rw.env.LoopbackEnv``). Results are gathered into
+    preallocated arrays, ``reset``, ``step`` and ``close`` have the same interface as ``PAAC``
+    (``areset`` and ``astep`` can be awaited from a running event loop).
+
+    Parameters
+    ----------
+        env_fn: callable
+            Creates a single env adapter, also used to replace envs that timed out.
+        n_envs: int
+            Number of envs.
+        s_sp: Space
+            State space.
+        a_sp: Space
+            Action space.
+        timeout: float
+            Seconds each env has to answer a reset or a step, no limit if None.
+        on_timeout: str
+            ``'raise'`` a ``TimeoutError``, or ``'reset'`` the env: the adapter is closed and
+            replaced, its episode ends (done, zero reward) and its info has ``timeout=True``.
+            If only the reset after a finished episode times out, the step is reported as
+            received and the env is replaced before its next step. A replacement that times
+            out is replaced again on the next step, until then the env reports a zero state
+            and ends its episode at every step (with ``timeout=True``).
+        tfms: list
+            Transforms applied to the states.
+    """
+    def __init__(self, env_fn, n_envs, s_sp, a_sp, timeout=None, on_timeout='raise', tfms=None):
+        if on_timeout not in {'raise', 'reset'}: raise ValueError(f'on_timeout should be raise or reset, got {on_timeout}')
+        self.env_fn, self.n_envs, self.s_sp, self.tfms = env_fn, n_envs, s_sp, tfms
+        self.timeout, self.on_timeout = timeout, on_timeout
+        self.envs = [env_fn() for _ in range(n_envs)]
+        self.loop = asyncio.new_event_loop()
+        self.step_time, self.n_steps, self.n_timeouts = 0., 0, 0
+        self._ss = np.zeros((n_envs, *s_sp.shape), dtype=s_sp.dtype)
+        self._rs, self._ds = np.zeros(n_envs, dtype=np.float32), np.zeros(n_envs, dtype=np.int32)
+        self._infos = [{} for _ in range(n_envs)]
+        # Envs whose reset after the end of an episode timed out, replaced before their next step
+        self._pending = set()
+        rw.logger.subscribe_log(self._write_logs)
+
+    def reset(self): return self.loop.run_until_complete(self.areset())
+
+    def step(self, act): return self.loop.run_until_complete(self.astep(act))
+
+    async def areset(self):
+        await asyncio.gather(*[self._reset(i) for i in range(self.n_envs)])
+        return torch.from_numpy(self._ss.copy())
+
+    async def astep(self, act):
+        start, a = time.perf_counter(), U.to_np(act)
+        await asyncio.gather(*[self._step(i, a[i]) for i in range(self.n_envs)])
+        self.step_time, self.n_steps = self.step_time + time.perf_counter() - start, self.n_steps + 1
+        return torch.from_numpy(self._ss.copy()), torch.from_numpy(self._rs.copy()), torch.from_numpy(self._ds.copy()), list(self._infos)
+
+    def close(self):
+        rw.logger.unsubscribe_log(self._write_logs)
+        self.loop.run_until_complete(self._close_all())
+        self.loop.close()
+
+    def stats(self):
+        "Mean step time (in ms) and number of timeouts since the last call."
+        stats = dict(step_ms=1e3 * self.step_time / max(self.n_steps, 1), timeouts=self.n_timeouts)
+        self.step_time, self.n_steps, self.n_timeouts = 0., 0, 0
+        return stats
+
+    def _write_logs(self):
+        if self.n_steps == 0: return
+        for k, v in self.stats().items(): rw.logger.add_log(f'async_runner/{k}', v, precision=3, hidden=True)
+
+    async def _reset(self, i):
+        if i in self._pending: s = await self._replace(i)
+        else:
+            try: s = await asyncio.wait_for(self.envs[i].reset(), self.timeout)
+            except asyncio.TimeoutError: s = await self._timed_out(i, 'reset')
+        if s is None: return self._write(i, s=self._blank(), r=0., d=False, info=dict(timeout=True))
+        self._write(i, s=s, r=0., d=False, info={})
+
+    async def _step(self, i, a):
+        if i in self._pending:
+            # The action was chosen on the last state of the previous episode, it starts the new one
+            if await self._replace(i) is None: return self._write(i, s=self._blank(), r=0., d=True, info=dict(timeout=True))
+        try: s, r, d, info = await asyncio.wait_for(self.envs[i].step(a), self.timeout)
+        except asyncio.TimeoutError:
+            s, r, d, info = await self._timed_out(i, 'step'), 0., True, dict(timeout=True)
+            if s is None: s = self._blank()
+        else:
+            if d:
+                try: s = await asyncio.wait_for(self.envs[i].reset(), self.timeout)
+                except asyncio.TimeoutError:
+                    # The step itself is valid, keep its reward and replace the env later
+                    self._count_timeout(i, 'reset')
+                    self._pending.add(i)
+                    info = dict(info, timeout=True)
+        self._write(i, s=s, r=r, d=d, info=info)
+
+    async def _timed_out(self, i, name):
+        "Replaces the env ``i``, returns its first state (None if the new env timed out too)."
+        self._count_timeout(i, name)
+        return await self._replace(i)
+
+    def _count_timeout(self, i, name):
+        self.n_timeouts += 1
+        if self.on_timeout == 'raise': raise TimeoutError(f'Env {i} took more than {self.timeout}s to {name}')
+
+    async def _replace(self, i):
+        self._pending.discard(i)
+        # The adapter may be waiting for an answer that will never be read, start over with a new one
+        await self._close(self.envs[i])
+        self.envs[i] = self.env_fn()
+        try: return await asyncio.wait_for(self.envs[i].reset(), self.timeout)
+        except asyncio.TimeoutError:
+            # Tried again on the next reset or step, until then its episodes end right away
+            self.n_timeouts += 1
+            self._pending.add(i)
+
+    def _blank(self): return np.zeros(self.s_sp.shape, dtype=self.s_sp.dtype)
+
+    def _write(self, i, s, r, d, info):
+        self._ss[i] = np.array(self.s_sp(np.asarray(s)[None]).apply_tfms(self.tfms))[0]
+        self._rs[i], self._ds[i], self._infos[i] = r, d, info
+
+    async def _close_all(self): await asyncio.gather(*[self._close(env) for env in self.envs])
+
+    @staticmethod
+    async def _close(env):
+        if hasattr(env, 'close'): await env.close()
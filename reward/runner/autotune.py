@@ -0,0 +1,112 @@
+import time
+import numpy as np
+import torch.multiprocessing as mp
+from collections import namedtuple
+from .paac import PAAC
+from .thread_runner import ThreadRunner
+from .paac_runner import PAACRunner
+
+Layout = namedtuple('Layout', 'n_workers n_envs steps_s step_ms')
+
+
+class LayoutTuner:
+    """
+    Finds the ``(n_workers, n_envs)`` layout of a runner with the highest throughput by running
+    a short rollout with each candidate layout.
+
+    ``runner`` can be ``PAAC``, ``ThreadRunner`` (``n_workers`` is its ``n_threads``) or
+    ``PAACRunner`` (created with a list of ``n_envs`` envs from ``env_fn`` and ``num_workers``).
+
+    Examples
+    --------
+        tuner = LayoutTuner(env_fn, s_sp=S, a_sp=A, max_step_ms=5.)
+        tuner.run()
+        print(tuner.summary())
+        runner = tuner.build()
+
+    Parameters
+    ----------
+        env_fn: callable
+            Creates a single env.
+        s_sp: Space
+            State space.
+        a_sp: Space
+            Action space.
+        layouts: list of tuple
+            Candidate ``(n_workers, n_envs)`` layouts. By default powers of 2 workers up to the
+            number of cpus with 1, 2 and 4 envs per worker (or ``n_envs`` envs if given).
+        n_envs: int
+            Only consider layouts with this number of envs.
+        steps: int
+            Steps measured for each layout (after ``warmup`` steps).
+        warmup: int
+            Steps run before measuring.
+        max_step_ms: float
+            Ignore layouts with a mean step latency higher than this.
+        act_fn: callable
+            Receives ``n_envs`` and returns the actions of a step, zero actions by default.
+        runner: type
+            Runner class, ``PAAC``, ``ThreadRunner``, ``PAACRunner`` or a subclass of them.
+        runner_kw:
+            Passed to ``runner`` (e.g. ``sync`` or ``tfms``).
+    """
+    def __init__(self, env_fn, s_sp, a_sp, layouts=None, n_envs=None, steps=100, warmup=10, max_step_ms=None, act_fn=None, runner=PAAC, **runner_kw):
+        if not issubclass(runner, (PAAC, ThreadRunner, PAACRunner)): raise ValueError(f'Layouts of {runner.__name__} are not supported')
+        self.env_fn, self.s_sp, self.a_sp, self.runner, self.runner_kw = env_fn, s_sp, a_sp, runner, runner_kw
+        self.steps, self.warmup, self.max_step_ms = steps, warmup, max_step_ms
+        self.act_fn = act_fn or (lambda n: np.zeros((n, *a_sp.shape), dtype=a_sp.dtype))
+        self.layouts = layouts or self._default_layouts(n_envs)
+        if n_envs is not None: self.layouts = [o for o in self.layouts if o[1] == n_envs]
+        if not self.layouts: raise ValueError('No candidate layouts')
+        self.results = []
+
+    @staticmethod
+    def _default_layouts(n_envs):
+        workers = [2 ** i for i in range(int(np.log2(mp.cpu_count())) + 1)]
+        if n_envs is not None: return [(w, n_envs) for w in workers if n_envs % w == 0]
+        return [(w, w * k) for w in workers for k in [1, 2, 4]]
+
+    def run(self):
+        "Measures every layout, returns the results sorted by throughput."
+        self.results = sorted([self._measure(*o) for o in self.layouts], key=lambda o: o.steps_s, reverse=True)
+        return self.results
+
+    @property
+    def best(self):
+        if not self.results: self.run()
+        ok = [o for o in self.results if self.max_step_ms is None or o.step_ms <= self.max_step_ms]
+        if not ok: raise ValueError(f'No layout has a step latency below {self.max_step_ms}ms')
+        return ok[0]
+
+    def build(self, **kwargs):
+        "Creates a runner with the best layout."
+        return self._create(n_workers=self.best.n_workers, n_envs=self.best.n_envs, **kwargs)
+
+    def summary(self):
+        best = self.best
+        lines = [f'{"n_workers":>9} {"n_envs":>6} {"steps/s":>10} {"step_ms":>8}']
+        for o in self.results:
+            mark = ' <- best' if o is best else ''
+            lines.append(f'{o.n_workers:>9} {o.n_envs:>6} {o.steps_s:>10.1f} {o.step_ms:>8.3f}{mark}')
+        return '\n'.join(lines)
+
+    def _measure(self, n_workers, n_envs):
+        runner = self._create(n_workers=n_workers, n_envs=n_envs)
+        step = runner.act if isinstance(runner, PAACRunner) else runner.step
+        try:
+            runner.reset()
+            a = self.act_fn(n_envs)
+            for _ in range(self.warmup): step(a)
+            start = time.perf_counter()
+            for _ in range(self.steps): step(a)
+            elapsed = time.perf_counter() - start
+            # Calibration steps shouldn't show up in the logs
+            if hasattr(runner, 'stats'): runner.stats()
+        finally: runner.close()
+        return Layout(n_workers=n_workers, n_envs=n_envs, steps_s=self.steps * n_envs / elapsed, step_ms=1e3 * elapsed / self.steps)
+
+    def _create(self, n_workers, n_envs, **kwargs):
+        kwargs = {**self.runner_kw, **kwargs}
+        if issubclass(self.runner, PAACRunner): return self.runner([self.env_fn() for _ in range(n_envs)], num_workers=n_workers, **kwargs)
+        workers = dict(n_threads=n_workers) if issubclass(self.runner, ThreadRunner) else dict(n_workers=n_workers)
+        return self.runner(self.env_fn, n_envs=n_envs, s_sp=self.s_sp, a_sp=self.a_sp, **workers, **kwargs)
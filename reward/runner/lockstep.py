@@ -0,0 +1,105 @@
+import os
+import torch
+import torch.multiprocessing as mp
+
+STEP, RESET, CLOSE = 1, 2, 3
+
+
+class Lockstep:
+    """
+    Lockstep protocol between a master and its workers through shared memory, without
+    pickling or going through pipes on every step.
+
+    For each step the master writes a command for every worker and bumps their sequence
+    numbers, each worker waits for a new sequence number, runs the command on its slice
+    of envs and acknowledges the sequence (together with the time it spent working).
+    The master waits until all workers (or a group of them) acknowledged.
+
+    Parameters
+    ----------
+        n_workers: int
+            Number of workers.
+        wait: str
+            ``'spin'`` busy waits on the shared flags, the lowest latency but each waiting
+            process keeps a core busy. ``'futex'`` blocks on semaphores (futex based on Linux),
+            slightly slower wake ups but idle processes don't use any cpu.
+        spins: int
+            Iterations a ``'spin'`` wait busy loops before yielding the cpu on each iteration,
+            so spinning doesn't starve the other processes when there are more processes than cores.
+    """
+    def __init__(self, n_workers, wait='spin', spins=1000):
+        if wait not in {'spin', 'futex'}: raise ValueError(f'wait should be spin or futex, got {wait}')
+        self.n_workers, self.wait, self.spins = n_workers, wait, spins
+        self._tensors = dict(cmds=torch.zeros(n_workers, dtype=torch.int64), seqs=torch.zeros(n_workers, dtype=torch.int64),
+                             acks=torch.zeros(n_workers, dtype=torch.int64), work=torch.zeros(n_workers, dtype=torch.float64))
+        for t in self._tensors.values(): t.share_memory_()
+        self._wake = [mp.Semaphore(0) for _ in range(n_workers)] if wait == 'futex' else None
+        self._done = mp.Semaphore(0) if wait == 'futex' else None
+        self._create_views()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in self._tensors: state.pop(k)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._create_views()
+
+    def _create_views(self):
+        for k, t in self._tensors.items(): setattr(self, k, t.numpy())
+
+    # Master side
+    def send(self, cmd, workers=None):
+        "Sends ``cmd`` to ``workers`` (all by default)."
+        workers = range(self.n_workers) if workers is None else workers
+        for i in workers:
+            self.cmds[i] = cmd
+            # Written after the command, a worker only reads the command after seeing the new sequence
+            self.seqs[i] += 1
+            if self._wake is not None: self._wake[i].release()
+
+    def ready(self, workers=None):
+        "If ``workers`` (all by default) acknowledged their last command."
+        workers = slice(None) if workers is None else workers
+        return bool((self.acks[workers] == self.seqs[workers]).all())
+
+    def join(self, workers=None):
+        "Waits for ``workers`` (all by default) to acknowledge their last command."
+        self.wait_any([slice(None) if workers is None else workers])
+
+    def wait_any(self, groups):
+        "Waits until all workers of one of ``groups`` acknowledged their last command, returns its position."
+        return self.wait_k(groups, k=1)[0]
+
+    def wait_k(self, groups, k):
+        "Waits until ``k`` of ``groups`` are done (all their workers acknowledged), returns the positions of the first ``k`` done ones."
+        done = lambda: [i for i, g in enumerate(groups) if self.ready(g)]
+        if self._done is None:
+            self._spin(lambda: len(done()) >= k)
+            return done()[:k]
+        # Each ack releases the semaphore once after writing its sequence, so waking up on
+        # any ack and checking the sequences again never misses the one we are waiting for
+        while len(done()) < k: self._done.acquire()
+        # Releases of acks already seen are stale, drain them
+        while self._done.acquire(block=False): pass
+        return done()[:k]
+
+    # Worker side
+    def recv(self, i, last):
+        "Waits for a command newer than ``last``, returns the command and its sequence number."
+        if self._wake is not None: self._wake[i].acquire()
+        else: self._spin(lambda: self.seqs[i] != last)
+        return int(self.cmds[i]), int(self.seqs[i])
+
+    def ack(self, i, seq, work):
+        self.work[i] = work
+        self.acks[i] = seq
+        if self._done is not None: self._done.release()
+
+
+    def _spin(self, cond):
+        n = 0
+        while not cond():
+            n += 1
+            if n > self.spins: os.sched_yield()
@@ -1,72 +1,344 @@
-import warnings
+import os, time, warnings
 import numpy as np
 import torch
 import torch.multiprocessing as mp
-import reward.utils as U
+import reward as rw, reward.utils as U
 from collections import namedtuple
+from .lockstep import Lockstep, STEP, RESET, CLOSE
+from .placement import Placement
+from .timings import StepTimings
 
 
-def run(env_fn, n_envs, ss, acs, rs, ds, inq, outq, s_sp, tfms):
-    envs = [env_fn() for _ in range(n_envs)]
+def _env_step(env, a): return env.step(a)
+def _env_reset(env): return env.reset()
+
+def _reset(envs, ss, s_sp, tfms, timer=None):
+    reset = _env_reset if timer is None else timer.reset
+    for i, env in enumerate(envs):
+        s = np.array(s_sp(reset(env)[None]).apply_tfms(tfms))
+        ss[i] = torch.as_tensor(s, dtype=ss.dtype)[0]
+
+def _step(envs, ss, acs, rs, ds, s_sp, tfms, timer=None):
+    step, reset = (_env_step, _env_reset) if timer is None else (timer.step, timer.reset)
+    a = acs.numpy()
+    for i, env in enumerate(envs):
+        # TODO: Squeeze may cause problems
+        s, r, d, _ = step(env, a[i].squeeze())
+        if d: s = reset(env)
+        s = np.array(s_sp(s[None]).apply_tfms(tfms))
+        ss[i] = torch.as_tensor(s, dtype=ss.dtype)[0]
+        rs[i] = torch.as_tensor(r, dtype=rs.dtype)
+        ds[i] = torch.as_tensor(d, dtype=ds.dtype)
+
+def _place(i, placement, report, ts):
+    if placement is None: return
+    placement.apply_worker(i)
+    # First touch of the slices, their pages are allocated on the node of the worker
+    if placement.numa:
+        for t in ts: t.zero_()
+    placement.report(report[i].numpy())
+
+def run(env_fn, n_envs, ss, acs, rs, ds, inq, outq, s_sp, tfms, i=0, placement=None, report=None, timings=None):
+    _place(i, placement=placement, report=report, ts=[ss, acs, rs, ds])
+    envs, timer = [env_fn() for _ in range(n_envs)], timings and timings.worker(i)
     while True:
         signal = inq.get()
-        a = acs.numpy()
-        for i, env in enumerate(envs):
-            if signal is None:
-                s = np.array(s_sp(env.reset()[None]).apply_tfms(tfms))
-                ss[i] = torch.as_tensor(s, dtype=ss.dtype)[0]
-            else:
-                # TODO: Squeeze may cause problems
-                s, r, d, _ = env.step(a[i].squeeze())
-                if d: s = env.reset()
-                s = np.array(s_sp(s[None]).apply_tfms(tfms))
-                ss[i] = torch.as_tensor(s, dtype=ss.dtype)[0]
-                rs[i] = torch.as_tensor(r, dtype=rs.dtype)
-                ds[i] = torch.as_tensor(d, dtype=ds.dtype)
-        outq.put(None)
+        start = time.perf_counter()
+        if signal is None: _reset(envs, ss=ss, s_sp=s_sp, tfms=tfms, timer=timer)
+        else:              _step(envs, ss=ss, acs=acs, rs=rs, ds=ds, s_sp=s_sp, tfms=tfms, timer=timer)
+        outq.put(time.perf_counter() - start)
+
+def run_lockstep(env_fn, n_envs, ss, acs, rs, ds, sync, i, s_sp, tfms, placement=None, report=None, timings=None):
+    _place(i, placement=placement, report=report, ts=[ss, acs, rs, ds])
+    envs, seq, timer = [env_fn() for _ in range(n_envs)], 0, timings and timings.worker(i)
+    while True:
+        cmd, seq = sync.recv(i, seq)
+        start = time.perf_counter()
+        if cmd == RESET:  _reset(envs, ss=ss, s_sp=s_sp, tfms=tfms, timer=timer)
+        elif cmd == STEP: _step(envs, ss=ss, acs=acs, rs=rs, ds=ds, s_sp=s_sp, tfms=tfms, timer=timer)
+        sync.ack(i, seq, time.perf_counter() - start)
+        if cmd == CLOSE: break
 
 
 class PAAC:
-    def __init__(self, env_fn, n_envs, s_sp, a_sp, n_workers=None, tfms=None):
+    """
+    Steps ``n_envs`` envs split over ``n_workers`` processes, states, actions, rewards and
+    dones are exchanged through shared tensors.
+
+    Parameters
+    ----------
+        env_fn: callable
+            Creates a single env, called inside each worker.
+        n_envs: int
+            Total number of envs.
+        s_sp: Space
+            State space.
+        a_sp: Space
+            Action space.
+        n_workers: int
+            Number of worker processes, defaults to the number of cpus.
+        tfms: list
+            Transforms applied to the states by the workers.
+        sync: str
+            How the workers are synchronized each step. ``'queue'`` uses a pair of queues per worker,
+            ``'spin'`` and ``'futex'`` use a shared memory lockstep protocol (see ``Lockstep``),
+            the workers busy wait with ``'spin'`` (lowest latency, keeps one core per worker busy)
+            and block on semaphores with ``'futex'``.
+        groups: int
+            Number of groups the workers are split in for asynchronous stepping, each group is
+            stepped independently with ``send`` and collected with ``recv``. With 2 groups one of
+            them is stepped while the actions of the other are computed (double buffering).
+            With a group per worker and ``recv(k)`` each call returns the first ``k`` slices
+            of envs to finish, slow envs don't hold back the others.
+            Needs the lockstep protocol (``sync`` spin or futex).
+        placement: Placement
+            Pins the workers (and the learner) to cpus, see ``Placement``. The placement of
+            each worker is logged after the first reset.
+        profile: bool
+            Record the duration of every env step and reset in each worker (see ``StepTimings``),
+            the p50/p99 step and reset times, the resets per step and the time waiting for the
+            slowest worker of each worker are logged (and returned by ``worker_stats``).
+
+    Examples
+    --------
+    Asynchronous stepping, the agent receives the env indexes of each group::
+
+        runner = PAAC(env_fn, n_envs=16, n_workers=8, s_sp=S, a_sp=A, sync='futex', groups=2)
+        runner.async_reset()
+        while True:
+            s, r, d, _, idxs = runner.recv()
+            agent.report(r=np.array(r), d=np.array(d), idxs=idxs)  # Skipped after the reset
+            runner.send(agent.get_act(S(s), idxs=idxs)[0].arr, idxs=idxs)
+
+    Partial stepping, each call acts on the first 4 (of 8) slices of envs to finish::
+
+        runner = PAAC(env_fn, n_envs=16, n_workers=8, s_sp=S, a_sp=A, sync='futex', groups=8)
+        runner.async_reset()
+        while True:
+            s, r, d, _, idxs = runner.recv(k=4, max_lag=8)
+            ...
+    """
+    def __init__(self, env_fn, n_envs, s_sp, a_sp, n_workers=None, tfms=None, sync='queue', groups=1, placement=None, profile=False):
         # TODO: Verify implemenatation, works with images? dtype with images, torch support uint8? Dont work with multiple spaces
         warnings.warn('Not tested with images')
+        if sync not in {'queue', 'spin', 'futex'}: raise ValueError(f'sync should be one of queue, spin or futex, got {sync}')
         self.n_workers = n_workers or mp.cpu_count()
-        if not n_envs % n_workers == 0 and n_envs > n_workers: raise ValueError('n_envs should be divisible by n_workers')
-        self.env_fn,self.n_envs=env_fn,n_envs
+        if not n_envs % self.n_workers == 0 and n_envs > self.n_workers: raise ValueError('n_envs should be divisible by n_workers')
+        if groups > 1 and sync == 'queue': raise ValueError('Asynchronous groups need the lockstep protocol, use sync spin or futex')
+        if groups > self.n_workers: raise ValueError(f'Cannot split {self.n_workers} workers in {groups} groups')
+        self.env_fn,self.n_envs,self.sync,self.n_groups,self.placement=env_fn,n_envs,sync,groups,placement
+        self.step_time, self.sync_time, self.n_steps = 0., 0., 0
+        self.timings = StepTimings(self.n_workers) if profile else None
+        self._barrier_wait, self._worker_wait, self._worker_steps = 0., np.zeros(self.n_workers), 0
         self._create_shared(s_sp=s_sp, a_sp=a_sp)
+        self._create_placement()
         self._create_workers(s_sp=s_sp, tfms=tfms)
+        if placement is not None: placement.apply_learner()
+        self._create_groups()
+        rw.logger.subscribe_log(self._write_logs)
 
     def reset(self):
-        for w in self._workers: w.send.put(None)
+        self._check_sync()
+        self._send(RESET)
         self._sync()
+        self._log_placement()
         return self._ss.clone()
 
     def step(self, act):
+        self._check_sync()
+        start = time.perf_counter()
         self._acs.copy_(torch.as_tensor(act))
-        for w in self._workers: w.send.put(True)
-        self._sync()
+        self._send(STEP)
+        sync_start = time.perf_counter()
+        work = self._sync()
+        end = time.perf_counter()
+        step_time = end - start
+        # Time not spent by the slowest worker stepping its envs
+        self.step_time, self.sync_time = self.step_time + step_time, self.sync_time + max(step_time - max(work), 0.)
+        self.n_steps += 1
+        if self.timings is not None:
+            # Each worker waits for the slowest one before the next step
+            self._worker_wait += np.max(work) - np.asarray(work)
+            self._barrier_wait, self._worker_steps = self._barrier_wait + end - sync_start, self._worker_steps + 1
         return self._ss.clone(), self._rs.clone(), self._ds.clone(), {}
 
+    def async_reset(self):
+        "Resets all envs without waiting, the states are returned by ``recv`` (one group at a time, with zero rewards and dones)."
+        for g in range(self.n_groups):
+            self._check_idle(g)
+            self._rs[self._gslices[g]], self._ds[self._gslices[g]] = 0, 0
+            self._send_group(g, RESET)
+        self._gsteps[:] = 0
+
+    def send(self, act, idxs):
+        "Starts stepping the groups of envs ``idxs`` (as returned by ``recv``) with ``act``, without waiting."
+        gs = self._groups_of(idxs)
+        for g in gs: self._check_idle(g)
+        act, start = torch.as_tensor(act), 0
+        for g in gs:
+            n = len(self.group_idxs[g])
+            self._acs[self._gslices[g]].copy_(act[start:start + n])
+            self._send_group(g, STEP)
+            self._gsteps[g], start = self._gsteps[g] + 1, start + n
+
+    def recv(self, k=1, max_lag=None):
+        """
+        Waits until ``k`` running groups of envs finished, returns ``s, r, d, info, idxs`` of
+        these groups (ordered by env). When more groups are done the ones with fewer steps are
+        returned, the others are returned by a later call.
+
+        Parameters
+        ----------
+            k: int
+                Number of groups to wait for (at most the number of running groups).
+            max_lag: int
+                Groups more than ``max_lag`` steps ahead of the slowest group are held back
+                until it catches up, bounding how far apart envs can drift.
+        """
+        running = np.flatnonzero(self._running)
+        if len(running) == 0: raise RuntimeError('No envs are running, call send or async_reset first')
+        if max_lag is not None: running = running[self._gsteps[running] - self._gsteps.min() <= max_lag]
+        # Groups that are behind go first when more than k are done
+        running = running[np.argsort(self._gsteps[running], kind='stable')]
+        if len(running) == 0: raise RuntimeError(f'All running envs are more than {max_lag} steps ahead, send the actions of the slowest ones first')
+        start = time.perf_counter()
+        gs = running[self._lockstep.wait_k([self._gworkers[g] for g in running], k=min(k, len(running)))]
+        # Time the agent waits for envs, the synchronization cost is not separable from the stepping here
+        self.step_time, self.n_steps = self.step_time + time.perf_counter() - start, self.n_steps + 1
+        gs = np.sort(gs)
+        self._running[gs] = False
+        self._log_placement()
+        if len(gs) == 1:
+            sl = self._gslices[gs[0]]
+            return self._ss[sl].clone(), self._rs[sl].clone(), self._ds[sl].clone(), {}, self.group_idxs[gs[0]]
+        cat = lambda t: torch.cat([t[self._gslices[g]] for g in gs])
+        return cat(self._ss), cat(self._rs), cat(self._ds), {}, np.concatenate([self.group_idxs[g] for g in gs])
+
     def close(self):
+        rw.logger.unsubscribe_log(self._write_logs)
+        if self._lockstep is not None:
+            self._lockstep.send(CLOSE)
+            for w in self._workers: w.p.join(timeout=1.)
         for w in self._workers: w.p.terminate()
 
+    def stats(self):
+        "Mean step time and synchronization overhead per step (in ms) since the last call."
+        n = max(self.n_steps, 1)
+        stats = dict(step_ms=1e3 * self.step_time / n, sync_overhead_ms=1e3 * self.sync_time / n)
+        self.step_time, self.sync_time, self.n_steps = 0., 0., 0
+        return stats
+
+    def worker_stats(self):
+        """
+        Statistics of each worker since the last call (needs ``profile``): p50/p99 of the env
+        step and reset durations (ms, upper edge of the histogram bin), resets per env step
+        and mean time waiting for the slowest worker each step (ms). Also the mean time the
+        master waits for the workers each step (``barrier_wait_ms``).
+        """
+        if self.timings is None: raise RuntimeError('Worker statistics need profile=True')
+        h, n = self.timings.read(), max(self._worker_steps, 1)
+        n_steps = h['steps'].sum(-1)
+        stats = dict(step_p50_ms=1e3 * self.timings.percentile(h['steps'], 50), step_p99_ms=1e3 * self.timings.percentile(h['steps'], 99),
+                     reset_p50_ms=1e3 * self.timings.percentile(h['resets'], 50), reset_p99_ms=1e3 * self.timings.percentile(h['resets'], 99),
+                     resets_per_step=h['resets'].sum(-1) / np.maximum(n_steps, 1), wait_ms=1e3 * self._worker_wait / n)
+        stats = [{k: v[i] for k, v in stats.items()} for i in range(self.n_workers)]
+        barrier_wait = 1e3 * self._barrier_wait / n
+        self._barrier_wait, self._worker_wait, self._worker_steps = 0., np.zeros(self.n_workers), 0
+        return stats, barrier_wait
+
+    def _write_logs(self):
+        if self.n_steps == 0: return
+        for k, v in self.stats().items(): rw.logger.add_log(f'paac/{k}', v, precision=3, hidden=True)
+        if self.timings is None: return
+        stats, barrier_wait = self.worker_stats()
+        rw.logger.add_log('paac/barrier_wait_ms', barrier_wait, precision=3, hidden=True)
+        for i, o in enumerate(stats):
+            for k, v in o.items():
+                if not np.isnan(v): rw.logger.add_log(f'paac/worker_{i}/{k}', v, precision=3, hidden=True)
+
+    def _check_sync(self):
+        if self._running.any(): raise RuntimeError('Some envs are still running asynchronously, call recv first')
+
+    def _log_placement(self):
+        "Logs the cpus of the workers that started since the last call."
+        if self.placement is None: return
+        for i, mask in enumerate(self._placement_report.numpy()):
+            if self._placement_logged[i] or not mask.any(): continue
+            cpus = np.flatnonzero(mask)
+            rw.logger.add_header(f'Worker {i}', self.placement.describe(mask))
+            rw.logger.add_log(f'paac/worker_{i}/n_cpus', len(cpus), hidden=True, force=True)
+            rw.logger.add_log(f'paac/worker_{i}/numa_node', self.placement.node_of(cpus[0]), hidden=True, force=True)
+            self._placement_logged[i] = True
+
+    def _send(self, cmd):
+        if self._lockstep is not None: self._lockstep.send(cmd)
+        else:
+            for w in self._workers: w.send.put(None if cmd == RESET else True)
+
+    def _send_group(self, g, cmd):
+        self._running[g] = True
+        self._lockstep.send(cmd, workers=self._gworkers[g])
+
+    def _check_idle(self, g):
+        if self._lockstep is None: raise RuntimeError('Asynchronous stepping needs the lockstep protocol, use sync spin or futex')
+        if self._running[g]: raise RuntimeError(f'Envs {self.group_idxs[g]} are still running, call recv first')
+
+    def _groups_of(self, idxs):
+        idxs = np.asarray(idxs)
+        gs = np.unique(np.searchsorted(self._gstarts, idxs, side='right') - 1)
+        if not np.array_equal(idxs, np.concatenate([self.group_idxs[g] for g in gs])):
+            raise ValueError(f'idxs should be whole groups in order, as returned by recv, got {idxs}')
+        return gs
+
+    def _create_groups(self):
+        # Consecutive workers are grouped, so each group owns a contiguous slice of envs
+        self._gworkers = np.array_split(np.arange(self.n_workers), self.n_groups)
+        bounds = np.cumsum([0] + [len(o) for o in self._split(self._ss)[0]])
+        self._gslices = [slice(bounds[w[0]], bounds[w[-1] + 1]) for w in self._gworkers]
+        self._gstarts = np.array([o.start for o in self._gslices])
+        self.group_idxs = [np.arange(o.start, o.stop) for o in self._gslices]
+        self._running = np.zeros(self.n_groups, dtype=bool)
+        # Steps sent to each group since the last reset
+        self._gsteps = np.zeros(self.n_groups, dtype=np.int64)
+
     def _sync(self):
-        for w in self._workers: w.recv.get()
+        "Waits for all workers, returns the time each one spent working."
+        if self._lockstep is None: return [w.recv.get() for w in self._workers]
+        self._lockstep.join()
+        return self._lockstep.work.copy()
 
     def _create_shared(self, s_sp, a_sp):
         n_envs = (self.n_envs,)
+        if self.placement is not None and self.placement.numa:
+            # Pages are allocated when first written by the workers
+            self._ss = Placement.empty_shared(n_envs+tuple(s_sp.shape), dtype=s_sp.dtype)
+            self._acs = Placement.empty_shared(n_envs+tuple(a_sp.shape), dtype=a_sp.dtype)
+            self._rs, self._ds = Placement.empty_shared(n_envs, dtype=np.float32), Placement.empty_shared(n_envs, dtype=np.int32)
+            return
         self._ss = torch.as_tensor(np.zeros(n_envs+tuple(s_sp.shape), dtype=s_sp.dtype))
         self._acs = torch.as_tensor(np.zeros(n_envs+tuple(a_sp.shape), dtype=a_sp.dtype))
         self._rs = torch.zeros(n_envs, dtype=torch.float)
         self._ds = torch.zeros(n_envs, dtype=torch.int)
         for t in [self._ss, self._acs, self._rs, self._ds]: t.share_memory_()
 
+    def _create_placement(self):
+        if self.placement is not None: self.placement.assign(self.n_workers)
+        # Cpus each worker runs on, written by the workers once started
+        self._placement_report = torch.zeros((self.n_workers, os.cpu_count()), dtype=torch.bool).share_memory_()
+        self._placement_logged = np.zeros(self.n_workers, dtype=bool)
+
     def _create_workers(self, s_sp, tfms):
         Worker = namedtuple('Worker', 'p send recv')
         self._workers = []
-        for ss, acs, rs, ds in zip(*self._split(self._ss, self._acs, self._rs, self._ds)):
-            sendq, recvq = mp.Queue(), mp.Queue()
-            p = mp.Process(target=run, args=(self.env_fn, self.n_envs//self.n_workers, ss, acs, rs, ds, sendq, recvq, s_sp, tfms))
+        self._lockstep = Lockstep(self.n_workers, wait=self.sync) if self.sync != 'queue' else None
+        for i, (ss, acs, rs, ds) in enumerate(zip(*self._split(self._ss, self._acs, self._rs, self._ds))):
+            n_envs = len(ss)
+            if self._lockstep is not None:
+                sendq = recvq = None
+                p = mp.Process(target=run_lockstep, args=(self.env_fn, n_envs, ss, acs, rs, ds, self._lockstep, i, s_sp, tfms, self.placement, self._placement_report, self.timings))
+            else:
+                sendq, recvq = mp.Queue(), mp.Queue()
+                p = mp.Process(target=run, args=(self.env_fn, n_envs, ss, acs, rs, ds, sendq, recvq, s_sp, tfms, i, self.placement, self._placement_report, self.timings))
             p.daemon = True
             p.start()
             self._workers.append(Worker(p=p, send=sendq, recv=recvq))
@@ -75,8 +347,3 @@ class PAAC:
         # TODO: Asserting divisible, can simplify
         q, r = divmod(self.n_envs, self.n_workers)
         return [[t[i*q+min(i, r):(i+1)*q+min(i+1, r)] for i in range(self.n_workers)] for t in ts]
-
-
-
-
-
@@ -1,6 +1,8 @@
 import multiprocessing
+import os
+import time
 from collections import namedtuple
-from ctypes import c_double, c_float, c_int, c_uint8
+from ctypes import c_bool, c_double, c_float, c_int, c_int64, c_uint8
 
 # from torch.multiprocessing import Manager, Pipe, Process, Queue
 from multiprocessing import Manager, Pipe, Process, Queue
@@ -8,8 +10,11 @@ from multiprocessing.sharedctypes import RawArray
 
 import numpy as np
 
+import reward as rw
 import reward.utils as U
 from reward.runner import BaseRunner
+from reward.runner.lockstep import Lockstep, STEP, RESET, CLOSE
+from reward.runner.placement import Placement
 from boltons.cacheutils import cachedproperty
 
 
@@ -19,18 +24,68 @@ class PAACRunner(BaseRunner):
         np.float64: c_double,
         np.uint8: c_uint8,
         np.int32: c_int,
-        np.int64: c_int,
+        np.int64: c_int64,
+        np.bool_: c_bool,
     }
 
-    def __init__(self, env, ep_maxlen=None, num_workers=None):
+    def __init__(
+        self,
+        env,
+        ep_maxlen=None,
+        num_workers=None,
+        sync="pipe",
+        info_schema=None,
+        extra_info="drop",
+        placement=None,
+    ):
+        """
+        Parameters
+        ----------
+        env: list
+            List of env, split between the workers.
+        ep_maxlen: int
+            Maximum length of an episode.
+        num_workers: int
+            Number of worker processes, defaults to the number of cpus.
+        sync: str
+            ``"pipe"`` drives the workers with a queue and a pipe each, ``"spin"`` and
+            ``"futex"`` with a shared memory ``Lockstep``.
+        info_schema: dict
+            Example value of each info key (numeric scalar or array), e.g.
+            ``dict(lives=0, pos=np.zeros(3))``. Info values are stored in shared arrays with
+            the same shape and dtype. If None, info dicts go through a ``Manager`` (slow).
+        extra_info: str
+            What to do with info keys not in ``info_schema``, ``"drop"`` them or ``"batch"``
+            them, sent by each worker in a single message per step (only with ``sync="pipe"``).
+        placement: Placement
+            Pins the workers (and the learner) to cpus, see ``rw.runner.placement.Placement``.
+            The placement of each worker is logged with the first logs.
+        """
         super().__init__(env=env, ep_maxlen=ep_maxlen)
+        if sync not in {"pipe", "spin", "futex"}:
+            raise ValueError("sync should be one of pipe, spin or futex, got {}".format(sync))
+        if extra_info not in {"drop", "batch"}:
+            raise ValueError("extra_info should be drop or batch, got {}".format(extra_info))
+        if extra_info == "batch" and sync != "pipe":
+            raise ValueError("Batched extra info is sent through the pipe, use sync pipe")
+        self.info_schema = (
+            None if info_schema is None else {k: np.asarray(v) for k, v in info_schema.items()}
+        )
+        self.extra_info = extra_info
+        self.placement = placement
         self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.sync_mode = sync
+        self.lockstep = Lockstep(self.num_workers, wait=sync) if sync != "pipe" else None
+        self._step_time, self._sync_time, self._num_acts = 0.0, 0.0, 0
         self._env_rs_sum = np.zeros(self.num_envs)
         self._env_ep_lengths = np.zeros(self.num_envs)
-        self.manager = Manager()
+        self.manager = Manager() if info_schema is None else None
+        self._extra = {}
 
         self._create_shared_transitions()
         self._create_workers()
+        if placement is not None:
+            placement.apply_learner()
 
     @property
     def env_name(self):
@@ -51,11 +106,25 @@ class PAACRunner(BaseRunner):
         return self.env[0].ac_space
 
     def _create_shared_transitions(self):
-        s = self._get_shared(np.zeros(self.s_space.shape, dtype=self.s_space.dtype))
-        ac = self._get_shared(self._get_ac_array())
-        r = self._get_shared(np.zeros(self.num_envs, dtype=np.float32))
-        d = self._get_shared(np.zeros(self.num_envs, dtype=np.float32))
-        info = [self.manager.dict() for _ in range(self.num_envs)]
+        if self.placement is not None and self.placement.numa:
+            # Pages are allocated when first written by the workers
+            shared = Placement.empty_shared_array
+        else:
+            shared = lambda shape, dtype: self._get_shared(np.zeros(shape, dtype=dtype))
+        ac = self._get_ac_array()
+        s = shared(self.s_space.shape, self.s_space.dtype)
+        ac = shared(ac.shape, ac.dtype)
+        r = shared(self.num_envs, np.float32)
+        d = shared(self.num_envs, np.float32)
+        if self.info_schema is None:
+            info = [self.manager.dict() for _ in range(self.num_envs)]
+        else:
+            info = U.memories.SimpleMemory(
+                {
+                    k: self._get_shared(np.repeat(v[None], self.num_envs, axis=0))
+                    for k, v in self.info_schema.items()
+                }
+            )
 
         self.shared_tran = U.memories.SimpleMemory(s=s, r=r, d=d, ac=ac, info=info)
 
@@ -67,25 +136,43 @@ class PAACRunner(BaseRunner):
         ----------
         env: list
             List of env, each worker will have approximately the same number of env.
+
+        With ``sync`` set to ``"spin"`` or ``"futex"`` the workers are driven by a shared
+        memory ``Lockstep`` instead of a queue and a pipe per worker.
         """
         WorkerNTuple = namedtuple("Worker", ["process", "connection", "barrier"])
         self.workers = []
-
-        for env_i, s_s, s_r, s_d, s_a, s_i in zip(
+        if self.placement is not None:
+            self.placement.assign(self.num_workers)
+        # Cpus each worker runs on, written by the workers once started
+        self._placement_report = self._get_shared(
+            np.zeros((self.num_workers, os.cpu_count()), dtype=np.bool_)
+        )
+        self._placement_logged = False
+
+        for i, (env_i, s_s, s_r, s_d, s_a, s_i) in enumerate(zip(
             self.split(self.env),
             self.split(self.shared_tran.s),
             self.split(self.shared_tran.r),
             self.split(self.shared_tran.d),
             self.split(self.shared_tran.ac),
-            self.split(self.shared_tran.info),
-        ):
+            self._split_info(self.shared_tran.info),
+        )):
 
             shared_tran = U.memories.SimpleMemory(s=s_s, r=s_r, d=s_d, ac=s_a, info=s_i)
             parent_conn, child_conn = Pipe()
             queue = Queue()
 
             process = EnvWorker(
-                env=env_i, conn=queue, barrier=child_conn, shared_transition=shared_tran
+                env=env_i,
+                conn=queue,
+                barrier=child_conn,
+                shared_transition=shared_tran,
+                lockstep=self.lockstep,
+                idx=i,
+                extra_info=self.extra_info,
+                placement=self.placement,
+                placement_report=self._placement_report,
             )
             process.daemon = True
             process.start()
@@ -95,9 +182,9 @@ class PAACRunner(BaseRunner):
             )
 
     def _get_ac_array(self):
-        if isinstance(self.ac_space, U.space.Continuous):
+        if isinstance(self.ac_space, rw.space.Continuous):
             shape = (self.num_envs, np.prod(self.ac_space.shape))
-        elif isinstance(self.ac_space, U.space.Discrete):
+        elif isinstance(self.ac_space, rw.space.Categorical):
             shape = (self.num_envs,)
         else:
             raise ValueError(
@@ -129,16 +216,17 @@ class PAACRunner(BaseRunner):
 
     def act(self, ac):
         # Send actions to worker
+        start = time.perf_counter()
         self.shared_tran.ac[...] = ac
-        for worker in self.workers:
-            worker.connection.put(True)
+        self.send(STEP)
         self.sync()
+        self._add_step_time(time.perf_counter() - start)
         self.num_steps += self.num_envs
 
         sns = self.shared_tran.s.copy()
         rs = self.shared_tran.r.copy()
         ds = self.shared_tran.d.copy()
-        infos = list(map(dict, self.shared_tran.info))
+        infos = self._get_infos()
 
         # Accumulate rs
         self._env_rs_sum += rs
@@ -158,20 +246,88 @@ class PAACRunner(BaseRunner):
         Reset all workers in parallel, using Pipe for communication.
         """
         # Send signal to reset
-        for worker in self.workers:
-            worker.connection.put(None)
+        self.send(RESET)
         # Receive results
         self.sync()
         ss = self.shared_tran.s.copy()
 
         return ss
 
+    def _get_infos(self):
+        info = self.shared_tran.info
+        if isinstance(info, list):
+            return list(map(dict, info))
+
+        infos = [{k: v[i].copy() for k, v in info.items()} for i in range(self.num_envs)]
+        for i, extra in self._extra.items():
+            infos[i].update(extra)
+        return infos
+
+    def _split_info(self, info):
+        if isinstance(info, list):
+            return self.split(info)
+
+        parts = {k: self.split(v) for k, v in info.items()}
+        return [
+            U.memories.SimpleMemory({k: v[i] for k, v in parts.items()})
+            for i in range(self.num_workers)
+        ]
+
     def sample_random_ac(self):
         return np.array([env.sample_random_ac() for env in self.env])
 
-    def sync(self):
+    def _add_step_time(self, step_time):
+        self._step_time += step_time
+        # Workers only report their work time with the lockstep protocol
+        if self.lockstep is not None:
+            self._sync_time += max(step_time - self.lockstep.work.max(), 0.0)
+        self._num_acts += 1
+
+    def write_logs(self, logger):
+        super().write_logs(logger)
+        self._log_placement(logger)
+        if self._num_acts == 0:
+            return
+        n = self._num_acts
+        logger.add_log(self._wrap_name("step_ms"), 1e3 * self._step_time / n, precision=3, hidden=True)
+        if self.lockstep is not None:
+            logger.add_log(self._wrap_name("sync_overhead_ms"), 1e3 * self._sync_time / n, precision=3, hidden=True)
+        self._step_time, self._sync_time, self._num_acts = 0.0, 0.0, 0
+
+    def _log_placement(self, logger):
+        if self.placement is None or self._placement_logged:
+            return
+        for i, mask in enumerate(self._placement_report):
+            cpus = np.flatnonzero(mask)
+            if len(cpus) == 0:
+                continue
+            logger.add_header("Worker {}".format(i), self.placement.describe(mask))
+            logger.add_log(self._wrap_name("worker_{}/n_cpus".format(i)), len(cpus), hidden=True)
+            logger.add_log(
+                self._wrap_name("worker_{}/numa_node".format(i)),
+                self.placement.node_of(cpus[0]),
+                hidden=True,
+            )
+        self._placement_logged = True
+
+    def send(self, cmd):
+        if self.lockstep is not None:
+            self.lockstep.send(cmd)
+            return
         for worker in self.workers:
-            worker.barrier.recv()
+            worker.connection.put(None if cmd == RESET else True)
+
+    def sync(self):
+        if self.lockstep is not None:
+            self.lockstep.join()
+            return
+        self._extra = {}
+        for idxs, worker in zip(self.split(np.arange(self.num_envs)), self.workers):
+            # Workers send the info not in the schema of all their envs in a single message,
+            # workers without envs (more workers than envs) only acknowledge
+            extra = worker.barrier.recv()
+            if isinstance(extra, dict) and len(idxs):
+                self._extra.update({idxs[0] + i: v for i, v in extra.items()})
 
     def split(self, array):
         """
@@ -194,6 +350,10 @@ class PAACRunner(BaseRunner):
         ]
 
     def terminate_workers(self):
+        if self.lockstep is not None:
+            self.lockstep.send(CLOSE)
+            for worker in self.workers:
+                worker.process.join(timeout=1.0)
         for worker in self.workers:
             worker.process.terminate()
 
@@ -204,8 +364,24 @@ class PAACRunner(BaseRunner):
 
 
 class EnvWorker(Process):
-    def __init__(self, env, conn, barrier, shared_transition):
+    def __init__(
+        self,
+        env,
+        conn,
+        barrier,
+        shared_transition,
+        lockstep=None,
+        idx=None,
+        extra_info="drop",
+        placement=None,
+        placement_report=None,
+    ):
         super().__init__()
+        self.placement = placement
+        self.placement_report = placement_report
+        self.extra_info = extra_info
+        self.lockstep = lockstep
+        self.idx = idx
         self.env = env
         self.conn = conn
         self.barrier = barrier
@@ -213,26 +389,79 @@ class EnvWorker(Process):
 
     def run(self):
         super().run()
+        if self.placement is not None:
+            self.placement.apply_worker(self.idx)
+            # First touch of the slices, their pages are allocated on the node of the worker
+            if self.placement.numa:
+                for arr in [self.shared_tran.s, self.shared_tran.r, self.shared_tran.d, self.shared_tran.ac]:
+                    arr[...] = 0
+            self.placement.report(self.placement_report[self.idx])
         self._run()
 
     def _run(self):
+        if self.lockstep is not None:
+            return self._run_lockstep()
+
         while True:
             data = self.conn.get()
 
             if data is None:
-                for i, env in enumerate(self.env):
-                    self.shared_tran.s[i] = env.reset()
-
+                self._reset()
+                extra = None
             else:
-                for i, (a, env) in enumerate(zip(self.shared_tran.ac, self.env)):
-                    sn, r, d, info = env.step(a)
+                extra = self._step()
 
-                    if d:
-                        sn = env.reset()
+            self.barrier.send(extra or True)
 
-                    self.shared_tran.s[i] = sn
-                    self.shared_tran.r[i] = r
-                    self.shared_tran.d[i] = d
-                    self.shared_tran.info[i].update(info)
+    def _run_lockstep(self):
+        seq = 0
+        while True:
+            cmd, seq = self.lockstep.recv(self.idx, seq)
+            start = time.perf_counter()
 
-            self.barrier.send(True)
+            if cmd == RESET:
+                self._reset()
+            elif cmd == STEP:
+                self._step()
+
+            self.lockstep.ack(self.idx, seq, time.perf_counter() - start)
+            if cmd == CLOSE:
+                break
+
+    def _reset(self):
+        for i, env in enumerate(self.env):
+            self.shared_tran.s[i] = env.reset()
+
+    def _step(self):
+        """
+        Steps all envs, returns the info not in the shared schema (if batched) of each env.
+        """
+        extra = {}
+        for i, (a, env) in enumerate(zip(self.shared_tran.ac, self.env)):
+            sn, r, d, info = env.step(a)
+
+            if d:
+                sn = env.reset()
+
+            self.shared_tran.s[i] = sn
+            self.shared_tran.r[i] = r
+            self.shared_tran.d[i] = d
+            # Info is a list of manager dicts when there is no schema
+            if isinstance(self.shared_tran.info, list):
+                self.shared_tran.info[i].update(info)
+                continue
+
+            extra_i = self._write_info(i, info)
+            if extra_i and self.extra_info == "batch":
+                extra[i] = extra_i
+
+        return extra
+
+    def _write_info(self, i, info):
+        extra = {}
+        for k, v in info.items():
+            if k in self.shared_tran.info:
+                self.shared_tran.info[k][i] = v
+            else:
+                extra[k] = v
+        return extra
@@ -0,0 +1,96 @@
+import os, glob, mmap, warnings
+import numpy as np
+import torch
+
+
+def _parse_cpulist(s):
+    "Parses a cpu list like ``'0-3,8,10-11'``."
+    cpus = []
+    for part in s.strip().split(','):
+        if not part: continue
+        lo, _, hi = part.partition('-')
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+def numa_nodes():
+    "Cpus of each NUMA node, a single node with all cpus if the topology is not available."
+    nodes = {}
+    for path in glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'):
+        with open(path) as f: nodes[int(path.split('/')[-2][4:])] = _parse_cpulist(f.read())
+    return nodes or {0: sorted(os.sched_getaffinity(0))}
+
+
+class Placement:
+    """
+    Pins the worker processes of a runner to cpus, keeping some cpus for the learner.
+
+    The learner (the process creating the runner) is pinned to ``learner_cpus`` and its torch
+    intra-op threads are set to the same number. The other cpus are split into contiguous
+    sets, one per worker. With ``numa`` the cpus are ordered by NUMA node, so consecutive workers
+    (which own consecutive slices of the shared memory) share a node, and the shared memory is
+    first touched by the workers, so the pages of their slices are allocated on their node.
+
+    Parameters
+    ----------
+        learner_cpus: int or list of int
+            Number of cpus (the first available ones) or the cpus reserved for the learner.
+        cpus: list of int
+            Cpus that can be used, defaults to the affinity of the current process.
+        numa: bool
+            Place workers by NUMA node.
+        nodes: dict
+            Cpus of each NUMA node, read from sysfs by default.
+    """
+    def __init__(self, learner_cpus=1, cpus=None, numa=True, nodes=None):
+        self.cpus = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+        self.numa, self.nodes = numa, nodes or numa_nodes()
+        self._node_of = {c: n for n, cs in self.nodes.items() for c in cs}
+        self.learner = self.cpus[:learner_cpus] if isinstance(learner_cpus, int) else sorted(learner_cpus)
+        self.workers = None
+
+    def node_of(self, cpu): return self._node_of.get(cpu, 0)
+
+    def assign(self, n_workers):
+        "Splits the cpus not reserved for the learner between ``n_workers`` workers."
+        rest = [c for c in self.cpus if c not in self.learner]
+        if not rest:
+            warnings.warn('No cpus left for the workers after reserving the learner ones, workers share them')
+            rest = list(self.cpus)
+        if self.numa: rest = sorted(rest, key=lambda c: (self.node_of(c), c))
+        if n_workers <= len(rest): self.workers = [[int(c) for c in o] for o in np.array_split(rest, n_workers)]
+        # More workers than cpus, consecutive workers share a cpu
+        else: self.workers = [[rest[i * len(rest) // n_workers]] for i in range(n_workers)]
+        return self.workers
+
+    def apply_learner(self):
+        if self.learner: os.sched_setaffinity(0, self.learner)
+        torch.set_num_threads(max(len(self.learner), 1))
+
+    def apply_worker(self, i): os.sched_setaffinity(0, self.workers[i])
+
+    def report(self, out):
+        "Writes the cpus the calling process actually runs on to the boolean mask ``out``."
+        out[:] = False
+        for c in os.sched_getaffinity(0):
+            if c < len(out): out[c] = True
+
+    def describe(self, mask):
+        "Text describing a cpu mask written by ``report``."
+        cpus = np.flatnonzero(mask)
+        nodes = sorted({self.node_of(c) for c in cpus})
+        return f'cpus {",".join(map(str, cpus))} node {",".join(map(str, nodes))}'
+
+    @staticmethod
+    def empty_shared_array(shape, dtype):
+        """
+        Numpy array in anonymous shared memory (inherited by forked workers) whose pages are not
+        touched yet, they are allocated on the node of the first process writing them.
+        """
+        dtype, n = np.dtype(dtype), int(np.prod(shape))
+        buf = mmap.mmap(-1, max(n * dtype.itemsize, 1))
+        return np.frombuffer(buf, dtype=dtype, count=n).reshape(shape)
+
+    @staticmethod
+    def empty_shared(shape, dtype):
+        "Tensor version of ``empty_shared_array``."
+        return torch.from_numpy(Placement.empty_shared_array(shape, dtype))
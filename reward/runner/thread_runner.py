@@ -0,0 +1,95 @@
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import reward as rw
+from concurrent.futures import ThreadPoolExecutor
+from .paac import _reset, _step
+
+
+class ThreadRunner:
+    """
+    Same interface as ``PAAC`` but the envs are stepped by a pool of threads of the current
+    process, each thread steps a slice of envs and writes directly to preallocated arrays.
+
+    Only useful for envs that release the GIL while stepping (MuJoCo, dm_control, simulators
+    written in C++, envs doing heavy numpy work), otherwise the threads run one at a time.
+    There are no worker processes to start and nothing is copied between processes.
+
+    Parameters
+    ----------
+        env_fn: callable
+            Creates a single env.
+        n_envs: int
+            Total number of envs.
+        s_sp: Space
+            State space.
+        a_sp: Space
+            Action space.
+        n_threads: int
+            Number of threads, defaults to the number of cpus (at most ``n_envs``).
+        tfms: list
+            Transforms applied to the states.
+    """
+    def __init__(self, env_fn, n_envs, s_sp, a_sp, n_threads=None, tfms=None):
+        self.n_envs, self.tfms, self.s_sp = n_envs, tfms, s_sp
+        self.n_threads = min(n_threads or mp.cpu_count(), n_envs)
+        self.envs = [env_fn() for _ in range(n_envs)]
+        self.step_time, self.sync_time, self.n_steps = 0., 0., 0
+        self._create_arrays(s_sp=s_sp, a_sp=a_sp)
+        q, r = divmod(n_envs, self.n_threads)
+        self._slices = [slice(i*q+min(i, r), (i+1)*q+min(i+1, r)) for i in range(self.n_threads)]
+        self._pool = ThreadPoolExecutor(max_workers=self.n_threads, thread_name_prefix='ThreadRunner')
+        rw.logger.subscribe_log(self._write_logs)
+
+    def reset(self):
+        self._run(self._reset_slice)
+        return self._ss.clone()
+
+    def step(self, act):
+        start = time.perf_counter()
+        self._acs.copy_(torch.as_tensor(act))
+        work = self._run(self._step_slice)
+        step_time = time.perf_counter() - start
+        self.step_time, self.sync_time = self.step_time + step_time, self.sync_time + max(step_time - max(work), 0.)
+        self.n_steps += 1
+        return self._ss.clone(), self._rs.clone(), self._ds.clone(), {}
+
+    def close(self):
+        rw.logger.unsubscribe_log(self._write_logs)
+        self._pool.shutdown()
+        for env in self.envs:
+            if hasattr(env, 'close'): env.close()
+
+    def stats(self):
+        "Mean step time and synchronization overhead per step (in ms) since the last call."
+        n = max(self.n_steps, 1)
+        stats = dict(step_ms=1e3 * self.step_time / n, sync_overhead_ms=1e3 * self.sync_time / n)
+        self.step_time, self.sync_time, self.n_steps = 0., 0., 0
+        return stats
+
+    def _write_logs(self):
+        if self.n_steps == 0: return
+        for k, v in self.stats().items(): rw.logger.add_log(f'thread_runner/{k}', v, precision=3, hidden=True)
+
+    def _run(self, fn):
+        "Runs ``fn`` on each slice of envs, returns the time spent by each slice."
+        return list(self._pool.map(fn, self._slices))
+
+    def _reset_slice(self, sl):
+        start = time.perf_counter()
+        _reset(self.envs[sl], ss=self._ss[sl], s_sp=self.s_sp, tfms=self.tfms)
+        return time.perf_counter() - start
+
+    def _step_slice(self, sl):
+        start = time.perf_counter()
+        _step(self.envs[sl], ss=self._ss[sl], acs=self._acs[sl], rs=self._rs[sl], ds=self._ds[sl], s_sp=self.s_sp, tfms=self.tfms)
+        return time.perf_counter() - start
+
+    def _create_arrays(self, s_sp, a_sp):
+        # Tensors are views of the numpy arrays written by the threads
+        n_envs = (self.n_envs,)
+        self._ss = torch.from_numpy(np.zeros(n_envs+tuple(s_sp.shape), dtype=s_sp.dtype))
+        self._acs = torch.from_numpy(np.zeros(n_envs+tuple(a_sp.shape), dtype=a_sp.dtype))
+        self._rs = torch.from_numpy(np.zeros(n_envs, dtype=np.float32))
+        self._ds = torch.from_numpy(np.zeros(n_envs, dtype=np.int32))
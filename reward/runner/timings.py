@@ -0,0 +1,85 @@
+import math, time
+import numpy as np
+import torch
+
+
+class StepTimings:
+    """
+    Histograms of the durations of env steps and resets of each worker, in shared memory.
+
+    Workers add the duration of every ``env.step`` and ``env.reset`` (through the timer returned
+    by ``worker``) to log-spaced bins, the master reads percentiles of the durations added since
+    its last read, without stopping the workers.
+
+    Parameters
+    ----------
+        n_workers: int
+            Number of workers.
+        lo: float
+            Upper edge of the first bin (in seconds), shorter durations go to the first bin.
+        hi: float
+            Lower edge of the last bin (in seconds), longer durations go to the last bin.
+        bins_per_decade: int
+            Resolution of the histograms.
+    """
+    def __init__(self, n_workers, lo=1e-6, hi=10., bins_per_decade=16):
+        self.n_workers, self.lo, self.bins_per_decade = n_workers, lo, bins_per_decade
+        self.n_bins = int(math.ceil(math.log10(hi / lo) * bins_per_decade)) + 2
+        # Upper edge of each bin, the last bin is unbounded
+        self.edges = np.append(lo * 10 ** (np.arange(self.n_bins - 1) / bins_per_decade), np.inf)
+        self._tensors = dict(steps=torch.zeros((n_workers, self.n_bins), dtype=torch.int64),
+                             resets=torch.zeros((n_workers, self.n_bins), dtype=torch.int64))
+        for t in self._tensors.values(): t.share_memory_()
+        self._create_views()
+        self._last = {k: np.zeros((n_workers, self.n_bins), dtype=np.int64) for k in self._tensors}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in self._tensors: state.pop(k)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._create_views()
+
+    def _create_views(self):
+        for k, t in self._tensors.items(): setattr(self, k, t.numpy())
+
+    def worker(self, i): return WorkerTimer(self, i)
+
+    def bin(self, dt):
+        if dt <= self.lo: return 0
+        return min(int(math.log10(dt / self.lo) * self.bins_per_decade) + 1, self.n_bins - 1)
+
+    def read(self):
+        "Histograms of steps and resets added since the last call, shape ``(n_workers, n_bins)``."
+        hists = {}
+        for k in self._tensors:
+            now = getattr(self, k).copy()
+            hists[k], self._last[k] = now - self._last[k], now
+        return hists
+
+    def percentile(self, hist, q):
+        "Upper edge of the bin containing the percentile ``q`` of each row of ``hist`` (nan for empty rows)."
+        total, cum = hist.sum(-1), hist.cumsum(-1)
+        idx = (cum < (q / 100) * total[:, None]).sum(-1)
+        edges = self.edges[np.minimum(idx, self.n_bins - 1)]
+        return np.where(total > 0, edges, np.nan)
+
+
+class WorkerTimer:
+    "Steps and resets envs of worker ``i``, adding their durations to the histograms of ``timings``."
+    def __init__(self, timings, i):
+        self.timings, self.steps, self.resets = timings, timings.steps[i], timings.resets[i]
+
+    def step(self, env, a):
+        start = time.perf_counter()
+        out = env.step(a)
+        self.steps[self.timings.bin(time.perf_counter() - start)] += 1
+        return out
+
+    def reset(self, env):
+        start = time.perf_counter()
+        s = env.reset()
+        self.resets[self.timings.bin(time.perf_counter() - start)] += 1
+        return s
@@ -14,6 +14,7 @@ class Categorical(Space):
 
     def __call__(self, val): return CategoricalObj(val=val)
     def from_list(self, vals): return CategoricalObj.from_list(vals=vals)
+    def from_arr(self, arr): return CategoricalObj.from_arr(arr=arr)
 
     def sample(self): return np.random.randint(low=0, high=self.n_acs, size=(1,))
 
@@ -26,13 +27,15 @@ class CategoricalObj:
     def __init__(self, val): self.val = val
     def __repr__(self): return f'Categorical({self.val.__repr__()})'
 
-    def __array__(self): return np.array(val, dtype='int', copy=False)
+    def __array__(self): return np.array(self.val, dtype='int', copy=False)
     def to_tensor(self): return U.tensor(np.array(self))
 
     def apply_tfms(self, tfms, priority): raise NotImplementedError
 
     @staticmethod
     def from_list(vals): return CategoricalList(vals=vals)
+    @staticmethod
+    def from_arr(arr): return CategoricalList.from_arr(arr=arr)
 
     @property
     def shape(self): raise NotImplementedError
@@ -40,13 +43,18 @@ class CategoricalObj:
 
 class CategoricalList:
     sig = Categorical
-    def __init__(self, vals): self.vals = vals
+    def __init__(self, vals, arr=None): self.vals, self._arr = vals, arr
     def __repr__(self): return f'Categorical({self.vals.__repr__()})'
 
-    def __array__(self): return np.array([o.val for o in self.vals], dtype='int', copy=False)
+    def __array__(self):
+        if self._arr is not None: return np.array(self._arr, dtype='int', copy=False)
+        return np.array([o.val for o in self.vals], dtype='int', copy=False)
     def to_tensor(self): return U.tensor(np.array(self))
 
-    def unpack(self): return self.vals
+    def unpack(self): return self.vals if self._arr is None else [CategoricalObj(o) for o in self._arr]
+
+    @classmethod
+    def from_arr(cls, arr): return cls(vals=None, arr=arr)
 
     def save(self, savedir, postfix=''):
         np.save(Path(savedir)/f'cat_{postfix}.npy', np.array(self))
@@ -17,6 +17,7 @@ class Image(Space):
         return ImageObj(img=self._fix_dims(img))
 
     def from_list(self, imgs): return ImageObj.from_list(imgs=imgs)
+    def from_arr(self, arr): return ImageObj.from_arr(arr=arr)
 
     def _fix_dims(self, img): return img if self.order == 'NHWC' else img.transpose([0, 2, 3, 1])
 
@@ -42,15 +43,18 @@ class ImageObj:
 
     @staticmethod
     def from_list(imgs): return ImageList(imgs=imgs)
+    @staticmethod
+    def from_arr(arr): return ImageList.from_arr(arr=arr)
 
     @property
     def shape(self): raise NotImplementedError
 
 class ImageList:
     sig = Image
-    def __init__(self, imgs): self.imgs = imgs
+    def __init__(self, imgs, arr=None): self.imgs, self._arr = imgs, arr
 
     def __array__(self): 
+        if self._arr is not None: return np.array(self._arr, copy=False)
         x = [o.img for o in self.imgs]
         # StackFrames Hack
         if isinstance(self.imgs[0].img, LazyStack): x = LazyStack.from_lists(x)
@@ -62,12 +66,16 @@ class ImageList:
         if isinstance(x, (torch.ByteTensor, torch.cuda.ByteTensor)): x = x.float() / 255.
         return x
 
-    def unpack(self): return self.imgs
+    def unpack(self): return self.imgs if self._arr is None else [ImageObj(o) for o in self._arr]
+
+    @classmethod
+    def from_arr(cls, arr): return cls(imgs=None, arr=arr)
 
     def save(self, savedir, postfix=''):
         savedir = Path(savedir)
         # StackFrames Hack
-        if isinstance(self.imgs[0].img, LazyStack):
+        if self._arr is not None: x = np.array(self._arr, copy=False)
+        elif isinstance(self.imgs[0].img, LazyStack):
             x = np.array([np.array(o.img, copy=False)[..., -1, None] for o in self.imgs])
             with open(str(savedir/(f'lazystack_{postfix}.json')), 'w') as f: json.dump(dict(n=np.array(self.imgs[0]).shape[-1]), f)
         else:
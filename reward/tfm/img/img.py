@@ -31,6 +31,9 @@ class Stack(Transform):
         self.n, self.deque = n, deque(maxlen=n)
 
     def get(self): return LazyStack(list(self.deque))
+
+    # Called at the start of each episode, the next frame is repeated to fill the stack
+    def reset(self): self.deque.clear()
         
     def apply(self, x):
         if x.shape[-1] != 1: raise ValueError(f'Can only stack grayscale images (last dim = 1), got {x.shape}')
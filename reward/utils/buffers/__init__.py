@@ -1,12 +1,21 @@
 from .ring_buffer import RingBuffer
+from .segment_tree import SegmentTree, SumTree, MinTree
+from .memmap_storage import MemmapStorage
+from .index_sampler import IndexSampler
 from .replay_buffer import ReplayBuffer, DictReplayBuffer
 from .prioritized_replay_buffer import PrReplayBuffer
-from .demo_replay_buffer import DemoReplayBuffer
+from .demo_replay_buffer import DemoReplayBuffer, PrDemoReplayBuffer
 
 __all__ = [
     "RingBuffer",
+    "SegmentTree",
+    "SumTree",
+    "MinTree",
+    "MemmapStorage",
+    "IndexSampler",
     "ReplayBuffer",
     "PrReplayBuffer",
     "DemoReplayBuffer",
+    "PrDemoReplayBuffer",
     "DictReplayBuffer",
 ]
@@ -35,28 +35,119 @@
 #         pr = pr + self.get_min_pr(step) + self.pr_demos[idx]
 #         self.probs[idx] = pr ** self.get_pr_factor(step)
 
-import pdb
 import numpy as np
-from reward.utils.buffers import ReplayBuffer
-from reward.utils import make_callable
+from pathlib import Path
+from reward.utils import Batch
+from reward.utils.buffers import ReplayBuffer, PrReplayBuffer
+
 
-# TODO: Add_sample_demo don't work after normal samples were added
 class DemoReplayBuffer(ReplayBuffer):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._last_demo = 0
-        self._demo_ended = False
+    """
+    Replay buffer with a pinned partition for demonstrations (DQfD style).
+
+    Demonstrations are stored in their own ``ReplayBuffer`` that is never evicted, agent
+    transitions use the usual ring. Each batch draws ``demo_ratio`` of its samples from the
+    demonstrations and the rest from the agent partition, both with ``IndexSampler``.
+
+    ``idx`` of a batch is global: demo indexes come first, agent indexes are offset by
+    ``demo_capacity``.
+
+    Parameters
+    ----------
+        maxlen: int
+            Maximum number of agent transitions stored.
+        num_envs: int
+            Number of envs in each write.
+        demo_maxlen: int
+            Capacity of the demo partition, defaults to ``maxlen``.
+        demo_ratio: float
+            Fraction of each batch drawn from demonstrations. A batch is drawn from a single
+            partition while the other one is empty.
+        kwargs:
+            Passed to ``ReplayBuffer`` (e.g. ``stack``, ``n_step``, ``seed``).
+    """
+    demo_cls = ReplayBuffer
+
+    def __init__(self, maxlen, num_envs, *, demo_maxlen=None, demo_ratio=0.25, **kwargs):
+        super().__init__(maxlen, num_envs, **kwargs)
+        self.demo_ratio = demo_ratio
+        kwargs.update(seed=self.sampler.rng)
+        kwargs.pop("memdir", None)
+        self.demo = self.demo_cls(demo_maxlen or maxlen, num_envs, **kwargs)
+
+    @property
+    def demo_capacity(self): return self.demo.real_maxlen * self.demo.num_envs
+
+    def __len__(self): return super().__len__() + len(self.demo)
 
     def add_sample_demo(self, **kwargs):
-        assert not self._demo_ended
-        super().add_sample(**kwargs)
-        self._last_demo += 1
+        self._check_demo_space(1)
+        self.demo.add_sample(**kwargs)
 
-    def add_sample(self, **kwargs):
-        self._demo_ended = True
-        super().add_sample(**kwargs)
+    def add_samples_demo(self, ss, acs, rs, ds):
+        self._check_demo_space(len(ss))
+        self.demo.add_samples(ss=ss, acs=acs, rs=rs, ds=ds)
+
+    def load_demos(self, loaddir, chunk_size=10000):
+        "Bulk ingests a buffer written by ``ReplayBuffer.save`` into the demo partition, one chunk at a time."
+        loaddir = Path(loaddir) / "buffer"
+        ss, acs, rs, ds = [np.load(loaddir / f"{k}.npy", mmap_mode="r") for k in ["states", "acs", "rs", "ds"]]
+        self._check_demo_space(len(ss))
+        for i in range(0, len(ss), chunk_size):
+            self.demo.add_samples(ss=ss[i:i + chunk_size], acs=acs[i:i + chunk_size], rs=rs[i:i + chunk_size], ds=ds[i:i + chunk_size])
 
     def sample(self, batch_size):
-        batch = super().sample(batch_size=batch_size)
-        batch.is_demo = batch.idx < self._last_demo
+        n_demo, n_agent = self.demo.available_idxs, self.available_idxs
+        if n_demo > 0 and n_agent > 0: bs_demo = int(round(batch_size * self.demo_ratio))
+        else:                          bs_demo = batch_size if n_demo > 0 else 0
+        batches = []
+        if bs_demo > 0: batches.append(self.demo.sample(batch_size=bs_demo))
+        if bs_demo < batch_size:
+            batches.append(super().sample(batch_size=batch_size - bs_demo))
+            batches[-1].idx = batches[-1].idx + self.demo_capacity
+        batch = self._cat(batches)
+        batch.is_demo = np.arange(batch_size) < bs_demo
         return batch
+
+    def save(self, savedir):
+        super().save(savedir=savedir)
+        (Path(savedir) / "demo").mkdir(exist_ok=True)
+        self.demo.save(savedir=Path(savedir) / "demo")
+
+    def load(self, loaddir):
+        super().load(loaddir=loaddir)
+        self.load_demos(loaddir=Path(loaddir) / "demo")
+
+    def _check_demo_space(self, n):
+        if self.demo._len + n > self.demo.real_maxlen:
+            raise ValueError("Demo partition is full ({} of {} steps used), demonstrations are never evicted".format(
+                self.demo._len, self.demo.real_maxlen))
+
+    @staticmethod
+    def _cat(batches):
+        if len(batches) == 1: return batches[0]
+        # Fields have shape (window, batch_size, ...), idx has shape (batch_size,)
+        return Batch({k: np.concatenate([b[k] for b in batches], axis=0 if k == "idx" else 1) for k in batches[0]})
+
+
+class PrDemoReplayBuffer(DemoReplayBuffer, PrReplayBuffer):
+    """
+    ``DemoReplayBuffer`` with prioritized partitions, each one sampled as a ``PrReplayBuffer``.
+
+    ``update_pr`` and ``get_is_weight`` receive the global indexes of a batch and route them
+    to their partition, importance weights are normalized inside each partition.
+    """
+    demo_cls = PrReplayBuffer
+
+    def update_pr(self, idx, pr, step):
+        idx, pr = np.asarray(idx), np.asarray(pr).reshape(-1)
+        demo = idx < self.demo_capacity
+        if demo.any(): self.demo.update_pr(idx[demo], pr[demo], step)
+        if not demo.all(): super().update_pr(idx[~demo] - self.demo_capacity, pr[~demo], step)
+
+    def get_is_weight(self, idx, step):
+        idx = np.asarray(idx)
+        demo, weights = idx < self.demo_capacity, np.ones((len(idx), 1))
+        if demo.any(): weights[demo] = self.demo.get_is_weight(idx[demo], step)
+        if not demo.all(): weights[~demo] = super().get_is_weight(idx[~demo] - self.demo_capacity, step)
+        return weights
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class IndexSampler:
+    """
+    Samples distinct indexes from ``range(n)`` in O(bs), without the O(n) permutation done
+    by ``np.random.choice(n, bs, replace=False)``.
+
+    Candidates are drawn with replacement, duplicates and indexes rejected by ``valid``
+    are discarded and new candidates are drawn until the batch is complete. When the batch
+    is a large fraction of ``n`` it falls back to a permutation of the valid indexes.
+
+    Parameters
+    ----------
+        seed: int or np.random.Generator
+            Seed (or generator) used for sampling, a fresh generator is created if None.
+    """
+    def __init__(self, seed=None): self.seed(seed)
+
+    def seed(self, seed=None): self.rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+
+    def sample(self, n, bs, valid=None, max_tries=32):
+        """
+        Parameters
+        ----------
+            n: int
+                Size of the index space.
+            bs: int
+                Number of indexes to sample.
+            valid: callable
+                Receives an array of candidate indexes and returns a boolean mask of the valid ones.
+            max_tries: int
+                Rounds of rejection sampling before falling back to a permutation.
+        """
+        n, bs = int(n), int(bs)
+        if bs > n: raise ValueError(f'Cannot sample {bs} indexes out of {n}')
+        idxs = np.empty(0, dtype=np.int64)
+        for _ in range(max_tries if 2 * bs <= n else 0):
+            # Draw a few more than needed, most draws are accepted when bs << n
+            cand = self.rng.integers(n, size=2 * (bs - len(idxs)) + 8)
+            if valid is not None: cand = cand[valid(cand)]
+            idxs = np.concatenate([idxs, cand])
+            # Keep the first occurrence of each index, in drawing order
+            _, first = np.unique(idxs, return_index=True)
+            idxs = idxs[np.sort(first)]
+            if len(idxs) >= bs: return idxs[:bs]
+        return self._permutation(n=n, bs=bs, valid=valid)
+
+    def _permutation(self, n, bs, valid):
+        idxs = np.arange(n)
+        if valid is not None: idxs = idxs[valid(idxs)]
+        if bs > len(idxs): raise ValueError(f'Cannot sample {bs} indexes, only {len(idxs)} out of {n} are valid')
+        return self.rng.choice(idxs, size=bs, replace=False)
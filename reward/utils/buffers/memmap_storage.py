@@ -0,0 +1,74 @@
+import pickle
+import numpy as np
+from pathlib import Path
+
+
+class MemmapStorage:
+    """
+    Named arrays backed by ``np.memmap`` files in a run directory.
+
+    The layout of the arrays (shape, dtype and extra info) and a write cursor are
+    persisted next to the data, so a restarted job can reopen the storage without
+    copying or replaying any transition. Hot pages are kept by the OS page cache.
+
+    Parameters
+    ----------
+        path: str or Path
+            Directory where the arrays are stored, created if it does not exist.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(exist_ok=True, parents=True)
+        self.layout, self._arrs = self._read_layout(), {}
+        cursor_path = self.path/'cursor.dat'
+        mode = 'r+' if cursor_path.exists() else 'w+'
+        self._cursor = np.memmap(str(cursor_path), dtype=np.int64, mode=mode, shape=(2,))
+
+    def __contains__(self, name): return name in self.layout['arrs']
+
+    @property
+    def info(self): return self.layout['info']
+
+    @property
+    def empty(self): return len(self.layout['arrs']) == 0
+
+    def alloc(self, name, shape, dtype):
+        "Creates a new array, or reopens it if it already exists with the same layout."
+        shape, dtype = tuple(int(o) for o in shape), np.dtype(dtype)
+        if name in self:
+            expected = self.layout['arrs'][name]
+            if expected != dict(shape=shape, dtype=dtype.str):
+                raise ValueError(f'Array {name} already exists in {self.path} with layout {expected}, got shape {shape} and dtype {dtype}')
+            return self.get(name)
+        self._arrs[name] = np.memmap(str(self._arr_path(name)), dtype=dtype, mode='w+', shape=shape)
+        self.layout['arrs'][name] = dict(shape=shape, dtype=dtype.str)
+        self._write_layout()
+        return self._arrs[name]
+
+    def get(self, name):
+        if name not in self._arrs:
+            l = self.layout['arrs'][name]
+            self._arrs[name] = np.memmap(str(self._arr_path(name)), dtype=np.dtype(l['dtype']), mode='r+', shape=l['shape'])
+        return self._arrs[name]
+
+    def set_info(self, **kwargs):
+        self.layout['info'].update(kwargs)
+        self._write_layout()
+
+    def get_cursor(self): return tuple(int(o) for o in self._cursor)
+
+    def set_cursor(self, idx, length): self._cursor[:] = idx, length
+
+    def flush(self):
+        for arr in self._arrs.values(): arr.flush()
+        self._cursor.flush()
+
+    def _arr_path(self, name): return self.path/f'{name}.dat'
+
+    def _read_layout(self):
+        try:
+            with open(str(self.path/'layout.pkl'), 'rb') as f: return pickle.load(f)
+        except FileNotFoundError: return dict(arrs={}, info={})
+
+    def _write_layout(self):
+        with open(str(self.path/'layout.pkl'), 'wb') as f: pickle.dump(self.layout, f)
@@ -1,14 +1,17 @@
-import pdb
 import numpy as np
 import reward
 from reward.utils.buffers import ReplayBuffer
+from reward.utils.buffers.segment_tree import SumTree, MinTree
 from reward.utils import make_callable
 
 
-# TODO: Why paper suggest using SumTree instead of this approach I did?
 class PrReplayBuffer(ReplayBuffer):
-    def __init__(self, maxlen, num_envs, *, pr_factor, is_factor, min_pr=0.01):
+    def __init__(self, maxlen, num_envs, *, pr_factor, is_factor, min_pr=0.01, stack=1, n_step=1, seed=None):
         """
+        Priorities are kept in a sum tree (sampling) and a min tree (importance weights),
+        indexed by the same flat indexes returned by ``sample``. Windows that are not valid
+        (see ``ReplayBuffer``) have no mass in the trees, so they are never sampled.
+
         Parameters
         ----------
         min_pr: float or schedule
@@ -17,17 +20,27 @@ class PrReplayBuffer(ReplayBuffer):
             Determines how much prioritization is used (alpha in the paper).
         is_factor: float or schedule
             Importance sampling weight for correcting the bias (beta in the paper).
+        stack: int
+            Number of sequential states stacked when sampling.
+        n_step: int
+            Number of rewards of each sampled transition.
+        seed: int or np.random.Generator
+            Seed used by ``sample``.
         """
-        super().__init__(maxlen=maxlen, num_envs=num_envs)
+        super().__init__(maxlen=maxlen, num_envs=num_envs, stack=stack, n_step=n_step, seed=seed)
         self._min_pr = make_callable(min_pr)
         self._pr_factor = make_callable(pr_factor)
         self._is_factor = make_callable(is_factor)
 
-        self._probs = np.ones(self.maxlen)
+        capacity = self.real_maxlen * self.num_envs
+        self._sum_tree, self._min_tree = SumTree(capacity), MinTree(capacity)
+        # Priorities of all windows, only the valid ones are written to the trees
+        self._prs = np.zeros(capacity)
+        self._max_pr = 1.
 
     @property
     def probs(self):
-        return self._probs[: len(self)]
+        return self._sum_tree.values[: len(self)]
 
     def get_min_pr(self, step):
         return self._min_pr(step)
@@ -40,26 +53,64 @@ class PrReplayBuffer(ReplayBuffer):
 
     def add_sample(self, **kwargs):
         super().add_sample(**kwargs)
-        # New transition start with max probability
-        prob = np.max(self.probs)
-        self.probs[self.current_idx] = prob
+        # New transition start with max priority
+        self._set_pr(self._flat_idxs(np.array([self.idx])), self._max_pr)
+
+    def add_samples(self, ss, acs, rs, ds):
+        super().add_samples(ss=ss, acs=acs, rs=rs, ds=ds)
+        rows = np.arange(self.idx - ss.shape[0] + 1, self.idx + 1) % self.real_maxlen
+        self._set_pr(self._flat_idxs(rows), self._max_pr)
 
     def sample(self, batch_size):
-        # The sum of all probs should be 1
-        probs = self.probs[: self.available_idxs]
-        probs = probs / np.sum(probs)
-        idxs = np.random.choice(self.available_idxs, batch_size, replace=False, p=probs)
+        # Stratified sampling, one sample per equal mass segment of the valid range
+        mass = self._sum_tree.reduce(0, self.available_idxs)
+        if mass <= 0: raise ValueError('No valid windows to sample')
+        rng = self.sampler.rng
+        bounds = (np.arange(batch_size) + rng.uniform(size=batch_size)) * mass / batch_size
+        idxs = self._find(bounds)
+        # Floating point errors can land on the boundary of a window without mass, draw them again
+        bad = ~self._valid.reshape(-1)[idxs]
+        while bad.any():
+            idxs[bad] = self._find(rng.uniform(size=bad.sum()) * mass)
+            bad[bad] = ~self._valid.reshape(-1)[idxs[bad]]
 
         return self._get_batch(idxs=idxs)
 
+    def _find(self, prefixsum):
+        # Guard against floating point errors on the last segment
+        return np.minimum(self._sum_tree.find_prefixsum_idx(prefixsum), self.available_idxs - 1)
+
     def get_is_weight(self, idx, step):
-        probs = self.probs[idx]
-        probs = probs / np.sum(self.probs[: self.available_idxs])
-        is_weights = probs ** -self.get_is_factor(step)
-        is_weights /= is_weights.max()
+        # Normalized by the max weight, (p / p_min) ** -beta == w / w_max
+        pr_min = self._min_tree.reduce(0, self.available_idxs)
+        is_weights = (self._sum_tree[idx] / pr_min) ** -self.get_is_factor(step)
 
         return is_weights[:, None]
 
     def update_pr(self, idx, pr, step):
-        pr = pr.squeeze()
-        self.probs[idx] = (pr + self.get_min_pr(step)) ** self.get_pr_factor(step)
+        pr = np.asarray(pr).reshape(-1)
+        pr = (pr + self.get_min_pr(step)) ** self.get_pr_factor(step)
+        self._set_pr(idx, pr)
+        self._max_pr = max(self._max_pr, pr.max())
+
+    def _set_pr(self, idx, pr):
+        self._prs[idx] = pr
+        self._write_trees(idx)
+
+    def _write_trees(self, idx):
+        valid = self._valid.reshape(-1)[idx]
+        self._sum_tree[idx] = np.where(valid, self._prs[idx], 0.)
+        self._min_tree[idx] = np.where(valid, self._prs[idx], np.inf)
+
+    def _update_valid(self, rows):
+        rows = super()._update_valid(rows)
+        if len(rows) > 0: self._write_trees(self._flat_idxs(rows))
+        return rows
+
+    def reset(self):
+        super().reset()
+        self._sum_tree[np.arange(self._sum_tree.capacity)] = 0.
+        self._min_tree[np.arange(self._min_tree.capacity)] = np.inf
+
+    def _flat_idxs(self, rows):
+        return (rows[:, None] * self.num_envs + np.arange(self.num_envs)).reshape(-1)
@@ -4,12 +4,17 @@ from tqdm import tqdm
 import numpy as np
 from pathlib import Path
 from reward.utils import Batch, to_np
+from reward.utils.buffers.memmap_storage import MemmapStorage
+from reward.utils.buffers.index_sampler import IndexSampler
 
 
 class ReplayBuffer:
     """
     Memory efficient implementation of replay buffer, storing each state only once.
 
+    The validity of each stacked window (not crossing the write head nor the end of an
+    episode) is updated on every write, so ``sample`` never scans the stored dones.
+
     Parameters
     ----------
         maxlen: int
@@ -18,6 +23,11 @@ class ReplayBuffer:
             Number of sequential states stacked when sampling
         batch_size: int
             Mini-batch size created by sample
+        memdir: str or Path
+            If given, transitions are stored in ``np.memmap`` files in this directory
+            instead of RAM. A buffer already stored in ``memdir`` is reopened.
+        seed: int or np.random.Generator
+            Seed used by ``sample``.
 
     Examples
     --------
@@ -26,7 +36,7 @@ class ReplayBuffer:
         (8 * 64 * 64 * 1M bits)
     """
 
-    def __init__(self, maxlen, num_envs, stack=1, n_step=1):
+    def __init__(self, maxlen, num_envs, stack=1, n_step=1, memdir=None, seed=None):
         self.maxlen = int(maxlen)
         self.num_envs = num_envs
         # TODO: Real maxlen ?
@@ -37,6 +47,9 @@ class ReplayBuffer:
         # Intialized at -1 so the first updated position is 0
         self.idx = -1
         self._len = 0
+        self.sampler = IndexSampler(seed)
+        self._storage = None if memdir is None else MemmapStorage(memdir)
+        if self._storage is not None and not self._storage.empty: self._reopen()
 
     def __len__(self): return self._len * self.num_envs
 
@@ -47,7 +60,8 @@ class ReplayBuffer:
         if self.sn is not None:
             snb = self.stp1_stride[idxs]
         else:
-            snb = self.s_stride[idxs + self.n_step]
+            # Flat indexes are (row, env) pairs, the next state is n_step rows ahead
+            snb = self.s_stride[idxs + self.n_step * self.num_envs]
         acs = self.a_stride[idxs, -1:]
         rs = self.r_stride[idxs, -self.n_step :]
         ds = self.d_stride[idxs, -self.n_step :]
@@ -61,23 +75,46 @@ class ReplayBuffer:
         return Batch(s=sb, sn=snb, ac=acs, r=rs, d=ds, idx=idxs)
 
     @property
-    def available_idxs(self): return self.num_envs * (len(self) - self.stack - self.n_step + 1)
+    def available_idxs(self): return self.num_envs * (self._len - self.stack - self.n_step + 1)
 
     def _initialize(self, s, ac, r, d, sn=None):
         self.initialized = True
         maxlen = self.real_maxlen
         # Allocate memory
-        self.ss = np.empty((maxlen,) + s.shape, dtype=s.dtype)
-        self.acs = np.empty((maxlen,) + ac.shape, dtype=ac.dtype)
-        self.rs = np.empty((maxlen,) + r.shape, dtype=r.dtype)
-        self.ds = np.empty((maxlen,) + d.shape, dtype=np.bool)
+        self.ss = self._alloc("states", (maxlen,) + s.shape, dtype=s.dtype)
+        self.acs = self._alloc("acs", (maxlen,) + ac.shape, dtype=ac.dtype)
+        self.rs = self._alloc("rs", (maxlen,) + r.shape, dtype=r.dtype)
+        self.ds = self._alloc("ds", (maxlen,) + d.shape, dtype=np.bool_)
         if sn is not None:
             assert s.shape == sn.shape
-            self.sn = np.empty((maxlen,) + s.shape, dtype=s.dtype)
+            self.sn = self._alloc("sn", (maxlen,) + s.shape, dtype=s.dtype)
         else: self.sn = None
 
         self._create_strides()
 
+    def _alloc(self, name, shape, dtype):
+        if self._storage is None: return np.empty(shape, dtype=dtype)
+        return self._storage.alloc(name, shape, dtype)
+
+    def _reopen(self):
+        self.initialized = True
+        self.ss, self.acs = self._storage.get("states"), self._storage.get("acs")
+        self.rs, self.ds = self._storage.get("rs"), self._storage.get("ds")
+        self.sn = self._storage.get("sn") if "sn" in self._storage else None
+        if self.ss.shape[:2] != (self.real_maxlen, self.num_envs):
+            raise ValueError("Buffer stored in {} has shape {}, expected (maxlen // num_envs, num_envs) == {}".format(
+                self._storage.path, self.ss.shape[:2], (self.real_maxlen, self.num_envs)))
+        self.idx, self._len = self._storage.get_cursor()
+        if self._len == 0: self.idx = -1
+        self._create_strides()
+        self._update_valid(rows=np.arange(self.real_maxlen))
+
+    def flush(self):
+        if self._storage is not None: self._storage.flush()
+
+    def _update_cursor(self):
+        if self._storage is not None: self._storage.set_cursor(self.idx, self._len)
+
     def _create_strides(self):
         # Function for selecting multiple slices
         self.s_stride = strided_axis(arr=self.ss, window=self.stack)
@@ -86,10 +123,29 @@ class ReplayBuffer:
         self.d_stride = strided_axis(arr=self.ds, window=self.stack + self.n_step - 1)
         if self.sn is not None: self.stp1_stride = strided_axis(arr=self.sn, window=self.stack)
         else: self.stp1_stride = strided_axis(arr=self.ss, window=self.stack)
+        # Validity of the window starting at each (row, env), kept up to date on every write
+        self._valid = np.zeros(self.ss.shape[:2], dtype=bool)
+
+    @property
+    def _window(self): return self.stack + self.n_step
+
+    def _update_valid(self, rows):
+        "Recomputes the validity of the windows that contain any of ``rows``, returns the rows of the updated windows."
+        rows = np.unique((np.asarray(rows)[:, None] - np.arange(self._window)).ravel())
+        rows = rows[(rows >= 0) & (rows <= self.real_maxlen - self._window)]
+        # Windows can't cross the write head, the newest row can only be the last one of a window
+        head = (rows <= self.idx) & (self.idx < rows + self._window - 1)
+        unwritten = rows + self._window - 1 > self.idx if self._len < self.real_maxlen else np.zeros_like(head)
+        # Stacked states can't span the end of an episode
+        seam = self.ds[rows[:, None] + np.arange(self.stack - 1)].any(axis=1)
+        self._valid[rows] = ~(head | unwritten)[:, None] & ~seam
+        return rows
 
     def reset(self):
         self.idx = -1
         self._len = 0
+        if self.initialized: self._valid[:] = False
+        self._update_cursor()
 
     def add_sample(self, s, ac, r, d, sn=None):
         "Add a single sample to the replay buffer, shape should be: (num_envs, features)."
@@ -106,6 +162,8 @@ class ReplayBuffer:
         if sn is not None:
             assert self.sn is not None
             self.sn[self.idx] = sn
+        self._update_valid(rows=[self.idx])
+        self._update_cursor()
 
     def add_samples(self, ss, acs, rs, ds):
         " Add a single sample to the replay buffer, shape should be (num_samples, num_envs, features)."
@@ -129,9 +187,12 @@ class ReplayBuffer:
         # Update current position
         self.idx = (self.idx + num_samples) % self.real_maxlen
         self._len = min(self._len + num_samples, self.real_maxlen)
+        self._update_valid(rows=idxs if num_samples < self.real_maxlen else np.arange(self.real_maxlen))
+        self._update_cursor()
 
     def sample(self, batch_size):
-        idxs = np.random.choice(self.available_idxs, size=batch_size, replace=False)
+        valid = self._valid.reshape(-1)
+        idxs = self.sampler.sample(n=self.available_idxs, bs=batch_size, valid=lambda idxs: valid[idxs])
         return self._get_batch(idxs=idxs)
 
     def check_shapes(self, *arrs):
@@ -146,11 +207,12 @@ class ReplayBuffer:
         savedir.mkdir(exist_ok=True)
         tqdm.write("Saving buffer to {}".format(savedir))
 
-        # Save transitions
-        np.save(savedir / "states.npy", self.ss[: len(self)])
-        np.save(savedir / "acs.npy", self.acs[: len(self)])
-        np.save(savedir / "rs.npy", self.rs[: len(self)])
-        np.save(savedir / "ds.npy", self.ds[: len(self)])
+        # Save transitions, oldest first
+        rows = (np.arange(self._len) + (self.idx + 1 if self._len == self.real_maxlen else 0)) % self.real_maxlen
+        np.save(savedir / "states.npy", self.ss[rows])
+        np.save(savedir / "acs.npy", self.acs[rows])
+        np.save(savedir / "rs.npy", self.rs[rows])
+        np.save(savedir / "ds.npy", self.ds[rows])
 
     def load(self, loaddir):
         loaddir = Path(loaddir) / "buffer"
@@ -182,12 +244,13 @@ def strided_axis(arr, window):
 
 class DictReplayBuffer:
     # TODO: Save and load
-    def __init__(self, maxlen, num_envs):
+    def __init__(self, maxlen, num_envs, seed=None):
         assert num_envs == 1
         self.maxlen = int(maxlen)
         self.buffer = []
         # Intialized at -1 so the first updated position is 0
         self.position = -1
+        self.sampler = IndexSampler(seed)
 
     def __len__(self): return len(self.buffer)
 
@@ -211,7 +274,8 @@ class DictReplayBuffer:
         self.buffer[self.position] = dict(s=s, ac=ac, r=r, d=d)
 
     def sample(self, batch_size):
-        idxs = np.random.choice(len(self) - 1, batch_size, replace=False)
+        # The newest transition has no next state yet
+        idxs = self.sampler.sample(n=len(self) - 1, bs=batch_size, valid=lambda idxs: idxs != self.position)
         return self._get_batch(idxs=idxs)
 
     def save(self, savedir): raise NotImplementedError
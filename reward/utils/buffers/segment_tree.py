@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class SegmentTree:
+    """
+    Array backed binary segment tree, all operations are vectorized over a batch of indexes.
+
+    Parameters
+    ----------
+        capacity: int
+            Number of leaves, rounded up to the next power of 2.
+        op: numpy ufunc
+            Associative operation used to combine two nodes (e.g. ``np.add``, ``np.minimum``).
+        neutral: float
+            Neutral element of ``op``, the initial value of all leaves.
+    """
+    def __init__(self, capacity, op, neutral):
+        self.capacity = 1 << int(np.ceil(np.log2(max(int(capacity), 2))))
+        self.op, self.neutral = op, neutral
+        self.tree = np.full(2 * self.capacity, neutral, dtype=np.float64)
+
+    def __getitem__(self, idx): return self.tree[self.capacity + np.asarray(idx)]
+
+    def __setitem__(self, idx, val):
+        "Updates the leaves and all their ancestors, O(len(idx) * log(capacity))."
+        idx = np.atleast_1d(self.capacity + np.asarray(idx))
+        self.tree[idx] = val
+        idx = np.unique(idx // 2)
+        while idx[0] >= 1:
+            self.tree[idx] = self.op(self.tree[2 * idx], self.tree[2 * idx + 1])
+            idx = np.unique(idx // 2)
+
+    @property
+    def values(self): return self.tree[self.capacity:]
+
+    def reduce(self, start=0, end=None):
+        "Applies ``op`` over the leaves in ``[start, end)``, O(log(capacity))."
+        end = self.capacity if end is None else end
+        res, start, end = self.neutral, start + self.capacity, end + self.capacity
+        while start < end:
+            if start & 1:
+                res = self.op(res, self.tree[start])
+                start += 1
+            if end & 1:
+                end -= 1
+                res = self.op(res, self.tree[end])
+            start, end = start // 2, end // 2
+        return res
+
+
+class SumTree(SegmentTree):
+    def __init__(self, capacity): super().__init__(capacity=capacity, op=np.add, neutral=0.)
+
+    @property
+    def total(self): return self.tree[1]
+
+    def find_prefixsum_idx(self, prefixsum):
+        "Highest index ``i`` such that ``sum(values[:i]) <= prefixsum``, for a batch of prefixsums."
+        prefixsum = np.array(prefixsum, dtype=np.float64)
+        idx = np.ones(prefixsum.shape, dtype=np.int64)
+        while idx[0] < self.capacity:
+            left = self.tree[2 * idx]
+            go_right = prefixsum > left
+            prefixsum -= left * go_right
+            idx = 2 * idx + go_right
+        return idx - self.capacity
+
+
+class MinTree(SegmentTree):
+    def __init__(self, capacity): super().__init__(capacity=capacity, op=np.minimum, neutral=np.inf)
+
+    @property
+    def min(self): return self.tree[1]
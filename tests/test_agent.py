@@ -0,0 +1,114 @@
+import pytest
+import torch
+import numpy as np, reward as rw
+from types import SimpleNamespace
+from reward.agent.rollout import RollBatch
+from reward.agent.agent import StepAligner
+
+
+def test_roll_batch():
+    S, A = rw.space.Continuous(low=[0] * 3, high=[1] * 3), rw.space.Categorical(n_acs=100)
+    b = RollBatch(horizon=4, s_sp=S, a_sp=A)
+    for i in range(5):
+        b.add_sa(s=[S(np.full((2, 3), i))], a=[A(np.full(2, i))])
+        b.add_rd(r=np.full(2, i), d=np.zeros(2))
+    assert len(b) == 5 and b.ss[0].shape == (5, 2, 3) and b.ss[0].dtype == np.float32
+    d = b.get(reset=False)
+    np.testing.assert_equal(d['ss'][0][:, 0, 0], np.arange(5))
+    np.testing.assert_equal(d['rs'][:, 0], np.arange(4))
+    assert np.shares_memory(d['ss'][0], b.ss[0])
+    with pytest.raises(RuntimeError): b.add_sa(s=[S(np.zeros((2, 3)))], a=[A(np.zeros(2))])
+    # The state after the last transition starts the next rollout
+    b.reset()
+    assert len(b) == 1
+    np.testing.assert_equal(b.get()['ss'][0][:, 0, 0], [4])
+
+
+def test_rollout_batch():
+    S, A = rw.space.Continuous(low=[0] * 3, high=[1] * 3), rw.space.Categorical(n_acs=100)
+    batches = []
+    # The batch can be a view of the storage, only valid during train
+    train = lambda **b: batches.append({k: [o.clone() for o in v] if isinstance(v, list) else v.clone() for k, v in b.items()})
+    agent = rw.agent.Rollout(model=SimpleNamespace(train=train), s_sp=S, a_sp=A, bs=4)
+    for i in range(5):
+        agent.register_sa(s=[S(np.full((2, 3), i))], a=[A(np.full(2, i))])
+        agent.report(r=np.full(2, i), d=np.zeros(2))
+    b, = batches
+    # Tensors keep the storage dtype, not float64/int64 copies of it
+    assert b['ss'][0].dtype == torch.float32 and b['acs'][0].dtype == torch.long and b['ds'].dtype == torch.float32
+    np.testing.assert_equal(b['ss'][0][:, 0, 0].numpy(), np.arange(4))
+    np.testing.assert_equal(b['sns'][0][:, 0, 0].numpy(), np.arange(1, 5))
+    np.testing.assert_equal(b['acs'][0][:, 0].numpy(), np.arange(4))
+
+
+def test_replay_prefetch():
+    S, A = rw.space.Continuous(low=[0] * 3, high=[1] * 3), rw.space.Categorical(n_acs=4)
+    batches = []
+    model = SimpleNamespace(gamma=.9, train=lambda **b: batches.append(b))
+    agent = rw.agent.Replay(model=model, s_sp=S, a_sp=A, bs=4, maxlen=32, prefetch=2)
+    for i in range(12):
+        agent.register_sa(s=[S(np.full((1, 3), i))], a=[A(np.full(1, i % 4))])
+        agent.report(r=np.ones(1), d=np.zeros(1))
+    b = batches[-1]
+    assert b['ss'][0].dtype == torch.float32 and b['acs'][0].dtype == torch.long and b['ds'].dtype == torch.float32
+    np.testing.assert_equal((b['sns'][0] - b['ss'][0]).numpy(), 1)
+    np.testing.assert_equal(b['acs'][0].numpy()[:, 0], b['ss'][0].numpy()[:, 0, 0] % 4)
+    agent.close()
+    assert agent._prefetcher._thread is None
+
+
+def test_step_aligner():
+    S = rw.space.Continuous(low=[0], high=[1])
+    calls = []
+    al = StepAligner(n_envs=4, register_sa=lambda s, a: calls.append(('sa', np.asarray(s[0])[:, 0])),
+                     report=lambda r, d: calls.append(('rd', r)))
+    a, b = np.array([0, 1]), np.array([2, 3])
+    # Rewards after a reset are ignored
+    al.add_rd(r=np.zeros(2), d=np.zeros(2), idxs=a)
+    al.add_sa(s=[S(np.full((2, 1), 0.))], a=[S(np.zeros((2, 1)))], idxs=a)
+    al.add_rd(r=np.full(2, 1.), d=np.zeros(2), idxs=a)
+    # Group a is a step ahead, its actions are kept until group b reports
+    al.add_sa(s=[S(np.full((2, 1), 1.))], a=[S(np.zeros((2, 1)))], idxs=a)
+    assert calls == []
+    al.add_sa(s=[S(np.full((2, 1), 0.))], a=[S(np.zeros((2, 1)))], idxs=b)
+    al.add_rd(r=np.full(2, 2.), d=np.zeros(2), idxs=b)
+    assert [o[0] for o in calls] == ['sa', 'rd']
+    np.testing.assert_equal(calls[1][1], [1, 1, 2, 2])
+    al.add_sa(s=[S(np.full((2, 1), 1.))], a=[S(np.zeros((2, 1)))], idxs=b)
+    np.testing.assert_equal(calls[2][1], [1, 1, 1, 1])
+    with pytest.raises(RuntimeError): al.add_sa(s=[S(np.zeros((2, 1)))], a=[S(np.zeros((2, 1)))], idxs=b)
+
+
+def test_step_aligner_lazy_stack():
+    S, A = rw.space.Image(shape=[4, 1, 1, 2]), rw.space.Categorical(n_acs=2)
+    calls = []
+    al = StepAligner(n_envs=4, register_sa=lambda s, a: calls.append(s[0]), report=lambda r, d: None)
+    stacks = {}
+    for idxs in [np.array([2, 3]), np.array([0, 1])]:
+        stacks[idxs[0]] = rw.tfm.img.Stack(n=2)
+        s = S(idxs.astype('uint8').reshape(2, 1, 1, 1)).apply_tfms(stacks[idxs[0]])
+        al.add_sa(s=[s], a=[A(np.zeros(2))], idxs=idxs)
+    # Memories receive the stacks frame by frame, as if all envs were stepped together
+    assert isinstance(calls[0].img, rw.tfm.img.img.LazyStack) and len(calls[0].img.arr) == 2
+    np.testing.assert_equal(np.array(calls[0])[:, 0, 0], np.repeat(np.arange(4)[:, None], 2, axis=1))
+    # Envs of a call at different steps split the stacks the same way
+    part = al._take([S(np.full((2, 1, 1, 1), 6, dtype='uint8')).apply_tfms(stacks[0])], np.array([False, True]))[0]
+    assert isinstance(part.img, rw.tfm.img.img.LazyStack)
+    np.testing.assert_equal(np.array(part)[:, 0, 0], [[1, 6]])
+
+def test_step_aligner_mixed_steps():
+    S = rw.space.Continuous(low=[0], high=[1])
+    calls = []
+    al = StepAligner(n_envs=2, register_sa=lambda s, a: calls.append(('sa', np.asarray(s[0])[:, 0])),
+                     report=lambda r, d: calls.append(('rd', r)))
+    al.add_sa(s=[S(np.full((2, 1), 0.))], a=[S(np.zeros((2, 1)))], idxs=np.array([0, 1]))
+    al.add_rd(r=np.full(1, 1.), d=np.zeros(1), idxs=np.array([0]))
+    al.add_sa(s=[S(np.full((1, 1), 1.))], a=[S(np.zeros((1, 1)))], idxs=np.array([0]))
+    # Env 0 is a step ahead of env 1, both report in the same call
+    al.add_rd(r=np.array([2., 3.]), d=np.zeros(2), idxs=np.array([0, 1]))
+    assert [o[0] for o in calls] == ['sa', 'rd']
+    np.testing.assert_equal(calls[1][1], [1, 3])
+    al.add_sa(s=[S(np.full((1, 1), 1.))], a=[S(np.zeros((1, 1)))], idxs=np.array([1]))
+    np.testing.assert_equal(calls[2][1], [1, 1])
+    al.add_rd(r=np.array([4.]), d=np.zeros(1), idxs=np.array([1]))
+    np.testing.assert_equal(calls[3][1], [2, 4])
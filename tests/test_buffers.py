@@ -0,0 +1,142 @@
+import pytest
+import numpy as np
+from reward.utils.buffers import SumTree, MinTree, ReplayBuffer, PrReplayBuffer, DemoReplayBuffer, PrDemoReplayBuffer, IndexSampler
+
+
+@pytest.mark.parametrize("capacity", [1, 7, 64])
+def test_segment_tree_reduce(capacity):
+    vals = np.random.uniform(size=capacity)
+    st, mt = SumTree(capacity), MinTree(capacity)
+    st[np.arange(capacity)] = vals
+    mt[np.arange(capacity)] = vals
+    np.testing.assert_allclose(st.total, vals.sum())
+    np.testing.assert_allclose(mt.min, vals.min())
+    for start, end in [(0, capacity), (0, 1), (capacity // 2, capacity)]:
+        if start >= end: continue
+        np.testing.assert_allclose(st.reduce(start, end), vals[start:end].sum())
+        np.testing.assert_allclose(mt.reduce(start, end), vals[start:end].min())
+
+def test_sum_tree_find_prefixsum_idx():
+    st = SumTree(5)
+    st[np.arange(5)] = np.array([1., 0., 2., 3., 4.])
+    idxs = st.find_prefixsum_idx([0., 0.5, 1.5, 2.99, 3.01, 9.99])
+    np.testing.assert_equal(idxs, [0, 0, 2, 2, 3, 4])
+
+@pytest.mark.parametrize("num_envs", [1, 4])
+def test_pr_replay_buffer(num_envs):
+    b = PrReplayBuffer(maxlen=400, num_envs=num_envs, pr_factor=1., is_factor=1., min_pr=0.)
+    for i in range(500 // num_envs):
+        b.add_sample(s=np.full((num_envs, 2), i), ac=np.zeros(num_envs), r=np.zeros(num_envs), d=np.zeros(num_envs))
+    pr = np.zeros(b.available_idxs)
+    pr[[3, 10]] = [1., 3.]
+    b.update_pr(idx=np.arange(b.available_idxs), pr=pr, step=0)
+    batch = b.sample(batch_size=400)
+    assert set(np.unique(batch.idx)) == {3, 10}
+    assert abs((batch.idx == 10).mean() - .75) < .1
+    b.update_pr(idx=np.arange(b.available_idxs), pr=pr + 1, step=0)
+    np.testing.assert_allclose(b.get_is_weight(idx=np.array([0, 3, 10]), step=0)[:, 0], [1., .5, .25])
+
+def test_replay_buffer_memmap_reopen(tmpdir):
+    b = ReplayBuffer(maxlen=40, num_envs=2, memdir=tmpdir)
+    for i in range(25):
+        b.add_sample(s=np.full((2, 3), i), ac=np.zeros(2), r=np.full(2, i), d=np.zeros(2))
+    b.flush()
+    b2 = ReplayBuffer(maxlen=40, num_envs=2, memdir=tmpdir)
+    assert len(b2) == len(b) and b2.idx == b.idx
+    np.testing.assert_equal(b2.ss, b.ss)
+    np.testing.assert_equal(b2.sample(batch_size=4).s.shape, (1, 4, 3))
+
+def test_index_sampler():
+    s1, s2 = IndexSampler(seed=3), IndexSampler(seed=3)
+    idxs = s1.sample(n=10 ** 7, bs=64)
+    assert len(np.unique(idxs)) == 64 and idxs.max() < 10 ** 7
+    np.testing.assert_equal(idxs, s2.sample(n=10 ** 7, bs=64))
+    idxs = s1.sample(n=100, bs=40, valid=lambda x: x % 2 == 0)
+    assert len(np.unique(idxs)) == 40 and (idxs % 2 == 0).all()
+    # Falls back to a permutation when the batch is most of the buffer
+    np.testing.assert_equal(np.sort(s1.sample(n=50, bs=25, valid=lambda x: x < 25)), np.arange(25))
+    with pytest.raises(ValueError): s1.sample(n=10, bs=6, valid=lambda x: x < 5)
+
+def test_replay_buffer_head_windows():
+    b = ReplayBuffer(maxlen=10, num_envs=1, stack=3, seed=0)
+    for i in range(14): b.add_sample(s=np.full((1, 1), i), ac=np.zeros((1, 1)), r=np.zeros(1), d=np.zeros(1))
+    batch = b.sample(batch_size=4)
+    # Storage rows hold [10..13, 4..9], stacks can't mix both sides of the head
+    s = batch.s[:, :, 0].T
+    np.testing.assert_equal(np.diff(s, axis=1), 1)
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_replay_buffer_valid_windows(bulk):
+    b = ReplayBuffer(maxlen=40, num_envs=2, stack=3, n_step=2, seed=0)
+    ss = np.arange(45)[:, None, None] * 10 + np.arange(2)[:, None]
+    ds = (np.arange(45)[:, None] + np.arange(2)) % 7 == 0
+    if bulk: b.add_samples(ss=ss, acs=np.zeros((45, 2, 1)), rs=np.zeros((45, 2)), ds=ds)
+    else:
+        for s, d in zip(ss, ds): b.add_sample(s=s, ac=np.zeros((2, 1)), r=np.zeros(2), d=d)
+    for _ in range(5):
+        batch = b.sample(batch_size=8)
+        s, sn = batch.s[..., 0].T // 10, batch.sn[..., 0].T // 10
+        # Stacks are consecutive steps of a single episode
+        np.testing.assert_equal(np.diff(s, axis=1), 1)
+        np.testing.assert_equal(sn, s + 2)
+        env = batch.s[0, :, 0] % 10
+        assert not (((s[:, :-1] + env[:, None]) % 7) == 0).any()
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_pr_replay_buffer_valid_windows(bulk):
+    b = PrReplayBuffer(maxlen=40, num_envs=2, pr_factor=1., is_factor=1., min_pr=0., stack=3, n_step=2, seed=0)
+    ss = np.arange(45)[:, None, None] * 10 + np.arange(2)[:, None]
+    ds = (np.arange(45)[:, None] + np.arange(2)) % 7 == 0
+    if bulk: b.add_samples(ss=ss, acs=np.zeros((45, 2, 1)), rs=np.zeros((45, 2)), ds=ds)
+    else:
+        for s, d in zip(ss, ds): b.add_sample(s=s, ac=np.zeros((2, 1)), r=np.zeros(2), d=d)
+    # Invalid windows have no mass, even with the highest priority
+    idx = np.arange(b.available_idxs)
+    b.update_pr(idx=idx, pr=np.where(b._valid.reshape(-1)[idx], 1., 100.), step=0)
+    assert b._sum_tree.reduce(0, b.available_idxs) == b._valid.reshape(-1)[idx].sum()
+    for _ in range(5):
+        batch = b.sample(batch_size=8)
+        s, sn = batch.s[..., 0].T // 10, batch.sn[..., 0].T // 10
+        # Stacks are consecutive steps of a single episode
+        np.testing.assert_equal(np.diff(s, axis=1), 1)
+        np.testing.assert_equal(sn, s + 2)
+        env = batch.s[0, :, 0] % 10
+        assert not (((s[:, :-1] + env[:, None]) % 7) == 0).any()
+
+def test_demo_replay_buffer(tmpdir):
+    demos = ReplayBuffer(maxlen=20, num_envs=1)
+    for i in range(20): demos.add_sample(s=np.full((1, 1), -i - 1), ac=np.zeros((1, 1)), r=np.zeros(1), d=np.zeros(1))
+    demos.save(tmpdir)
+    b = DemoReplayBuffer(maxlen=10, num_envs=1, demo_maxlen=30, demo_ratio=0.25, stack=2, seed=0)
+    b.load_demos(tmpdir, chunk_size=7)
+    # Only demos available
+    assert b.sample(batch_size=8).is_demo.all()
+    for i in range(25): b.add_sample(s=np.full((1, 1), i), ac=np.zeros((1, 1)), r=np.zeros(1), d=np.zeros(1))
+    batch = b.sample(batch_size=8)
+    s = batch.s[-1, :, 0]
+    np.testing.assert_equal(batch.is_demo, np.arange(8) < 2)
+    np.testing.assert_equal(s < 0, batch.is_demo)
+    # Agent indexes come after the demo ones
+    np.testing.assert_equal(batch.idx >= b.demo_capacity, ~batch.is_demo)
+    # Demos are never evicted
+    assert len(b.demo) == 20 and b.demo.ss[:20].min() == -20
+    with pytest.raises(ValueError): b.load_demos(tmpdir)
+
+def test_pr_demo_replay_buffer():
+    b = PrDemoReplayBuffer(maxlen=20, num_envs=1, demo_maxlen=10, demo_ratio=0.5, pr_factor=1., is_factor=1., min_pr=0., seed=0)
+    for i in range(10): b.add_sample_demo(s=np.full((1, 1), -i - 1), ac=np.zeros((1, 1)), r=np.zeros(1), d=np.zeros(1))
+    for i in range(20): b.add_sample(s=np.full((1, 1), i), ac=np.zeros((1, 1)), r=np.zeros(1), d=np.zeros(1))
+    batch = b.sample(batch_size=8)
+    np.testing.assert_equal(batch.idx >= b.demo_capacity, ~batch.is_demo)
+    # A mixed batch, only the first transition of each partition keeps a priority
+    demo_idx, agent_idx = batch.idx[batch.is_demo][0], batch.idx[~batch.is_demo][0]
+    idx = np.concatenate([np.arange(b.demo.available_idxs), b.demo_capacity + np.arange(b.available_idxs)])
+    b.update_pr(idx=idx, pr=np.isin(idx, [demo_idx, agent_idx]), step=0)
+    assert b.demo._prs[demo_idx] == 1 and b._prs[agent_idx - b.demo_capacity] == 1
+    assert b.demo._sum_tree.total == b._sum_tree.total == 1
+    batch = b.sample(batch_size=8)
+    np.testing.assert_equal(batch.idx, np.where(batch.is_demo, demo_idx, agent_idx))
+    np.testing.assert_equal(batch.s[-1, :, 0] < 0, batch.is_demo)
+    # Weights are normalized inside each partition
+    b.update_pr(idx=idx, pr=1 + np.isin(idx, [demo_idx, agent_idx]), step=0)
+    np.testing.assert_allclose(b.get_is_weight(idx=batch.idx, step=0), .5)
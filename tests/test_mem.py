@@ -0,0 +1,294 @@
+import pytest
+import numpy as np, reward as rw
+
+
+def fill(b, n, S, A, start=0):
+    for i in range(start, start + n):
+        b.add_transition(s=[S(np.full((1, 3), i))], a=[A(np.array([i]))], r=np.array([i]), d=np.array([False]))
+
+@pytest.mark.parametrize("n", [10, 25])
+def test_replay_buffer_columnar(n):
+    S, A = rw.space.Continuous(low=[0] * 3, high=[1] * 3), rw.space.Categorical(n_acs=100)
+    b = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A)
+    fill(b, n, S, A)
+    assert len(b) == min(n, 16)
+    assert b.ss[0].dtype == np.float32 and b.acs[0].dtype == np.int32
+    batch = b.sample(bs=8)
+    ss, sns, acs = batch.ss[0], batch.sns[0], batch.acs[0]
+    assert ss.shape == (8, 1, 3) and acs.shape == (8, 1) and batch.rs.shape == (8, 1)
+    # Next state is always the following transition, even after wrapping
+    np.testing.assert_equal(sns[:, 0, 0], ss[:, 0, 0] + 1)
+    np.testing.assert_equal(acs[:, 0], ss[:, 0, 0])
+    np.testing.assert_equal(batch.rs[:, 0], ss[:, 0, 0])
+    assert ss.min() >= max(0, n - 16)
+    t = S.from_arr(ss).to_tensor()
+    assert tuple(t.shape) == (8, 1, 3)
+
+def test_replay_buffer_save_load(tmpdir):
+    S, A = rw.space.Continuous(low=[0] * 3, high=[1] * 3), rw.space.Categorical(n_acs=100)
+    b = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A)
+    fill(b, 20, S, A)
+    b.save(tmpdir)
+    b2 = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A)
+    b2.load(tmpdir)
+    np.testing.assert_equal(b2.ss[0][:, 0, 0], np.arange(4, 20))
+    np.testing.assert_equal(b2.acs[0][:, 0], np.arange(4, 20))
+
+def test_replay_buffer_memmap_reopen(tmpdir):
+    S, A = rw.space.Continuous(low=[0] * 3, high=[1] * 3), rw.space.Categorical(n_acs=100)
+    b = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A, memdir=tmpdir)
+    fill(b, 20, S, A)
+    assert isinstance(b.ss[0], np.memmap)
+    b.flush()
+    b2 = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A, memdir=tmpdir)
+    assert len(b2) == 16 and b2.position == b.position
+    np.testing.assert_equal(b2.ss[0], b.ss[0])
+    fill(b2, 1, S, A, start=20)
+    np.testing.assert_equal(b2.ss[0][b2._ordered_idxs()][-2:, 0, 0], [19, 20])
+    with pytest.raises(ValueError): rw.mem.ReplayBuffer(maxlen=8, memdir=tmpdir)
+
+def test_replay_buffer_stacked_frames():
+    S, A = rw.space.Image(shape=[1, 2, 2, 3]), rw.space.Categorical(n_acs=2)
+    stack = rw.tfm.img.Stack(n=3)
+    b = rw.mem.ReplayBuffer(maxlen=8, s_sp=S, a_sp=A)
+    ss = {}
+    for i in range(1, 12):
+        s = S(np.full((1, 2, 2, 1), i, dtype='uint8')).apply_tfms(stack)
+        ss[i] = np.array(s.img)
+        b.add_transition(s=[s], a=[A(np.array([0]))], r=np.array([0.]), d=np.array([i == 7]))
+        if i == 7: stack.reset()
+    assert isinstance(b.ss[0], rw.mem.StackedFrames) and b.ss[0].frames.shape == (8, 1, 2, 2, 1)
+    last = lambda x: x[:, 0, 0, 0]
+    # Frames from 4 to 11 are stored, the episode ends at frame 7
+    idxs = b._ordered_idxs([2, 3, 4, 5, 7])
+    np.testing.assert_equal(last(b.ss[0][idxs]), [[4, 5, 6], [5, 6, 7], [8, 8, 8], [8, 8, 9], [9, 10, 11]])
+    # Stacks are the ones the agent acted on
+    for i, idx in zip([6, 7, 8, 9, 11], idxs): np.testing.assert_equal(b.ss[0][idx], ss[i])
+    batch = b._get_batch(idxs[:3])
+    np.testing.assert_equal(last(batch.sns[0]), [[5, 6, 7], [8, 8, 8], [8, 8, 9]])
+    # Frames 4 and 5 lost the first frames of their stacks
+    np.testing.assert_equal(np.sort(b.sample(bs=5).ss[0][:, 0, 0, 0, -1]), [6, 7, 8, 9, 10])
+    np.testing.assert_equal(np.sort(b.sample_seq(bs=4, seq_len=2).ss[0][:, 0, 0, 0, -1]), [6, 7, 8, 9])
+
+@pytest.mark.parametrize("delta", [None, 3])
+def test_compressed_frames(delta):
+    frames = rw.mem.CompressedFrames(maxlen=7, shape=(4, 4), dtype=np.uint8, delta=delta, n_threads=2)
+    expected = np.zeros((7, 4, 4), dtype=np.uint8)
+    for i in range(23):
+        x = np.random.randint(0, 255, size=(4, 4), dtype=np.uint8)
+        frames[i % 7], expected[i % 7] = x, x
+        idxs = np.random.randint(0, min(i + 1, 7), size=(5, 2))
+        np.testing.assert_equal(frames[idxs], expected[idxs])
+    assert frames.ratio > 0
+
+def test_replay_buffer_compressed():
+    S, A = rw.space.Image(shape=[1, 8, 8, 4]), rw.space.Categorical(n_acs=2)
+    stack = rw.tfm.img.Stack(n=4)
+    b1 = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A)
+    b2 = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A, compress='zlib', compress_kw=dict(delta=4))
+    for i in range(40):
+        s = S(np.full((1, 8, 8, 1), i % 5, dtype='uint8')).apply_tfms(stack)
+        for b in [b1, b2]: b.add_transition(s=[s], a=[A(np.array([0]))], r=np.array([0.]), d=np.array([i % 9 == 0]))
+    assert isinstance(b2.ss[0].frames, rw.mem.CompressedFrames)
+    idxs = np.arange(15)
+    np.testing.assert_equal(b2._get_batch(idxs).ss[0], b1._get_batch(idxs).ss[0])
+    ratio, decode_ms = b2.ss[0].frames.stats()
+    assert ratio > 5 and decode_ms > 0
+    from reward.logger.interface import _logger
+    assert b2._write_logs in _logger.callbacks
+    b2.close()
+    assert b2._write_logs not in _logger.callbacks
+
+@pytest.mark.parametrize("delta", [None, 2])
+def test_replay_buffer_compressed_partial(delta):
+    S, A = rw.space.Image(shape=[1, 2, 2, 3]), rw.space.Categorical(n_acs=2)
+    b1 = rw.mem.ReplayBuffer(maxlen=8, s_sp=S, a_sp=A)
+    b2 = rw.mem.ReplayBuffer(maxlen=8, s_sp=S, a_sp=A, compress='zlib', compress_kw=dict(delta=delta))
+    for b in [b1, b2]:
+        stack = rw.tfm.img.Stack(n=3)
+        for i in range(4):
+            s = S(np.full((1, 2, 2, 1), i, dtype='uint8')).apply_tfms(stack)
+            b.add_transition(s=[s], a=[A(np.array([0]))], r=np.array([0.]), d=np.array([False]))
+    # The first stacks reach ring rows that were never written
+    idxs = np.arange(3)
+    np.testing.assert_equal(b2._get_batch(idxs).ss[0], b1._get_batch(idxs).ss[0])
+    np.testing.assert_equal(b2.sample(bs=3).ss[0].shape, (3, 1, 2, 2, 3))
+
+def test_replay_buffer_multi_env():
+    S, A = rw.space.Continuous(low=[0] * 2, high=[1] * 2), rw.space.Categorical(n_acs=100)
+    b = rw.mem.ReplayBuffer(maxlen=30, s_sp=S, a_sp=A)
+    envs = np.arange(3)
+    for t in range(14):
+        s = np.repeat((t * 10 + envs)[:, None], 2, axis=1)
+        b.add_transition(s=[S(s)], a=[A(t * 10 + envs)], r=t * 10. + envs, d=envs == t % 3)
+    assert b.num_envs == 3 and b.ss[0].shape == (10, 3, 2) and len(b) == 30
+    batch = b.sample(bs=27)
+    ss, sns = batch.ss[0][:, 0, 0], batch.sns[0][:, 0, 0]
+    assert batch.ss[0].shape == (27, 1, 2) and batch.acs[0].shape == (27, 1) and batch.rs.shape == (27, 1)
+    np.testing.assert_equal(sns, ss + 10)
+    np.testing.assert_equal(batch.acs[0][:, 0], ss)
+    np.testing.assert_equal(batch.ds[:, 0], ss % 10 == (ss // 10) % 3)
+    assert len(np.unique(ss)) == 27 and ss.min() >= 40
+
+def test_replay_buffer_multi_env_stacked_frames():
+    S, A = rw.space.Image(shape=[2, 1, 1, 2]), rw.space.Categorical(n_acs=2)
+    stack = rw.tfm.img.Stack(n=2)
+    b = rw.mem.ReplayBuffer(maxlen=20, s_sp=S, a_sp=A)
+    for t in range(1, 6):
+        s = S(np.array([t, 10 * t], dtype='uint8').reshape(2, 1, 1, 1)).apply_tfms(stack)
+        b.add_transition(s=[s], a=[A(np.zeros(2))], r=np.zeros(2), d=np.array([t == 2, False]))
+    batch = b._get_batch(idxs=np.array([2, 2, 3]), envs=np.array([0, 1, 0]))
+    np.testing.assert_equal(batch.ss[0][:, 0, 0, 0], [[3, 3], [20, 30], [3, 4]])
+
+def test_replay_buffer_n_step():
+    S, A = rw.space.Continuous(low=[0] * 2, high=[1] * 2), rw.space.Categorical(n_acs=100)
+    b = rw.mem.ReplayBuffer(maxlen=40, s_sp=S, a_sp=A)
+    envs, gamma = np.arange(2), 0.5
+    for t in range(25):
+        s = np.repeat((t * 10 + envs)[:, None], 2, axis=1)
+        b.add_transition(s=[S(s)], a=[A(t * 10 + envs)], r=np.ones(2), d=np.array([t % 4 == 3, False]))
+    batch = b.sample(bs=20, n_step=3, gamma=gamma)
+    ss, sns = batch.ss[0][:, 0, 0], batch.sns[0][:, 0, 0]
+    t, env = ss // 10, ss % 10
+    # Episodes of env 0 end at every t % 4 == 3
+    steps = np.where(env == 0, np.minimum(3, 4 - t % 4), 3)
+    np.testing.assert_equal(sns, ss + 10 * steps)
+    np.testing.assert_allclose(batch.rs[:, 0], (1 - gamma ** steps) / (1 - gamma))
+    np.testing.assert_allclose(batch.gammas[:, 0], gamma ** steps)
+    np.testing.assert_equal(batch.ds[:, 0], (env == 0) & (t % 4 + steps == 4))
+    assert t.min() >= 5 and t.max() <= 21
+
+def test_batch_prefetcher():
+    calls = []
+    def sample():
+        calls.append(len(calls))
+        return dict(ss=[np.full((4, 1, 3), len(calls), dtype=np.float32)], rs=np.full((4, 1), len(calls)))
+    p = rw.mem.BatchPrefetcher(sample_fn=sample, convert_fn=lambda b: b, k=2, pin_memory=False)
+    bs = [p.get() for _ in range(5)]
+    np.testing.assert_equal(bs[-1].rs, 5)
+    np.testing.assert_equal(bs[-1].ss[0], 5)
+    # Staging memory is reused, at most k batches are built ahead
+    assert len(calls) <= 5 + 2 and p.depth <= 2 and p.n_gets == 5
+    p.close()
+
+def test_batch_prefetcher_error():
+    def sample(): raise RuntimeError('boom')
+    p = rw.mem.BatchPrefetcher(sample_fn=sample, convert_fn=lambda b: b)
+    with pytest.raises(RuntimeError): p.get()
+
+def test_replay_buffer_sharded_save(tmpdir):
+    S, A = rw.space.Continuous(low=[0] * 3, high=[1] * 3), rw.space.Categorical(n_acs=100)
+    b = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A)
+    fill(b, 10, S, A)
+    b.save(tmpdir, shard_size=4)
+    shards = lambda: sorted(o.basename for o in (tmpdir/'buffer'/'shards').listdir())
+    assert shards() == ['000000', '000001', '000002_10']
+    fill(b, 10, S, A, start=10)
+    b.save(tmpdir, shard_size=4)
+    # Complete shards are kept, the ones out of the buffer are removed
+    assert shards() == ['000001', '000002', '000003', '000004']
+    b2 = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A)
+    b2.load(tmpdir)
+    assert len(b2) == 16
+    np.testing.assert_equal(b2.ss[0][b2._ordered_idxs()][:, 0, 0], np.arange(4, 20))
+    np.testing.assert_equal(b2.rs[b2._ordered_idxs()][:, 0], np.arange(4, 20))
+    # Partial loads
+    b3 = rw.mem.ReplayBuffer(maxlen=8, s_sp=S, a_sp=A)
+    b3.load(tmpdir, start=-5)
+    np.testing.assert_equal(b3.acs[0][b3._ordered_idxs()][:, 0], np.arange(15, 20))
+    b3.load(tmpdir, stop=6)
+    np.testing.assert_equal(b3.acs[0][b3._ordered_idxs()][:, 0], [18, 19, 4, 5, 6, 7, 8, 9])
+
+def test_replay_buffer_sharded_save_stacked(tmpdir):
+    S, A = rw.space.Image(shape=[1, 4, 4, 2]), rw.space.Categorical(n_acs=2)
+    stack = rw.tfm.img.Stack(n=2)
+    b = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A)
+    for i in range(20):
+        s = S(np.full((1, 4, 4, 1), i, dtype='uint8')).apply_tfms(stack)
+        b.add_transition(s=[s], a=[A(np.array([0]))], r=np.array([i]), d=np.array([i % 6 == 5]))
+    b.save(tmpdir, shard_size=5)
+    b2 = rw.mem.ReplayBuffer(maxlen=16, s_sp=S, a_sp=A, compress='zlib')
+    b2.load(tmpdir)
+    assert isinstance(b2.ss[0].frames, rw.mem.CompressedFrames)
+    idxs = np.arange(16)
+    np.testing.assert_equal(b2._get_batch(b2._ordered_idxs(idxs)).ss[0], b._get_batch(b._ordered_idxs(idxs)).ss[0])
+
+def _shared_actor(shard, i, n):
+    S, A = rw.space.Continuous(low=[0] * 2, high=[1] * 2), rw.space.Categorical(n_acs=100)
+    fill_envs = lambda t: np.repeat((1000 * i + 10 * t + np.arange(2))[:, None], 2, axis=1)
+    for t in range(n):
+        shard.add_transition(s=[S(fill_envs(t))], a=[A(np.full(2, i))], r=np.full(2, float(t)), d=np.zeros(2, dtype=bool))
+
+def test_shared_replay_buffer():
+    import torch.multiprocessing as mp
+    S, A = rw.space.Continuous(low=[0] * 2, high=[1] * 2), rw.space.Categorical(n_acs=100)
+    b = rw.mem.SharedReplayBuffer(maxlen=80, n_shards=2, s_sp=S, a_sp=A, guard=2, seed=0)
+    b.initialize(s=[S(np.zeros((2, 2)))], a=[A(np.zeros(2))], r=np.zeros(2), d=np.zeros(2, dtype=bool))
+    ctx = mp.get_context('spawn')
+    ps = [ctx.Process(target=_shared_actor, args=(b.shards[i], i, n)) for i, n in [(0, 10), (1, 30)]]
+    for p in ps: p.start()
+    for p in ps: p.join()
+    assert len(b) == 2 * 10 + 2 * 20
+    batch = b.sample(bs=40)
+    ss, sns, acs = batch.ss[0][:, 0, 0], batch.sns[0][:, 0, 0], batch.acs[0][:, 0]
+    np.testing.assert_equal(sns, ss + 10)
+    np.testing.assert_equal(acs, ss // 1000)
+    assert len(np.unique(ss)) == 40
+    # The guard steps of the full shard are never sampled
+    assert ss[acs == 1].min() >= 1000 + 10 * 12
+
+def test_replay_buffer_sample_seq():
+    S, A = rw.space.Continuous(low=[0] * 2, high=[1] * 2), rw.space.Categorical(n_acs=100)
+    b = rw.mem.ReplayBuffer(maxlen=60, s_sp=S, a_sp=A)
+    envs = np.arange(2)
+    for t in range(40):
+        s = np.repeat((t * 10 + envs)[:, None], 2, axis=1)
+        b.add_transition(s=[S(s)], a=[A(t * 10 + envs)], r=t * 10. + envs, d=(t + envs) % 5 == 4)
+    batch = b.sample_seq(bs=16, seq_len=4, burn_in=2)
+    ss = batch.ss[0][..., 0]
+    assert batch.ss[0].shape == (16, 6, 2) and batch.acs[0].shape == (16, 6) and batch.masks.shape == (16, 6)
+    np.testing.assert_equal(np.diff(ss, axis=1), 10)
+    np.testing.assert_equal(batch.sns[0][..., 0], ss + 10)
+    np.testing.assert_equal(batch.rs, ss)
+    t, env = ss // 10, ss % 10
+    episode = (t + env) // 5
+    np.testing.assert_equal(batch.masks, episode == episode[:, 2:3])
+    assert ss.min() >= 100
+
+def test_replay_buffer_sample_seq_stacked():
+    S, A = rw.space.Image(shape=[1, 2, 2, 3]), rw.space.Categorical(n_acs=2)
+    stack = rw.tfm.img.Stack(n=3)
+    b = rw.mem.ReplayBuffer(maxlen=8, s_sp=S, a_sp=A)
+    for i in range(1, 12):
+        s = S(np.full((1, 2, 2, 1), i, dtype='uint8')).apply_tfms(stack)
+        b.add_transition(s=[s], a=[A(np.array([0]))], r=np.array([0.]), d=np.array([i == 7]))
+    batch = b.sample_seq(bs=3, seq_len=3)
+    assert batch.ss[0].shape == (3, 3, 2, 2, 3)
+    for seq in batch.ss[0]:
+        # Frames 4 to 11 are stored, the newest frame of each stack identifies its step
+        rel = seq[:, 0, 0, -1].astype(int) - 4
+        np.testing.assert_equal(seq, b.ss[0][b._ordered_idxs(rel), np.zeros(3, dtype=int)])
+        np.testing.assert_equal(np.diff(rel), 1)
+
+def test_deque_buffer_views():
+    S, A = rw.space.Continuous(low=[0] * 3, high=[1] * 3), rw.space.Categorical(n_acs=100)
+    b = rw.mem.DequeBuffer(maxlen=6, s_sp=S, a_sp=A)
+    for n in [3, 3, 4]:
+        fill(b, n, S, A, start=b._total)
+        batch = b.get()
+        # Views of the storage, even after wrapping
+        assert np.shares_memory(batch.ss[0], b.ss[0]) and batch.ss[0].shape == (min(b._total, 6) - 1, 1, 3)
+        np.testing.assert_equal(batch.ss[0][:, 0, 0], np.arange(b._total - len(b), b._total - 1))
+        np.testing.assert_equal(batch.sns[0][:, 0, 0], batch.ss[0][:, 0, 0] + 1)
+        np.testing.assert_equal(batch.rs[:, 0], batch.acs[0][:, 0])
+
+def test_deque_buffer_stacked():
+    S, A = rw.space.Image(shape=[1, 2, 2, 3]), rw.space.Categorical(n_acs=2)
+    stack = rw.tfm.img.Stack(n=3)
+    b = rw.mem.DequeBuffer(maxlen=4, s_sp=S, a_sp=A)
+    ss = []
+    for i in range(1, 8):
+        s = S(np.full((1, 2, 2, 1), i, dtype='uint8')).apply_tfms(stack)
+        ss.append(np.array(s))
+        b.add_transition(s=[s], a=[A(np.array([0]))], r=np.array([0.]), d=np.array([False]))
+    np.testing.assert_equal(b.get().sns[0], np.stack(ss[-3:]))
@@ -0,0 +1,380 @@
+import os, asyncio, pytest
+import numpy as np
+import reward as rw, reward.utils as U
+
+
+class CountEnv:
+    "State is the number of steps since the last reset, done every 3 steps."
+    def __init__(self): self.n = 0
+
+    def reset(self):
+        self.n = 0
+        return np.array([self.n], dtype='float32')
+
+    def step(self, a):
+        self.n += 1
+        d = self.n == 3
+        return np.array([self.n], dtype='float32'), float(a), d, {}
+
+
+@pytest.mark.parametrize('sync', ['queue', 'spin', 'futex'])
+def test_paac_sync(sync):
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(1,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    runner = rw.runner.PAAC(CountEnv, n_envs=4, n_workers=2, s_sp=s_sp, a_sp=a_sp, sync=sync)
+    try:
+        assert (runner.reset().numpy() == 0).all()
+        for i in range(1, 5):
+            acs = np.arange(4, dtype='float32')[:, None] * i
+            s, r, d, _ = runner.step(acs)
+            # Envs are reset on done, the state after the third step is a reset state
+            np.testing.assert_allclose(s.numpy()[:, 0], i % 3)
+            np.testing.assert_allclose(r.numpy(), acs[:, 0])
+            assert (d.numpy() == (i == 3)).all()
+        stats = runner.stats()
+        assert stats['step_ms'] > 0 and 0 <= stats['sync_overhead_ms'] <= stats['step_ms']
+    finally: runner.close()
+
+
+def test_paac_invalid_sync():
+    s_sp = rw.space.Continuous(low=0, high=1, shape=(1,))
+    with pytest.raises(ValueError): rw.runner.PAAC(CountEnv, n_envs=2, n_workers=2, s_sp=s_sp, a_sp=s_sp, sync='pipe')
+
+
+@pytest.mark.parametrize('sync', ['spin', 'futex'])
+def test_paac_async_groups(sync):
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(1,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    runner = rw.runner.PAAC(CountEnv, n_envs=4, n_workers=2, s_sp=s_sp, a_sp=a_sp, sync=sync, groups=2)
+    try:
+        runner.async_reset()
+        steps = np.zeros(4, dtype=int)
+        for _ in range(10):
+            s, r, d, _, idxs = runner.recv()
+            np.testing.assert_allclose(s.numpy()[:, 0], steps[idxs] % 3)
+            np.testing.assert_allclose(r.numpy(), (steps[idxs] > 0) * idxs)
+            with pytest.raises(RuntimeError): runner.step(np.zeros((4, 1)))
+            runner.send(idxs[:, None].astype('float32'), idxs=idxs)
+            steps[idxs] += 1
+        assert sorted(np.concatenate(runner.group_idxs)) == [0, 1, 2, 3]
+        with pytest.raises(ValueError): runner.send(np.zeros((1, 1)), idxs=[1])
+    finally: runner.close()
+
+
+@pytest.mark.parametrize('sync', ['spin', 'futex'])
+def test_paac_first_k(sync):
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(1,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    runner = rw.runner.PAAC(CountEnv, n_envs=4, n_workers=4, s_sp=s_sp, a_sp=a_sp, sync=sync, groups=4)
+    try:
+        runner.async_reset()
+        # Waiting for all the groups returns every env, in order
+        s, r, d, _, idxs = runner.recv(k=4)
+        np.testing.assert_equal(idxs, [0, 1, 2, 3])
+        runner.send(idxs[:, None].astype('float32'), idxs=idxs)
+        steps = np.ones(4, dtype=int)
+        for _ in range(10):
+            s, r, d, _, idxs = runner.recv(k=2, max_lag=1)
+            assert len(idxs) == 2 and (np.diff(idxs) > 0).all()
+            np.testing.assert_allclose(s.numpy()[:, 0], steps[idxs] % 3)
+            np.testing.assert_allclose(r.numpy(), idxs)
+            runner.send(idxs[:, None].astype('float32'), idxs=idxs)
+            steps[idxs] += 1
+        assert steps.max() - steps.min() <= 1
+        with pytest.raises(ValueError): runner.send(np.zeros((2, 1)), idxs=[1, 0])
+    finally: runner.close()
+
+
+class InfoEnv(CountEnv):
+    def step(self, a):
+        s, r, d, _ = super().step(a)
+        return s, r, d, dict(n=self.n, pos=np.full(2, self.n), name=f'step{self.n}')
+
+
+@pytest.mark.parametrize('extra_info', ['drop', 'batch'])
+def test_env_worker_info_schema(extra_info):
+    from reward.runner.paac_runner import EnvWorker
+    n = 2
+    info = U.memories.SimpleMemory(n=np.zeros(n, dtype=int), pos=np.zeros((n, 2)))
+    tran = U.memories.SimpleMemory(s=np.zeros((n, 1)), r=np.zeros(n), d=np.zeros(n), ac=np.zeros(n), info=info)
+    w = EnvWorker(env=[InfoEnv() for _ in range(n)], conn=None, barrier=None, shared_transition=tran, extra_info=extra_info)
+    w._reset()
+    w._step()
+    extra = w._step()
+    np.testing.assert_equal(info.n, [2, 2])
+    np.testing.assert_equal(info.pos, np.full((n, 2), 2))
+    assert extra == ({0: dict(name='step2'), 1: dict(name='step2')} if extra_info == 'batch' else {})
+
+
+class RunnerInfoEnv(InfoEnv):
+    "``InfoEnv`` with the interface expected by ``PAACRunner``."
+    env_name = 'count'
+
+    def __init__(self):
+        super().__init__()
+        self.s_space = rw.space.Continuous(low=0, high=10, shape=(1,))
+        self.ac_space = rw.space.Continuous(low=0, high=1, shape=(1,))
+
+    def sample_random_ac(self): return np.zeros(1, dtype='float32')
+
+    def close(self): pass
+
+
+def test_paac_runner_sync_modes():
+    from reward.runner.paac_runner import PAACRunner
+    schema = dict(n=0, pos=np.zeros(2))
+    runs = {}
+    for sync, extra_info in [('pipe', 'batch'), ('spin', 'drop'), ('futex', 'drop')]:
+        runner = PAACRunner([RunnerInfoEnv() for _ in range(4)], num_workers=2, sync=sync, info_schema=schema, extra_info=extra_info)
+        try:
+            steps = [(runner.reset(),)]
+            for i in range(1, 5): steps.append(runner.act(np.arange(4, dtype='float32')[:, None] * i))
+        finally: runner.close()
+        runs[sync] = steps
+        s, r, d, infos = steps[-1]
+        np.testing.assert_equal(s[:, 0], 1)
+        np.testing.assert_equal(r, np.arange(4) * 4)
+        assert [o['n'] for o in infos] == [1] * 4 and all((o['pos'] == 1).all() for o in infos)
+        # Only the batched extra info reaches the learner
+        assert all(('name' in o) == (extra_info == 'batch') for o in infos)
+    for sync in ['spin', 'futex']:
+        for a, b in zip(runs['pipe'], runs[sync]):
+            for x, y in zip(a[:3], b[:3]): np.testing.assert_equal(x, y)
+            if len(a) == 1: continue
+            for x, y in zip(a[3], b[3]): np.testing.assert_equal({k: v for k, v in x.items() if k != 'name'}, y)
+
+
+def test_paac_runner_more_workers_than_envs():
+    from reward.runner.paac_runner import PAACRunner
+    runner = PAACRunner([RunnerInfoEnv() for _ in range(2)], num_workers=3, info_schema=dict(n=0), extra_info='batch')
+    try:
+        runner.reset()
+        for i in range(1, 5):
+            s, r, d, infos = runner.act(np.full((2, 1), i, dtype='float32'))
+            np.testing.assert_equal(r, i)
+            assert [o['name'] for o in infos] == [f'step{(i - 1) % 3 + 1}'] * 2
+            # Every worker was waited for, even the one without envs
+            assert not any(w.barrier.poll(0.05) for w in runner.workers)
+    finally: runner.close()
+
+
+def test_paac_runner_placement():
+    import torch
+    from reward.runner.paac_runner import PAACRunner
+    from reward.runner.placement import Placement
+    cpu, n_threads = min(os.sched_getaffinity(0)), torch.get_num_threads()
+    placement = Placement(learner_cpus=0, cpus=[cpu], nodes={0: [cpu]})
+    runner = PAACRunner([RunnerInfoEnv() for _ in range(4)], num_workers=2, placement=placement)
+    try:
+        np.testing.assert_equal(runner.reset()[:, 0], 0)
+        s, r, _, _ = runner.act(np.ones((4, 1), dtype='float32'))
+        np.testing.assert_equal(r, 1)
+        np.testing.assert_equal(np.flatnonzero(runner._placement_report.any(0)), [cpu])
+    finally:
+        runner.close()
+        torch.set_num_threads(n_threads)
+
+
+def test_placement_empty_shared():
+    import multiprocessing
+    from reward.runner.placement import Placement
+    t = Placement.empty_shared((2, 3), dtype=np.int32)
+    assert t.shape == (2, 3) and t.numpy().dtype == np.int32
+    # Written by a forked process, as the workers do
+    p = multiprocessing.get_context('fork').Process(target=t.fill_, args=(7,))
+    p.start()
+    p.join()
+    np.testing.assert_equal(t.numpy(), 7)
+
+
+def test_thread_runner():
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(1,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    runner = rw.runner.ThreadRunner(CountEnv, n_envs=5, n_threads=2, s_sp=s_sp, a_sp=a_sp)
+    try:
+        assert (runner.reset().numpy() == 0).all()
+        for i in range(1, 5):
+            acs = np.arange(5, dtype='float32')[:, None] * i
+            s, r, d, _ = runner.step(acs)
+            np.testing.assert_allclose(s.numpy()[:, 0], i % 3)
+            np.testing.assert_allclose(r.numpy(), acs[:, 0])
+            assert (d.numpy() == (i == 3)).all()
+        assert runner.stats()['step_ms'] > 0
+    finally: runner.close()
+
+
+def test_async_runner_loopback():
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(4,)), rw.space.Continuous(low=0, high=1, shape=(2,))
+    with rw.env.LoopbackSim(ep_len=3, delay=0.01) as sim:
+        runner = rw.runner.AsyncRunner(lambda: rw.env.LoopbackEnv(sim.address), n_envs=8, s_sp=s_sp, a_sp=a_sp, timeout=1.)
+        try:
+            assert (runner.reset().numpy() == 0).all()
+            for i in range(1, 5):
+                s, r, d, infos = runner.step(np.ones((8, 2)))
+                np.testing.assert_allclose(s.numpy(), i % 3)
+                np.testing.assert_allclose(r.numpy(), 2.)
+                assert (d.numpy() == (i == 3)).all() and len(infos) == 8
+            # Envs are stepped concurrently, a step takes about one delay
+            assert runner.stats()['step_ms'] < 8 * 10
+        finally: runner.close()
+
+
+@pytest.mark.parametrize('on_timeout', ['raise', 'reset'])
+def test_async_runner_timeout(on_timeout):
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(4,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    with rw.env.LoopbackSim() as fast, rw.env.LoopbackSim(delay=0.5) as slow:
+        addresses = iter([fast.address, slow.address, fast.address])
+        runner = rw.runner.AsyncRunner(lambda: rw.env.LoopbackEnv(next(addresses)), n_envs=2, s_sp=s_sp, a_sp=a_sp,
+                                       timeout=0.2, on_timeout=on_timeout)
+        try:
+            if on_timeout == 'raise':
+                with pytest.raises(TimeoutError): runner.reset()
+                return
+            # The slow env is replaced by a new one (connected to the fast sim)
+            runner.reset()
+            s, r, d, infos = runner.step(np.ones((2, 1)))
+            np.testing.assert_allclose(s.numpy()[:, 0], [1, 1])
+            assert runner.stats()['timeouts'] == 1
+        finally: runner.close()
+
+
+class SlowResetEnv:
+    "Episodes of a single step, resets after the first ``fast`` ones take ``delay`` seconds."
+    def __init__(self, delay=0., fast=1): self.delay, self.fast, self.n = delay, fast, 0
+
+    async def reset(self):
+        self.n += 1
+        if self.n > self.fast: await asyncio.sleep(self.delay)
+        return np.zeros(4)
+
+    async def step(self, a): return np.ones(4), 5., True, {}
+
+
+@pytest.mark.parametrize('on_timeout', ['raise', 'reset'])
+def test_async_runner_reset_timeout(on_timeout):
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(4,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    envs = iter([SlowResetEnv(delay=1.), SlowResetEnv()])
+    runner = rw.runner.AsyncRunner(lambda: next(envs), n_envs=1, s_sp=s_sp, a_sp=a_sp, timeout=0.1, on_timeout=on_timeout)
+    try:
+        runner.reset()
+        if on_timeout == 'raise':
+            with pytest.raises(TimeoutError): runner.step(np.ones((1, 1)))
+            return
+        # The reward of the step is kept, the env is replaced before its next step
+        s, r, d, infos = runner.step(np.ones((1, 1)))
+        assert r.item() == 5. and d.item() and infos[0]['timeout']
+        assert runner.stats()['timeouts'] == 1
+        s, r, d, infos = runner.step(np.ones((1, 1)))
+        assert r.item() == 5. and d.item() and 'timeout' not in infos[0]
+        np.testing.assert_allclose(s.numpy(), 0.)
+    finally: runner.close()
+
+
+def test_async_runner_replacement_timeout():
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(4,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    envs = iter([SlowResetEnv(delay=1.), SlowResetEnv(delay=1., fast=0), SlowResetEnv()])
+    runner = rw.runner.AsyncRunner(lambda: next(envs), n_envs=1, s_sp=s_sp, a_sp=a_sp, timeout=0.1, on_timeout='reset')
+    try:
+        runner.reset()
+        runner.step(np.ones((1, 1)))
+        # The replacement times out too, the env is tried again on the next step
+        s, r, d, infos = runner.step(np.ones((1, 1)))
+        assert r.item() == 0. and d.item() and infos[0]['timeout']
+        assert runner.stats()['timeouts'] == 2
+        s, r, d, infos = runner.step(np.ones((1, 1)))
+        assert r.item() == 5. and 'timeout' not in infos[0]
+    finally: runner.close()
+
+
+def test_benchmark_async_script(monkeypatch, capsys):
+    import runpy, sys
+    path = os.path.join(os.path.dirname(__file__), '..', 'examples3', 'runner', 'benchmark_async.py')
+    monkeypatch.setattr(sys, 'argv', [path, '--n_envs', '2', '--delay', '0', '--steps', '3'])
+    runpy.run_path(path, run_name='__main__')
+    assert 'Serial' in capsys.readouterr().out
+
+
+def test_layout_tuner():
+    from reward.logger.interface import _logger
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(1,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    tuner = rw.runner.LayoutTuner(CountEnv, s_sp=s_sp, a_sp=a_sp, layouts=[(1, 1), (1, 2), (2, 4)], steps=5, warmup=1)
+    n_callbacks = len(_logger.callbacks)
+    results = tuner.run()
+    # Closed calibration runners are not kept alive by the logger
+    assert len(_logger.callbacks) == n_callbacks
+    assert len(results) == 3 and results[0].steps_s >= results[-1].steps_s
+    assert tuner.best in results and '<- best' in tuner.summary()
+    runner = tuner.build()
+    try: assert (runner.n_workers, runner.n_envs) == (tuner.best.n_workers, tuner.best.n_envs)
+    finally: runner.close()
+    assert len(_logger.callbacks) == n_callbacks
+    tuner.max_step_ms = 0.
+    with pytest.raises(ValueError): tuner.best
+
+
+def test_layout_tuner_runners():
+    from reward.runner.paac_runner import PAACRunner
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(1,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    tuner = rw.runner.LayoutTuner(CountEnv, s_sp=s_sp, a_sp=a_sp, layouts=[(1, 2), (2, 2)], steps=5, warmup=1, runner=rw.runner.ThreadRunner)
+    runner = tuner.build()
+    try: assert (runner.n_threads, runner.n_envs) == (tuner.best.n_workers, 2)
+    finally: runner.close()
+    # The layout is mapped to the list of envs and num_workers of PAACRunner
+    tuner = rw.runner.LayoutTuner(RunnerInfoEnv, s_sp=s_sp, a_sp=a_sp, layouts=[(1, 2), (2, 4)], steps=5, warmup=1, runner=PAACRunner, sync='spin')
+    runner = tuner.build()
+    try: assert (runner.num_workers, runner.num_envs, runner.sync_mode) == (tuner.best.n_workers, tuner.best.n_envs, 'spin')
+    finally: runner.close()
+    with pytest.raises(ValueError): rw.runner.LayoutTuner(CountEnv, s_sp=s_sp, a_sp=a_sp, runner=rw.runner.AsyncRunner)
+
+
+def test_placement_assign():
+    from reward.runner.placement import Placement, _parse_cpulist
+    assert _parse_cpulist('0-2,5,7-8\n') == [0, 1, 2, 5, 7, 8]
+    # Cpus of the two nodes are interleaved, workers get cpus of a single node
+    p = Placement(learner_cpus=2, cpus=range(8), nodes={0: [0, 2, 4, 6], 1: [1, 3, 5, 7]})
+    assert p.learner == [0, 1]
+    assert p.assign(3) == [[2, 4], [6, 3], [5, 7]]
+    assert Placement(learner_cpus=[7], cpus=range(8), numa=False, nodes={0: list(range(8))}).assign(2) == [[0, 1, 2, 3], [4, 5, 6]]
+    assert Placement(learner_cpus=0, cpus=[0, 1], nodes={0: [0, 1]}).assign(4) == [[0], [0], [1], [1]]
+
+
+def test_paac_placement():
+    import torch
+    from reward.runner.placement import Placement
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(1,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    cpu, n_threads = min(os.sched_getaffinity(0)), torch.get_num_threads()
+    runner = rw.runner.PAAC(CountEnv, n_envs=2, n_workers=2, s_sp=s_sp, a_sp=a_sp, placement=Placement(learner_cpus=0, cpus=[cpu]))
+    try:
+        assert (runner.reset().numpy() == 0).all()
+        np.testing.assert_equal(np.flatnonzero(runner._placement_report.numpy().any(0)), [cpu])
+        assert runner._placement_logged.all()
+        s, r, _, _ = runner.step(np.ones((2, 1)))
+        np.testing.assert_allclose(r.numpy(), 1.)
+    finally:
+        runner.close()
+        torch.set_num_threads(n_threads)
+
+
+def test_step_timings_percentile():
+    from reward.runner.timings import StepTimings
+    t = StepTimings(n_workers=2, lo=1e-3, hi=1., bins_per_decade=1)
+    np.testing.assert_allclose(t.edges[:-1], [1e-3, 1e-2, 1e-1, 1.])
+    for dt in [5e-3] * 98 + [0.5] * 2: t.steps[0, t.bin(dt)] += 1
+    h = t.read()
+    np.testing.assert_allclose(t.percentile(h['steps'], 50), [1e-2, np.nan])
+    np.testing.assert_allclose(t.percentile(h['steps'], 99), [1., np.nan])
+    # Only what was added since the last read
+    assert t.read()['steps'].sum() == 0
+
+
+@pytest.mark.parametrize('sync', ['queue', 'futex'])
+def test_paac_profile(sync):
+    s_sp, a_sp = rw.space.Continuous(low=0, high=10, shape=(1,)), rw.space.Continuous(low=0, high=1, shape=(1,))
+    runner = rw.runner.PAAC(CountEnv, n_envs=4, n_workers=2, s_sp=s_sp, a_sp=a_sp, sync=sync, profile=True)
+    try:
+        runner.reset()
+        # Drop the resets of the first reset
+        runner.worker_stats()
+        for _ in range(6): runner.step(np.zeros((4, 1)))
+        stats, barrier_wait = runner.worker_stats()
+        assert len(stats) == 2 and barrier_wait > 0
+        for o in stats:
+            np.testing.assert_allclose(o['resets_per_step'], 1 / 3)
+            assert 0 < o['step_p50_ms'] <= o['step_p99_ms'] and o['wait_ms'] >= 0
+    finally: runner.close()